@@ -0,0 +1 @@
+default_app_config = 'github_users.apps.GitHubUsersConfig'
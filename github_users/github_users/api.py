@@ -1,19 +1,57 @@
+import json
+
 from django.conf.urls import url
+from django.core.exceptions import MultipleObjectsReturned
+from django.http import StreamingHttpResponse
 
 from tastypie import fields
+from tastypie.exceptions import BadRequest, ImmediateHttpResponse, InvalidSortError, NotFound
 from tastypie.resources import ModelResource, ALL, ALL_WITH_RELATIONS
 from tastypie.utils import trailing_slash
 
+from .graph_cache import follow_graph
 from .models import GitHubUser
+from .paginator import KeysetPaginator, iterate_keyset
+from .result_cache import cached_results
+
+
+DISTANCE_FILTERS = {
+    'distance': lambda value, distance: [value],
+    'distance__lt': lambda value, distance: range(1, value),
+    'distance__lte': lambda value, distance: range(1, value + 1),
+    'distance__gt': lambda value, distance: range(value + 1, distance + 1),
+    'distance__gte': lambda value, distance: range(value, distance + 1),
+}
+
+
+def _has_distance(bundle):
+    return hasattr(bundle.obj, 'distance')
+
+
+def _never(bundle):
+    return False
 
 
 class GitHubUserResource(ModelResource):
-    followers = fields.ToManyField('self', 'followers', use_in='detail')
-    following = fields.ToManyField('self', 'following', use_in='detail')
+    # Only there to filter on: a popular user's full lists are far too long to
+    # output. The detail view links to the paginated followers/ and following/.
+    followers = fields.ToManyField('self', 'followers', use_in=_never)
+    following = fields.ToManyField('self', 'following', use_in=_never)
+    # How many of the user's followers and following are stored, from with_edge_counts().
+    followers_count = fields.IntegerField(attribute='followers_stored', readonly=True,
+                                          use_in='detail')
+    following_count = fields.IntegerField(attribute='following_stored', readonly=True,
+                                          use_in='detail')
+    followers_uri = fields.CharField(readonly=True, use_in='detail')
+    following_uri = fields.CharField(readonly=True, use_in='detail')
+    # Only set on the users listed by within().
+    distance = fields.IntegerField(attribute='distance', readonly=True, null=True,
+                                   use_in=_has_distance)
 
     class Meta:
         queryset = GitHubUser.objects.all()
         resource_name = 'user'
+        paginator_class = KeysetPaginator
         fields = ['id', 'github_id', 'login', 'num_following',
                   'num_followers', 'location', 'company']
         filtering = {
@@ -29,7 +67,7 @@ class GitHubUserResource(ModelResource):
             'distance': []
         }
         ordering = ['id', 'num_followers', 'num_following', 'login', 'github_id', 'location',
-                    'company']
+                    'company', 'distance']
 
     def prepend_urls(self):
         return [
@@ -38,27 +76,182 @@ class GitHubUserResource(ModelResource):
                 self._meta.detail_uri_name,
                 trailing_slash()
             ), self.wrap_view('within'), name="api_user_within"),
+            url(r"^(?P<resource_name>%s)/(?P<%s>.*?)/path/(?P<other_pk>\d+)%s$" % (
+                self._meta.resource_name,
+                self._meta.detail_uri_name,
+                trailing_slash()
+            ), self.wrap_view('path'), name="api_user_path"),
+            url(r"^(?P<resource_name>%s)/(?P<%s>.*?)/followers%s$" % (
+                self._meta.resource_name,
+                self._meta.detail_uri_name,
+                trailing_slash()
+            ), self.wrap_view('get_followers'), name="api_user_followers"),
+            url(r"^(?P<resource_name>%s)/(?P<%s>.*?)/following%s$" % (
+                self._meta.resource_name,
+                self._meta.detail_uri_name,
+                trailing_slash()
+            ), self.wrap_view('get_following'), name="api_user_following"),
         ]
 
+    def obj_get(self, bundle, **kwargs):
+        """
+        Get the user along with the counts of their stored followers and following,
+        all in one query.
+        """
+        objects = self.get_object_list(bundle.request).with_edge_counts().filter(**kwargs)
+        try:
+            matches = list(objects[:2])
+        except ValueError:
+            raise NotFound("Invalid resource lookup data provided (mismatched type).")
+        if not matches:
+            raise GitHubUser.DoesNotExist("Couldn't find a user which matched '%s'." % kwargs)
+        if len(matches) > 1:
+            raise MultipleObjectsReturned("More than one user matched '%s'." % kwargs)
+
+        bundle.obj = matches[0]
+        self.authorized_read_detail(objects, bundle)
+        return bundle.obj
+
+    def _relation_uri(self, bundle, relation):
+        return self._build_reverse_url('api_user_%s' % relation,
+                                       kwargs=self.resource_uri_kwargs(bundle))
+
+    def dehydrate_followers_uri(self, bundle):
+        return self._relation_uri(bundle, 'followers')
+
+    def dehydrate_following_uri(self, bundle):
+        return self._relation_uri(bundle, 'following')
+
+    def wants_ndjson(self, request):
+        """
+        Whether the client asked for NDJSON, with ``format=ndjson`` or the Accept header.
+        """
+        return (request.GET.get('format') == 'ndjson' or
+                request.META.get('HTTP_ACCEPT', '').startswith('application/x-ndjson'))
+
+    def stream_ndjson(self, objects):
+        """
+        Stream ``objects`` as newline delimited JSON, one user per line.
+
+        Rows are read in chunks as plain values and written out directly,
+        skipping the bundles and dehydration of the paginated views.
+        """
+        fields = list(self._meta.fields)
+        if 'distance' in objects.query.annotations:
+            fields.append('distance')
+        # Detail URIs are the list URI followed by the pk.
+        detail_uri = self.get_resource_uri() + '%d/'
+
+        def lines():
+            chunk = []
+            for row in iterate_keyset(objects, fields):
+                row['resource_uri'] = detail_uri % row['id']
+                chunk.append(json.dumps(row))
+                if len(chunk) == 500:
+                    yield '\n'.join(chunk) + '\n'
+                    chunk = []
+            if chunk:
+                yield '\n'.join(chunk) + '\n'
+
+        return StreamingHttpResponse(lines(), content_type='application/x-ndjson')
+
+    def get_list(self, request, **kwargs):
+        """
+        Return a page of the list, served from the result cache where possible,
+        or the whole list as a stream of NDJSON with ``format=ndjson``.
+        """
+        base_bundle = self.build_bundle(request=request)
+
+        def build():
+            objects = self.obj_get_list(bundle=base_bundle,
+                                        **self.remove_api_resource_names(kwargs))
+            return self.apply_sorting(objects, options=request.GET)
+
+        response = self.paginated_response(request, cached_results(request, build, GitHubUser))
+        if self.wants_ndjson(request):
+            # dispatch() replaces anything that isn't an HttpResponse with a 204,
+            # so the stream has to skip past it.
+            raise ImmediateHttpResponse(response=response)
+        return response
+
+    def apply_sorting(self, obj_list, options=None):
+        order_by = options.getlist('order_by') if hasattr(options, 'getlist') else []
+        if ('distance' not in obj_list.query.annotations and
+                any(order.lstrip('-') == 'distance' for order in order_by)):
+            raise InvalidSortError("Ordering by distance is only possible on within/<distance>/.")
+        return super(GitHubUserResource, self).apply_sorting(obj_list, options=options)
+
+    def distance_filter(self, request, distance):
+        """
+        Return the distances, up to ``distance``, that the request's ``distance``
+        filters allow, or ``None`` if there are no such filters.
+        """
+        distances = None
+        for name, values in DISTANCE_FILTERS.items():
+            if name not in request.GET:
+                continue
+            try:
+                value = int(request.GET[name])
+            except ValueError:
+                raise BadRequest("Invalid %s '%s' provided. Please provide an integer." % (
+                    name, request.GET[name]))
+            allowed = set(values(value, distance))
+            distances = allowed if distances is None else distances & allowed
+
+        if 'distance__in' in request.GET:
+            try:
+                allowed = set(int(value) for value in request.GET['distance__in'].split(','))
+            except ValueError:
+                raise BadRequest("Invalid distance__in '%s' provided. Please provide a comma "
+                                 "separated list of integers." % request.GET['distance__in'])
+            distances = allowed if distances is None else distances & allowed
+        return distances
+
     def within(self, request, **kwargs):
         """
         Expose the distance method on the custom manager via an instance.
 
+        Each user comes with their shortest ``distance`` from the given user,
+        which can be filtered on and ordered by. With ``counts_only=1`` only
+        the number of users at each distance is returned.
+
         There is almost definitely a better way to do this. This method is
         duplicating a bunch of code in the get_list() method.
         """
         self.method_check(request, allowed=['get'])
         basic_bundle = self.build_bundle(request=request)
-        distance = kwargs.pop('distance')
+        distance = int(kwargs.pop('distance'))
         user = self.cached_obj_get(bundle=basic_bundle,
                                    **self.remove_api_resource_names(kwargs))
-        # Access our custom manager method to get the appropriate queryset
-        objects = user.users_within_distance(int(distance))
+        distances = self.distance_filter(request, distance)
 
-        sorted_objects = self.apply_sorting(objects, options=request.GET)
+        if request.GET.get('counts_only') in ('1', 'true'):
+            counts = dict((str(d), count) for d, count in
+                          enumerate(user.distance_counts(distance, stale_ok=True), 1)
+                          if distances is None or d in distances)
+            return self.create_response(request, {'counts': counts,
+                                                  'total_count': sum(counts.values())})
+
+        graph = follow_graph(stale_ok=True)
+
+        def build():
+            # Access our custom manager method to get the appropriate queryset
+            objects = user.users_within_distance(distance, with_distance=True,
+                                                 distances=distances, stale_ok=True)
+            return self.apply_sorting(objects, options=request.GET)
+
+        return self.paginated_response(request,
+                                       cached_results(request, build, GitHubUser, graph))
+
+    def paginated_response(self, request, sorted_objects):
+        """
+        Return a page of ``sorted_objects``, or all of them as NDJSON.
+        """
+        if self.wants_ndjson(request):
+            return self.stream_ndjson(sorted_objects)
 
         paginator = self._meta.paginator_class(request.GET, sorted_objects,
-                                               resource_uri=self.get_resource_uri(),
+                                               resource_uri=request.path,
                                                limit=self._meta.limit,
                                                max_limit=self._meta.max_limit,
                                                collection_name=self._meta.collection_name)
@@ -75,3 +268,57 @@ class GitHubUserResource(ModelResource):
         to_be_serialized = self.alter_list_data_to_serialize(request, to_be_serialized)
         return self.create_response(request, to_be_serialized)
 
+    def get_followers(self, request, **kwargs):
+        return self.relation(request, 'followers', **kwargs)
+
+    def get_following(self, request, **kwargs):
+        return self.relation(request, 'following', **kwargs)
+
+    def relation(self, request, relation, **kwargs):
+        """
+        List a user's stored followers or following, paginated like the user
+        list, with ``limit`` and ``offset`` or ``cursor``, and sortable.
+        """
+        self.method_check(request, allowed=['get'])
+        basic_bundle = self.build_bundle(request=request)
+        user = self.cached_obj_get(bundle=basic_bundle,
+                                   **self.remove_api_resource_names(kwargs))
+
+        def build():
+            objects = getattr(user, relation).all()
+            return self.apply_sorting(objects, options=request.GET)
+
+        return self.paginated_response(request, cached_results(request, build, GitHubUser))
+
+    def path(self, request, **kwargs):
+        """
+        Return the distance between two users and one shortest path between them,
+        following edges in either direction.
+
+        ``max_distance`` limits how far to search. When there is no path, the
+        distance is null and the path is empty.
+        """
+        self.method_check(request, allowed=['get'])
+        basic_bundle = self.build_bundle(request=request)
+        other_pk = kwargs.pop('other_pk')
+        kwargs = self.remove_api_resource_names(kwargs)
+        user = self.cached_obj_get(bundle=basic_bundle, **kwargs)
+        other = self.cached_obj_get(bundle=basic_bundle, pk=other_pk)
+
+        max_distance = request.GET.get('max_distance')
+        if max_distance is not None:
+            try:
+                max_distance = int(max_distance)
+            except ValueError:
+                raise BadRequest("Invalid max_distance '%s' provided. Please provide an "
+                                 "integer." % max_distance)
+
+        pks = follow_graph(stale_ok=True).shortest_path(user.pk, other.pk, max_distance) or []
+        users = GitHubUser.objects.in_bulk(pks)
+        bundles = [self.full_dehydrate(self.build_bundle(obj=users[pk], request=request),
+                                       for_list=True)
+                   for pk in pks]
+        return self.create_response(request, {
+            'distance': len(pks) - 1 if pks else None,
+            'path': bundles,
+        })
@@ -0,0 +1,40 @@
+from django.apps import AppConfig
+from django.conf import settings
+from django.core.management import call_command
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_migrate
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """
+    Apply ``SQLITE_PRAGMAS`` to every new SQLite connection.
+    """
+    if connection.vendor != 'sqlite':
+        return
+    # Straight on the driver's connection, so that they aren't logged as queries.
+    for name, value in settings.SQLITE_PRAGMAS:
+        connection.connection.execute('PRAGMA %s = %s' % (name, value))
+
+
+def create_cache_tables(sender, using, **kwargs):
+    """
+    Create the tables of the database caches, if they are missing, when the
+    cache database is migrated.
+    """
+    if using == settings.GITHUB_RESPONSE_CACHE_DATABASE:
+        call_command('createcachetable', database=using, verbosity=0)
+
+
+class GitHubUsersConfig(AppConfig):
+    name = 'github_users'
+    verbose_name = "GitHub users"
+
+    def ready(self):
+        from .models import GitHubUser, follow_edges_changed
+
+        m2m_changed.connect(follow_edges_changed, sender=GitHubUser.followers.through,
+                            dispatch_uid='github_users.follow_edges_changed')
+        connection_created.connect(configure_sqlite,
+                                   dispatch_uid='github_users.configure_sqlite')
+        post_migrate.connect(create_cache_tables, sender=self,
+                             dispatch_uid='github_users.create_cache_tables')
@@ -0,0 +1,321 @@
+"""
+Crawl the follow graph on an asyncio event loop. Python 3.5 and later only.
+
+``CrawlScheduler`` runs the model methods on each worker thread, so a worker
+that is writing a page to the database isn't fetching the next one. Here the
+network and the database are pipelined instead:
+
+* A user's profile, followers and following are fetched at the same time, and
+  the ``next`` page of a list is requested as soon as the page before it
+  arrives, before that page has been stored.
+* Every page is handed to a single writer task, which stores whatever has
+  queued up since its last batch in one transaction, on a thread of its own.
+
+Requests go through ``GitHubUserApi`` on a pool of threads, and share its
+ETags, response cache and rate limit governor. The frontier is checkpointed as
+``CrawlNode`` rows, just as ``CrawlScheduler`` does, so either can resume a
+run that the other started.
+"""
+import asyncio
+import datetime
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import pytz
+import requests
+from django.conf import settings
+from django.db import connection, transaction
+
+from .crawler import neighbor_pks, set_field, store_profile
+from .github_user_api import GitHubUserApi
+from .models import CrawlNode, CrawlRun, GitHubUser
+from .telemetry import stage
+from .transactions import immediate_atomic
+
+
+log = logging.getLogger(__name__)
+
+
+class ExecutorClient(object):
+    """
+    Make the requests of a ``GitHubUserApi`` on a pool of ``concurrency`` threads.
+    """
+
+    def __init__(self, api, concurrency):
+        self.api = api
+        self._executor = ThreadPoolExecutor(concurrency)
+
+    async def fetch(self, endpoint, etag=None, absolute_url=False):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, self.api._fetch,
+                                          endpoint, etag, absolute_url)
+
+    async def close(self):
+        self._executor.shutdown()
+
+
+class DatabaseWriter(object):
+    """
+    Run database work submitted from the event loop on a single thread.
+
+    ``submit()`` returns a future for the result. The writer takes everything
+    that has been submitted since its last batch, up to ``batch_size`` calls,
+    and runs it in one transaction, each call in a savepoint of its own so that
+    one failure doesn't undo the rest of the batch. The transaction takes the
+    write lock as it begins, so that a batch waits for any other writer to the
+    database rather than failing part way through.
+    """
+
+    def __init__(self, batch_size=50, telemetry=None):
+        self.batch_size = batch_size
+        self.telemetry = telemetry
+        self.batches = 0
+        self._queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(1)
+        self._task = asyncio.ensure_future(self._run())
+
+    def submit(self, func, *args, **kwargs):
+        future = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((partial(func, *args, **kwargs), future))
+        return future
+
+    async def close(self):
+        self._queue.put_nowait(None)
+        await self._task
+        await asyncio.get_event_loop().run_in_executor(self._executor, self._close_connection)
+        self._executor.shutdown()
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        closing = False
+        while not closing:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            if None in batch:
+                batch.remove(None)
+                closing = True
+            if not batch:
+                continue
+
+            results = await loop.run_in_executor(self._executor, self._run_batch,
+                                                 [call for call, _ in batch])
+            self.batches += 1
+            for (_, future), (ok, value) in zip(batch, results):
+                if future.cancelled():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    @staticmethod
+    def _close_connection():
+        # The thread has a connection of its own, which would otherwise be left open.
+        connection.close()
+
+    def _run_batch(self, calls):
+        results = []
+        with stage(self.telemetry, 'database'), immediate_atomic():
+            for call in calls:
+                try:
+                    with transaction.atomic():
+                        results.append((True, call()))
+                except Exception as e:
+                    results.append((False, e))
+        return results
+
+
+class AsyncCrawler(object):
+    """
+    Fill the follow graph around ``root`` to the given depth.
+
+    This crawls the same users as ``CrawlScheduler``, breadth first and each
+    once per run, with ``concurrency`` users in flight at a time. One
+    difference: a user's followers and following are requested alongside
+    their profile rather than after it, so lists are fetched for users whose
+    profile turns out to have no followers or following. That is the price of
+    not waiting on the profile.
+    """
+
+    def __init__(self, root, depth=3, concurrency=16, force=False, api=None,
+                 crawl_run=None, batch_size=50, client=None, telemetry=None):
+        self.root = root
+        self.depth = depth
+        self.concurrency = concurrency
+        self.force = force
+        self.api = api if api is not None else GitHubUserApi()
+        self.crawl_run = crawl_run
+        self.batch_size = batch_size
+        self.client = client
+        self.telemetry = telemetry
+        if telemetry is not None:
+            self.api.telemetry = telemetry
+
+        self.seen = set()
+        self.expanded = 0
+        # How many times a user was reached again after they were scheduled.
+        self.duplicates = 0
+        self.batches = 0
+
+    @classmethod
+    def resume(cls, crawl_run, concurrency=16, api=None, telemetry=None, batch_size=50):
+        """
+        Build a crawler that continues the given ``CrawlRun``.
+        """
+        return cls(crawl_run.root, depth=crawl_run.depth, concurrency=concurrency,
+                   force=crawl_run.force, api=api, crawl_run=crawl_run, telemetry=telemetry,
+                   batch_size=batch_size)
+
+    def run(self):
+        """
+        Crawl until the frontier is exhausted. Return the number of users expanded.
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self._crawl())
+        finally:
+            loop.close()
+
+    async def _crawl(self):
+        self.queue = asyncio.Queue()
+        self.writer = DatabaseWriter(self.batch_size, self.telemetry)
+        if self.client is None:
+            self.client = ExecutorClient(self.api, self.concurrency)
+        try:
+            if self.crawl_run is None:
+                self.crawl_run = await self.writer.submit(
+                    CrawlRun.objects.create, root=self.root, depth=self.depth, force=self.force)
+            for user_pk, depth, done in await self.writer.submit(self._checkpoint):
+                self.seen.add(user_pk)
+                if self.telemetry is not None:
+                    self.telemetry.scheduled(depth)
+                    if done:
+                        self.telemetry.finished(depth, restored=True)
+                if not done:
+                    self.queue.put_nowait((user_pk, depth))
+            if not self.seen:
+                await self.schedule([self.root.pk], 0)
+
+            workers = [asyncio.ensure_future(self._work()) for _ in range(self.concurrency)]
+            await self.queue.join()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+            await self.writer.submit(self._finish)
+        finally:
+            await self.client.close()
+            await self.writer.close()
+            self.batches = self.writer.batches
+        return self.expanded
+
+    def _checkpoint(self):
+        nodes = self.crawl_run.nodes.order_by('depth', 'pk')
+        return list(nodes.values_list('user_id', 'depth', 'done'))
+
+    def _finish(self):
+        # Users that failed are left on the frontier for the next --resume.
+        if not self.crawl_run.nodes.filter(done=False).exists():
+            self.crawl_run.finished = datetime.datetime.now(tz=pytz.UTC)
+            self.crawl_run.save(update_fields=['finished'])
+
+    async def schedule(self, pks, level):
+        """
+        Checkpoint and queue users for crawling, skipping any that are already
+        queued or done.
+        """
+        pks = list(OrderedDict.fromkeys(pks))
+        new_pks = [pk for pk in pks if pk not in self.seen]
+        self.duplicates += len(pks) - len(new_pks)
+        if not new_pks:
+            return
+        self.seen.update(new_pks)
+        await self.writer.submit(CrawlNode.objects.bulk_create, [
+            CrawlNode(run=self.crawl_run, user_id=pk, depth=level) for pk in new_pks
+        ])
+        if self.telemetry is not None:
+            self.telemetry.scheduled(level, len(new_pks))
+        for pk in new_pks:
+            self.queue.put_nowait((pk, level))
+
+    async def _work(self):
+        while True:
+            pk, level = await self.queue.get()
+            try:
+                await self.crawl(pk, level)
+            except Exception:
+                log.exception("Failed to crawl user %d" % pk)
+            finally:
+                self.queue.task_done()
+
+    async def crawl(self, pk, level):
+        """
+        Fetch a single user and queue their neighbors for the next level.
+
+        As in ``fill_follow_graph``, the root is expected to be populated
+        already, and users at the last level are only populated when
+        ``POPULATE_ALL`` is set.
+        """
+        user = await self.writer.submit(GitHubUser.objects.get, pk=pk)
+
+        fetches = []
+        if level > 0 and (level < self.depth or settings.POPULATE_ALL):
+            fetches.append(self._profile(user))
+        if level < self.depth:
+            fetches.append(self._relation(user, 'followers'))
+            fetches.append(self._relation(user, 'following'))
+        await asyncio.gather(*fetches)
+
+        if level < self.depth:
+            self.expanded += 1
+            await self.schedule(await self.writer.submit(neighbor_pks, user), level + 1)
+
+        await self.writer.submit(self.crawl_run.nodes.filter(user_id=pk).update, done=True)
+        if self.telemetry is not None:
+            self.telemetry.finished(level)
+
+    async def _profile(self, user):
+        api_resp = await self.client.fetch('/users/%s' % user.login,
+                                           False if self.force else user.e_tag)
+        await self.writer.submit(store_profile, user, api_resp)
+
+    async def _relation(self, user, relation):
+        """
+        Fetch the pages of the 'followers' or 'following' list of ``user`` and
+        hand them to the writer, as ``GitHubUser._populate_relation()`` does.
+        """
+        count = getattr(user, 'num_' + relation)
+        if count == 0 and not self.force:
+            return
+
+        etag_field = relation + '_etag'
+        api_resp = await self.client.fetch('/users/%s/%s?per_page=100' % (user.login, relation),
+                                           False if self.force else getattr(user, etag_field))
+        if api_resp['status'] == requests.codes.ok:
+            await self.writer.submit(set_field, user.pk, etag_field, api_resp['etag'])
+        elif api_resp['status'] != requests.codes.not_modified:
+            return
+
+        stored = []
+        complete = True
+        while True:
+            next_page = None
+            if 'next' in api_resp:
+                next_page = asyncio.ensure_future(
+                    self.client.fetch(api_resp['next'], None, absolute_url=True))
+            stored.append(self.writer.submit(user._ingest_page, api_resp['json'], relation))
+            if next_page is None:
+                break
+            api_resp = await next_page
+            if api_resp['status'] not in (requests.codes.ok, requests.codes.not_modified):
+                complete = False
+                break
+
+        seen = set()
+        for page_pks in await asyncio.gather(*stored):
+            seen |= page_pks
+        if self.force and complete:
+            await self.writer.submit(user._remove_stale, relation, seen)
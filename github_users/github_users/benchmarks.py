@@ -0,0 +1,478 @@
+"""
+Benchmarks for the crawler and the API, run by the ``benchmark`` management command.
+
+Each suite is a function that takes the command's options and returns a dict of
+results, which the command writes out as JSON so runs can be compared.
+
+The graph and API suites run against a synthetic follow graph, generated once
+per run with ``power_law_edges`` so that a few users have most of the
+followers, as on GitHub.
+"""
+import datetime
+import os
+from importlib import import_module
+from itertools import islice
+import random
+import shutil
+import tempfile
+import time
+
+import pytz
+import requests
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.db.models import Max
+from django.test import Client
+from django.test.utils import override_settings
+
+from .crawler import CrawlScheduler
+from .fake_github import FakeGitHub, UnlimitedGovernor
+from .github_user_api import GitHubUserApi
+from .graph import FollowGraph
+from .hydrate import Hydrator
+from .models import CrawlRun, GitHubUser
+from .paginator import encode_cursor
+
+LOCATIONS = [None, 'San Francisco', 'New York', 'London', 'Berlin', 'Tokyo', 'Bangalore']
+COMPANIES = [None, None, 'GitHub', 'Google', 'Microsoft', 'Mozilla']
+
+
+def _rate(count, seconds):
+    return {'requests': count, 'seconds': round(seconds, 4),
+            'per_second': round(count / seconds, 1) if seconds else None}
+
+
+def _timed(func, repeat=1):
+    """
+    Call ``func`` ``repeat`` times. Return the best time and the last result.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best, 4), result
+
+
+def power_law_edges(num_users, follows=5, seed=0):
+    """
+    Generate a follow graph by preferential attachment, as ``(user, follower)``
+    pairs of user numbers from ``0`` to ``num_users - 1``.
+
+    Each new user follows up to ``follows`` of the users before them, picked in
+    proportion to the number of followers they already have, plus one. The
+    result has a power law follower distribution.
+    """
+    rand = random.Random(seed)
+    # Every user appears once, plus once for each follower they have.
+    weighted = []
+    for follower in range(num_users):
+        followed = set()
+        for _ in range(min(follows, follower)):
+            followed.add(weighted[rand.randrange(len(weighted))])
+        for user in sorted(followed):
+            weighted.append(user)
+            yield user, follower
+        weighted.append(follower)
+
+
+def load_synthetic_graph(num_users, follows=5, seed=0, batch_size=10000):
+    """
+    Replace the users in the database with a generated graph of ``num_users``.
+
+    Return the pks of the users in the order they were generated, so the
+    first one has the most followers.
+
+    The edges are generated twice, once to count them and once to store them,
+    rather than held in memory all at once.
+    """
+    GitHubUser.objects.all().delete()
+
+    num_followers = [0] * num_users
+    num_following = [0] * num_users
+    for user, follower in power_law_edges(num_users, follows, seed):
+        num_followers[user] += 1
+        num_following[follower] += 1
+
+    rand = random.Random(seed)
+    now = datetime.datetime.now(tz=pytz.UTC)
+    for start in range(0, num_users, batch_size):
+        GitHubUser.objects.bulk_create([
+            GitHubUser(github_id=i + 1, login='user%d' % i,
+                       num_followers=num_followers[i], num_following=num_following[i],
+                       location=rand.choice(LOCATIONS), company=rand.choice(COMPANIES),
+                       last_retrieved=now, last_checked=now)
+            for i in range(start, min(start + batch_size, num_users))
+        ])
+
+    pks = dict(GitHubUser.objects.values_list('github_id', 'pk'))
+    pks = [pks[i + 1] for i in range(num_users)]
+    Through = GitHubUser.followers.through
+    edges = power_law_edges(num_users, follows, seed)
+    while True:
+        batch = [Through(from_githubuser_id=pks[user], to_githubuser_id=pks[follower])
+                 for user, follower in islice(edges, batch_size)]
+        if not batch:
+            break
+        Through.objects.bulk_create(batch)
+    return pks
+
+
+_synthetic = {}
+
+
+def _synthetic_graph(options):
+    """
+    Load the synthetic graph for ``options``, once for all of the suites that use it.
+    """
+    key = (options['users'], options['follows'], options['seed'])
+    if key not in _synthetic:
+        _synthetic.clear()
+        seconds, pks = _timed(lambda: load_synthetic_graph(*key))
+        _synthetic[key] = {'pks': pks, 'load_seconds': seconds}
+    return _synthetic[key]
+
+
+def _roots(pks):
+    """
+    The users to measure distances from: the one with the most followers,
+    and one from the middle of the pack.
+    """
+    return [('hub', pks[0]), ('median', pks[len(pks) // 2])]
+
+
+def graph_queries(options):
+    """
+    Time distance queries on the synthetic graph.
+    """
+    synthetic = _synthetic_graph(options)
+    repeat = options['repeat']
+    results = {'users': options['users'], 'load_seconds': synthetic['load_seconds']}
+
+    results['graph_load_seconds'], graph = _timed(FollowGraph.load, repeat)
+    results['edges'] = len(graph.followers)
+
+    for name, pk in _roots(synthetic['pks']):
+        user = GitHubUser.objects.get(pk=pk)
+        for distance in range(1, options['distance'] + 1):
+            seconds, found = _timed(
+                lambda: len(user.users_within_distance(distance).values_list('pk', flat=True)),
+                repeat)
+            results['within_%s_%d' % (name, distance)] = {'seconds': seconds, 'users': found}
+
+    # Between two of the last users to join, who are about as far apart as any.
+    pks = synthetic['pks']
+    seconds, path = _timed(lambda: graph.shortest_path(pks[-1], pks[-2]), repeat)
+    results['shortest_path'] = {'seconds': seconds, 'distance': len(path) - 1 if path else None}
+
+    # The same queries against a memory mapped snapshot, as another process would.
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'graph.snapshot')
+        graph = FollowGraph.load(all_users=True)
+        results['snapshot_write_seconds'], _ = _timed(lambda: graph.write_snapshot(
+            path, GitHubUser.objects.values_list('pk', 'github_id', 'login').iterator()))
+        results['snapshot_bytes'] = os.path.getsize(path)
+        results['snapshot_open_seconds'], snapshot = _timed(lambda: FollowGraph.open(path),
+                                                            repeat)
+        for name, pk in _roots(synthetic['pks']):
+            results['snapshot_degree_%s_seconds' % name], _ = _timed(
+                lambda: snapshot.degree(pk), repeat)
+            results['snapshot_neighbors_%s_seconds' % name], _ = _timed(
+                lambda: snapshot.neighbors(pk), repeat)
+            for distance in range(1, options['distance'] + 1):
+                seconds, found = _timed(lambda: len(snapshot.within(pk, distance)), repeat)
+                results['snapshot_within_%s_%d' % (name, distance)] = {'seconds': seconds,
+                                                                        'users': found}
+    finally:
+        shutil.rmtree(tmp)
+    return results
+
+
+def api_queries(options):
+    """
+    Time API requests on the synthetic graph, including serialization.
+
+    The result cache is cleared before each request, except for those named
+    ``_cached``, which time a second page of a result that is already cached.
+    """
+    synthetic = _synthetic_graph(options)
+    repeat = options['repeat']
+    client = Client()
+    filtered = '/api/user/?location=Berlin&num_followers__gte=5&order_by=login'
+    urls = [
+        ('list', '/api/user/'),
+        ('list_ordered', '/api/user/?order_by=-num_followers'),
+        ('list_filtered', filtered),
+        ('list_filtered_cached', filtered + '&offset=20'),
+        ('list_last_page', '/api/user/?order_by=-num_following&offset=%d' %
+         max(options['users'] - 20, 0)),
+    ]
+    # The same deep page, picked up from a cursor instead of an offset.
+    last = GitHubUser.objects.order_by('-num_following', 'id').values_list(
+        'num_following', 'id')[max(options['users'] - 21, 0)]
+    urls.append(('list_last_page_cursor', '/api/user/?order_by=-num_following&cursor=%s' %
+                 encode_cursor(['-num_following', 'id'], list(last))))
+    for name, pk in _roots(synthetic['pks']):
+        urls.append(('detail_%s' % name, '/api/user/%d/' % pk))
+        urls.append(('followers_%s_cursor' % name, '/api/user/%d/followers/?cursor=' % pk))
+        within = '/api/user/%d/within/%d/?order_by=-num_followers' % (pk, options['distance'])
+        urls.append(('within_%s' % name, within))
+        urls.append(('within_%s_cached' % name, within + '&offset=20'))
+        urls.append(('within_%s_ndjson' % name,
+                     '/api/user/%d/within/%d/?format=ndjson' % (pk, options['distance'])))
+        urls.append(('within_%s_counts' % name,
+                     '/api/user/%d/within/%d/?counts_only=1' % (pk, options['distance'])))
+    urls.append(('path', '/api/user/%d/path/%d/' % (synthetic['pks'][-1], synthetic['pks'][-2])))
+
+    def get(url, cached):
+        if not cached:
+            caches['results'].clear()
+        response = client.get(url)
+        if response.streaming:
+            b''.join(response.streaming_content)
+        return response
+
+    results = {'users': options['users']}
+    for name, url in urls:
+        seconds, response = _timed(lambda: get(url, name.endswith('_cached')), repeat)
+        assert response.status_code == 200, (url, response.status_code)
+        results[name] = {'url': url, 'seconds': seconds}
+    return results
+
+
+# The indexes that the filter_indexes migration added, by the columns they cover.
+TUNED_INDEXES = {
+    GitHubUser._meta.db_table: [['location'], ['company'], ['num_followers'], ['num_following']],
+    GitHubUser.followers.through._meta.db_table: [['to_githubuser_id', 'from_githubuser_id']],
+}
+
+filter_indexes = import_module('github_users.migrations.0005_filter_indexes')
+
+
+def case_insensitive_index_names():
+    """
+    Return the names of the case insensitive indexes that the filter_indexes
+    migration may have added on this backend.
+    """
+    return set(name for name, sql in filter_indexes.case_insensitive_indexes(
+        connection.vendor, filter_indexes.has_trigrams(connection)))
+
+
+def _tuned_indexes():
+    """
+    Return ``(table, name)`` for each of the indexes added for filtering and
+    ordering, the case insensitive ones included, as the database reports them.
+    """
+    case_insensitive = case_insensitive_index_names()
+    indexes = []
+    with connection.cursor() as cursor:
+        for table, columns in TUNED_INDEXES.items():
+            constraints = connection.introspection.get_constraints(cursor, table)
+            for name, constraint in constraints.items():
+                if constraint['unique'] or constraint['primary_key']:
+                    continue
+                if name in case_insensitive or (constraint['index'] and
+                                                constraint['columns'] in columns):
+                    indexes.append((table, name))
+    return indexes
+
+
+def indexes(options):
+    """
+    Time filtered and ordered queries on the synthetic graph with the indexes
+    from the filter_indexes migration, and again after dropping them.
+
+    The indexes are dropped inside a transaction that is rolled back, so this
+    needs a backend that can roll back DDL.
+    """
+    synthetic = _synthetic_graph(options)
+    repeat = options['repeat']
+    hub, median = synthetic['pks'][0], synthetic['pks'][len(synthetic['pks']) // 2]
+    queries = {
+        'location_exact_by_followers': lambda: list(GitHubUser.objects.filter(
+            location='Berlin').order_by('-num_followers')[:20]),
+        'location_iexact_count': lambda: GitHubUser.objects.filter(
+            location__iexact='berlin').count(),
+        'company_istartswith_count': lambda: GitHubUser.objects.filter(
+            company__istartswith='goo').count(),
+        'top_followers': lambda: list(GitHubUser.objects.order_by('-num_followers')[:20]),
+        'num_following_range_count': lambda: GitHubUser.objects.filter(
+            num_following__gte=3, num_following__lte=4).count(),
+        'following_of_hub': lambda: len(GitHubUser(pk=hub).following.values_list(
+            'pk', flat=True)),
+        'following_of_median': lambda: len(GitHubUser(pk=median).following.values_list(
+            'pk', flat=True)),
+    }
+
+    def run():
+        return dict((name, _timed(query, repeat)[0]) for name, query in queries.items())
+
+    results = {'users': options['users'], 'with_indexes': run()}
+    dropped = _tuned_indexes()
+    results['indexes'] = sorted(name for table, name in dropped)
+    if not connection.features.can_rollback_ddl:
+        return results
+
+    with transaction.atomic():
+        with connection.schema_editor() as schema_editor:
+            for table, name in dropped:
+                schema_editor.execute(schema_editor.sql_delete_index % {
+                    'table': schema_editor.quote_name(table),
+                    'name': schema_editor.quote_name(name),
+                })
+        results['without_indexes'] = run()
+        transaction.set_rollback(True)
+    return results
+
+
+# SQLite's defaults, SQLITE_PRAGMAS, and SQLITE_PRAGMAS with --batch-size.
+CRAWL_WRITE_MODES = [
+    ('crawl_autocommit', [('journal_mode', 'DELETE'), ('synchronous', 'FULL')], 1),
+    ('crawl_wal', settings.SQLITE_PRAGMAS, 1),
+    ('crawl_wal_batched', settings.SQLITE_PRAGMAS, 100),
+]
+
+
+def _crawl_writes(api, num_users, pragmas, batch_size, first_id):
+    """
+    Time a crawl of root and the profiles of its followers, which commits as it
+    goes, with ``pragmas`` and transactions of ``batch_size`` users.
+    """
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            for name, value in pragmas:
+                cursor.execute('PRAGMA %s = %s' % (name, value))
+    caches['github'].clear()
+    root = GitHubUser(login='root')
+    root.api = api
+    root.populate_from_github(force=True)
+    crawler = CrawlScheduler(root, depth=1, workers=1, force=True, api=api,
+                             batch_size=batch_size)
+    try:
+        # The crawler's thread opens a connection of its own.
+        with override_settings(POPULATE_ALL=True, SQLITE_PRAGMAS=pragmas):
+            seconds, _ = _timed(crawler.run)
+    finally:
+        CrawlRun.objects.filter(root=root).delete()
+        GitHubUser.objects.filter(github_id__gte=first_id).delete()
+    return {'seconds': seconds, 'users_per_second': round(num_users / seconds, 1)}
+
+
+def ingest(options):
+    """
+    Time storing follower lists from a local fake GitHub, through
+    ``populate_followers`` and ``_add_followers``, and then a whole crawl with
+    each of the ``CRAWL_WRITE_MODES``. Commits only cost what they do on disk
+    with ``--on-disk``.
+
+    The database is rolled back or cleaned up afterwards, so this leaves the
+    synthetic graph alone.
+    """
+    followers = ['follower%d' % i for i in range(options['followers'])]
+    results = {'followers': len(followers)}
+    # Keep clear of the GitHub ids of any synthetic users.
+    first_id = (GitHubUser.objects.aggregate(Max('github_id'))['github_id__max'] or 0) + 1
+    with FakeGitHub({'root': followers}, latency=options['latency'], first_id=first_id) as fake:
+        api = GitHubUserApi(governor=UnlimitedGovernor(), host=fake.url)
+        with transaction.atomic():
+            root = GitHubUser(login='root')
+            root.api = api
+            root.populate_from_github(force=True)
+
+            # The second pass only has to check the edges it already has, and
+            # gets every page after the first as a 304.
+            for name in ('first_fetch', 'refetch'):
+                before = fake.requests
+                seconds, _ = _timed(lambda: root.populate_followers(force=True))
+                results[name] = dict(_rate(fake.requests - before, seconds),
+                                     users_per_second=round(len(followers) / seconds, 1))
+
+            # _add_followers alone, without the network.
+            page = [fake.user_json(login) for login in followers[:100]]
+            GitHubUser.objects.filter(login__in=followers[:100]).delete()
+            seconds, _ = _timed(lambda: root._add_followers(page))
+            results['add_followers_page'] = {'users': len(page), 'seconds': seconds}
+            transaction.set_rollback(True)
+
+        for name, pragmas, batch_size in CRAWL_WRITE_MODES:
+            results[name] = _crawl_writes(api, len(followers), pragmas, batch_size, first_id)
+    return results
+
+
+def hydrate(options):
+    """
+    Compare fetching profiles one at a time, as the crawlers do with
+    ``POPULATE_ALL``, with the ``Hydrator``, against a local fake GitHub.
+
+    Each way fetches half of ``followers`` new users, which are deleted again
+    afterwards.
+    """
+    logins = ['hydrate%d' % i for i in range(options['followers'])]
+    first_id = (GitHubUser.objects.aggregate(Max('github_id'))['github_id__max'] or 0) + 1
+    users = GitHubUser.objects.filter(github_id__gte=first_id)
+    results = {}
+    with FakeGitHub({'root': logins}, latency=options['latency'], first_id=first_id) as fake:
+        api = GitHubUserApi(governor=UnlimitedGovernor(), host=fake.url)
+        now = datetime.datetime.now(tz=pytz.UTC)
+        GitHubUser.objects.bulk_create([
+            GitHubUser(github_id=fake.ids[login], login=login, last_retrieved=now,
+                       last_checked=now)
+            for login in logins])
+        try:
+            half = list(users.order_by('pk')[:len(logins) // 2])
+
+            def one_at_a_time():
+                for user in half:
+                    user.api = api
+                    user.populate_from_github()
+
+            seconds, _ = _timed(one_at_a_time)
+            results['one_at_a_time'] = _rate(len(half), seconds)
+            seconds, stats = _timed(lambda: Hydrator(users=users, api=api).run())
+            results['hydrator'] = _rate(stats['hydrated'], seconds)
+        finally:
+            users.delete()
+    return results
+
+
+def http_client(options):
+    """
+    Compare a new connection per request with the pooled, kept alive session
+    that ``GitHubUserApi`` uses, against a local fake GitHub.
+    """
+    count = options['requests']
+    results = {}
+    with FakeGitHub({'root': ['follower']}, latency=options['latency']) as fake:
+        url = '%s/users/root' % fake.url
+
+        start = time.time()
+        for _ in range(count):
+            requests.get(url, timeout=19)
+        results['new_connection'] = _rate(count, time.time() - start)
+
+        session = GitHubUserApi.session()
+        start = time.time()
+        for _ in range(count):
+            session.get(url, timeout=19)
+        results['session'] = _rate(count, time.time() - start)
+
+        api = GitHubUserApi(governor=UnlimitedGovernor(), host=fake.url)
+        start = time.time()
+        for _ in range(count):
+            api.get_user('root', etag=False)
+        results['github_user_api'] = _rate(count, time.time() - start)
+
+    return results
+
+
+SUITES = {
+    'api': api_queries,
+    'graph': graph_queries,
+    'http': http_client,
+    'hydrate': hydrate,
+    'indexes': indexes,
+    'ingest': ingest,
+}
@@ -0,0 +1,380 @@
+"""
+Crawl the follow graph breadth first with a pool of worker threads.
+
+``GitHubUser.fill_follow_graph`` makes one request at a time, so a large crawl
+spends most of its time waiting on the network. The scheduler here keeps
+several requests in flight, bounded by the number of workers, while all of the
+workers draw on one ``GitHubUserApi`` rate limit budget.
+
+The frontier is checkpointed to the database as ``CrawlNode`` rows, one per
+user reached, so an interrupted run can pick up where it stopped instead of
+spending its rate limit on users it has already crawled.
+
+Database work is serialized between the workers: a worker holds the database
+lock while it runs the model methods and gives it up whenever it waits on
+GitHub. SQLite only allows one writer at a time anyway, and this keeps the
+workers from failing with "database is locked" errors.
+
+By default every write commits on its own, which on SQLite costs a sync to
+disk each. With a single worker, ``batch_size`` makes all of the requests for a
+user first and holds on to what they returned, and then stores that many users
+at a time in one transaction. No transaction is open while the worker waits on
+GitHub, so other processes writing to the database aren't held up.
+"""
+import datetime
+import logging
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+import pytz
+import requests
+from django.conf import settings
+from django.db import connection, transaction
+
+from .github_user_api import GitHubUserApi
+from .models import PROFILE_FIELDS, CrawlNode, CrawlRun, GitHubUser, GraphVersion
+from .telemetry import stage
+from .transactions import immediate_atomic
+
+
+log = logging.getLogger(__name__)
+
+# The longest that a batch of users waits to be stored, in seconds.
+BATCH_MAX_SECONDS = 5.0
+
+
+class _UnlockedApi(object):
+    """
+    Wrap a ``GitHubUserApi`` so that ``lock`` is released for the duration of
+    each request.
+    """
+
+    def __init__(self, api, lock, telemetry=None):
+        self._api = api
+        self._lock = lock
+        self._telemetry = telemetry
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if not name.startswith('get_'):
+            return attr
+
+        def call(*args, **kwargs):
+            self._lock.release()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                with stage(self._telemetry, 'lock_wait'):
+                    self._lock.acquire()
+        return call
+
+
+def set_field(pk, field, value):
+    GitHubUser.objects.filter(pk=pk).update(**{field: value})
+
+
+def store_profile(user, api_resp):
+    """
+    Save a response of the ``/users/<login>`` endpoint to ``user``.
+    """
+    # Only save the profile, the relations may have stored their ETags meanwhile.
+    user._store_profile(api_resp, save=False)
+    if api_resp['status'] == requests.codes.ok:
+        user.save(update_fields=PROFILE_FIELDS)
+        GraphVersion.objects.bump_users()
+    elif api_resp['status'] == requests.codes.not_modified:
+        user.save(update_fields=['last_checked'])
+
+
+def neighbor_pks(user):
+    pks = list(user.followers.values_list('pk', flat=True))
+    pks.extend(user.following.values_list('pk', flat=True))
+    return pks
+
+
+class CrawlScheduler(object):
+    """
+    Fill the follow graph around ``root`` to the given depth.
+
+    Users are crawled in breadth first order. A user is only ever queued once
+    per run, so users reachable along several paths are fetched a single time.
+    Pass ``crawl_run`` to continue a run that was interrupted, and a
+    ``CrawlTelemetry`` as ``telemetry`` to instrument the crawl.
+
+    ``batch_size`` stores that many users at a time, once their requests are
+    all made, and needs a single worker: the neighbors of a batch are only
+    queued once it is stored.
+    """
+
+    def __init__(self, root, depth=3, workers=8, force=False, api=None, crawl_run=None,
+                 telemetry=None, batch_size=1):
+        if batch_size > 1 and workers > 1:
+            raise ValueError("Batching writes needs a single worker.")
+        self.root = root
+        self.depth = depth
+        self.workers = workers
+        self.batch_size = batch_size
+        self.force = force
+        self.api = api if api is not None else GitHubUserApi()
+        self.crawl_run = crawl_run
+        self.telemetry = telemetry
+        if telemetry is not None:
+            self.api.telemetry = telemetry
+
+        self.queue = queue.Queue()
+        self.seen = set()
+        self.expanded = 0
+        # How many times a user was reached again after they were scheduled.
+        self.duplicates = 0
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+
+    @classmethod
+    def resume(cls, crawl_run, workers=8, api=None, telemetry=None, batch_size=1):
+        """
+        Build a scheduler that continues the given ``CrawlRun``.
+        """
+        return cls(crawl_run.root, depth=crawl_run.depth, workers=workers,
+                   force=crawl_run.force, api=api, crawl_run=crawl_run, telemetry=telemetry,
+                   batch_size=batch_size)
+
+    def run(self):
+        """
+        Crawl until the frontier is exhausted. Return the number of users expanded.
+        """
+        if self.crawl_run is None:
+            self.crawl_run = CrawlRun.objects.create(root=self.root, depth=self.depth,
+                                                     force=self.force)
+        self._load_frontier()
+        if not self.seen:
+            self.schedule([self.root.pk], 0)
+
+        threads = [threading.Thread(target=self._work, name='crawler-%d' % i)
+                   for i in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        self.queue.join()
+        for _ in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join()
+
+        # Users that failed are left on the frontier for the next --resume.
+        if not self.crawl_run.nodes.filter(done=False).exists():
+            self.crawl_run.finished = datetime.datetime.now(tz=pytz.UTC)
+            self.crawl_run.save(update_fields=['finished'])
+        return self.expanded
+
+    def _load_frontier(self):
+        """
+        Restore the visited set and the queue from the run's checkpoint.
+        """
+        nodes = self.crawl_run.nodes.order_by('depth', 'pk')
+        for user_pk, depth, done in nodes.values_list('user_id', 'depth', 'done').iterator():
+            self.seen.add(user_pk)
+            if self.telemetry is not None:
+                self.telemetry.scheduled(depth)
+                if done:
+                    self.telemetry.finished(depth, restored=True)
+            if not done:
+                self.queue.put((user_pk, depth))
+
+    def schedule(self, pks, level):
+        """
+        Checkpoint and queue users for crawling, skipping any that are already
+        queued or done.
+        """
+        with self._lock:
+            pks = list(OrderedDict.fromkeys(pks))
+            new_pks = [pk for pk in pks if pk not in self.seen]
+            self.seen.update(new_pks)
+            self.duplicates += len(pks) - len(new_pks)
+        if not new_pks:
+            return
+
+        CrawlNode.objects.bulk_create([
+            CrawlNode(run=self.crawl_run, user_id=pk, depth=level) for pk in new_pks
+        ])
+        if self.telemetry is not None:
+            self.telemetry.scheduled(level, len(new_pks))
+        for pk in new_pks:
+            self.queue.put((pk, level))
+
+    def _work(self):
+        if self.batch_size > 1:
+            return self._work_batched()
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    self.queue.task_done()
+                    break
+                try:
+                    with stage(self.telemetry, 'lock_wait'):
+                        self._db_lock.acquire()
+                    try:
+                        with stage(self.telemetry, 'database'):
+                            self.crawl(*item)
+                    finally:
+                        self._db_lock.release()
+                except Exception:
+                    log.exception("Failed to crawl user %d" % item[0])
+                finally:
+                    self.queue.task_done()
+        finally:
+            # Each thread gets its own database connection.
+            connection.close()
+
+    def _work_batched(self):
+        """
+        Fetch users one after another and store them ``batch_size`` at a time,
+        or sooner once the queue runs dry or a batch has waited
+        ``BATCH_MAX_SECONDS``.
+        """
+        batch = []
+        started = None
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    self.queue.task_done()
+                    break
+                try:
+                    batch.append((item, self.fetch(*item)))
+                    if started is None:
+                        started = time.time()
+                except Exception:
+                    log.exception("Failed to crawl user %d" % item[0])
+                    self.queue.task_done()
+                if batch and (len(batch) >= self.batch_size or self.queue.empty() or
+                              time.time() - started >= BATCH_MAX_SECONDS):
+                    self._store_batch(batch)
+                    batch, started = [], None
+        finally:
+            connection.close()
+
+    def _store_batch(self, batch):
+        """
+        Store the users in ``batch`` in one transaction, each in a savepoint of
+        its own so that one that fails is rolled back without the rest. As with
+        the async crawler's writer, the transaction takes the write lock as it
+        begins.
+        """
+        try:
+            with stage(self.telemetry, 'database'), immediate_atomic():
+                for item, store in batch:
+                    try:
+                        with transaction.atomic():
+                            store()
+                    except Exception:
+                        log.exception("Failed to crawl user %d" % item[0])
+        except Exception:
+            # The users are left on the frontier for the next --resume.
+            log.exception("Failed to store a batch of %d users" % len(batch))
+        finally:
+            for _ in batch:
+                self.queue.task_done()
+
+    def crawl(self, pk, level):
+        """
+        Fetch a single user and queue their neighbors for the next level.
+
+        This mirrors ``fill_follow_graph``: the root is expected to be populated
+        already, and users at the last level are only populated when
+        ``POPULATE_ALL`` is set. The caller must hold the database lock, which
+        also covers checkpointing.
+        """
+        user = GitHubUser.objects.get(pk=pk)
+        user.api = _UnlockedApi(self.api, self._db_lock, self.telemetry)
+
+        if level > 0 and (level < self.depth or settings.POPULATE_ALL):
+            user.populate_from_github(force=self.force)
+
+        if level < self.depth:
+            user.populate_followers(force=self.force)
+            user.populate_following(force=self.force)
+            with self._lock:
+                self.expanded += 1
+
+            self.schedule(user.followers.values_list('pk', flat=True), level + 1)
+            self.schedule(user.following.values_list('pk', flat=True), level + 1)
+
+        self.crawl_run.nodes.filter(user_id=pk).update(done=True)
+        if self.telemetry is not None:
+            self.telemetry.finished(level)
+
+    def fetch(self, pk, level):
+        """
+        Make the requests for a single user, as ``crawl()`` does, without
+        writing anything. Return a function that stores what they returned and
+        queues the user's neighbors, which runs in a transaction later on.
+        """
+        user = GitHubUser.objects.get(pk=pk)
+        writes = []
+
+        if level > 0 and (level < self.depth or settings.POPULATE_ALL):
+            api_resp = self.api.get_user(user.login, False if self.force else user.e_tag)
+            # The counts in the profile decide which relations are fetched.
+            user._store_profile(api_resp, save=False)
+            writes.append(partial(store_profile, user, api_resp))
+
+        if level < self.depth:
+            writes.extend(self._fetch_relation(user, 'followers'))
+            writes.extend(self._fetch_relation(user, 'following'))
+
+        def store():
+            for write in writes:
+                write()
+            if level < self.depth:
+                with self._lock:
+                    self.expanded += 1
+                self.schedule(neighbor_pks(user), level + 1)
+            self.crawl_run.nodes.filter(user_id=pk).update(done=True)
+            if self.telemetry is not None:
+                self.telemetry.finished(level)
+        return store
+
+    def _fetch_relation(self, user, relation):
+        """
+        Fetch the pages of the 'followers' or 'following' list of ``user``, as
+        ``GitHubUser._populate_relation()`` does, and return the writes that
+        store them.
+        """
+        if getattr(user, 'num_' + relation) == 0 and not self.force:
+            return []
+
+        fetch = getattr(self.api, 'get_user_' + relation)
+        etag_field = relation + '_etag'
+        api_resp = fetch(user.login, False if self.force else getattr(user, etag_field))
+        writes = []
+        if api_resp['status'] == requests.codes.ok:
+            writes.append(partial(set_field, user.pk, etag_field, api_resp['etag']))
+        elif api_resp['status'] != requests.codes.not_modified:
+            return []
+
+        pages = [api_resp['json']]
+        complete = True
+        while 'next' in api_resp:
+            api_resp = fetch(user.login, None, api_resp['next'])
+            if api_resp['status'] not in (requests.codes.ok, requests.codes.not_modified):
+                complete = False
+                break
+            pages.append(api_resp['json'])
+
+        def store():
+            seen = set()
+            for data in pages:
+                seen |= user._ingest_page(data, relation)
+            if self.force and complete:
+                user._remove_stale(relation, seen)
+        writes.append(store)
+        return writes
@@ -0,0 +1,201 @@
+"""
+A local stand in for the GitHub users API, for tests and benchmarks.
+
+``FakeGitHub`` serves a follow graph from memory over real HTTP, with the
+parts of the API that the crawler relies on: paginated follower and following
+lists with ``Link`` headers, ETags and 304 responses, the ``X-RateLimit-*``
+headers and gzip. It can also add latency and fail requests with a 502.
+"""
+import gzip
+import hashlib
+import io
+import json
+import socket
+import sys
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+
+class UnlimitedGovernor(object):
+    """
+    A ``RateGovernor`` that never waits, for use against ``FakeGitHub``.
+    """
+
+    def acquire(self):
+        return None
+
+    def update(self, token, limit, remaining, reset, charged=True):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up on kept alive connections is business as usual.
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections alive between requests. Without TCP_NODELAY
+    # kept alive connections stall on delayed ACKs.
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.fake.handle(self)
+
+
+class FakeGitHub(object):
+    """
+    Serve ``followers``, a dict of login to a list of the logins following them.
+
+    Use it as a context manager, or call ``start()`` and ``stop()``. ``url`` is
+    the address to use in place of ``https://api.github.com``.
+
+    :param latency: seconds to wait before answering each request
+    :param failures: the number of requests to answer with a 502 before
+                     answering normally
+    :param first_id: the GitHub id of the first user, by login
+    """
+    RATE_LIMIT = 5000
+
+    def __init__(self, followers, latency=0, failures=0, profiles=None, first_id=1000):
+        self.followers = followers
+        self.logins = sorted(set(followers) | set(
+            login for follower_list in followers.values() for login in follower_list))
+        self.ids = dict((login, i + first_id) for i, login in enumerate(self.logins))
+        self.following = dict((login, []) for login in self.logins)
+        for login in self.logins:
+            for follower in followers.get(login, []):
+                self.following[follower].append(login)
+        self.profiles = profiles or {}
+        self.latency = latency
+        self.failures = failures
+
+        self.requests = 0
+        self.not_modified = 0
+        self.connections = set()
+        self._lock = threading.Lock()
+        self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.fake = self
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self._server.server_address[1]
+
+    def user_json(self, login):
+        data = {
+            'id': self.ids[login],
+            'login': login,
+            'followers': len(self.followers.get(login, [])),
+            'following': len(self.following[login]),
+            'followers_url': '%s/users/%s/followers' % (self.url, login),
+            'following_url': '%s/users/%s/following{/other_user}' % (self.url, login),
+            'location': None,
+            'company': None,
+        }
+        data.update(self.profiles.get(login, {}))
+        return data
+
+    def _route(self, path, query):
+        """
+        Return ``(status, data, next_url)`` for a request.
+        """
+        parts = path.strip('/').split('/')
+        if len(parts) < 2 or parts[0] != 'users' or parts[1] not in self.ids:
+            return 404, {'message': 'Not Found'}, None
+        login = parts[1]
+        if len(parts) == 2:
+            return 200, self.user_json(login), None
+
+        if len(parts) != 3 or parts[2] not in ('followers', 'following'):
+            return 404, {'message': 'Not Found'}, None
+        logins = self.followers.get(login, []) if parts[2] == 'followers' else \
+            self.following[login]
+        per_page = int(query.get('per_page', ['30'])[0])
+        page = int(query.get('page', ['1'])[0])
+        start = (page - 1) * per_page
+        data = [{'id': self.ids[other], 'login': other}
+                for other in logins[start:start + per_page]]
+        next_url = None
+        if start + per_page < len(logins):
+            next_url = '%s%s?per_page=%d&page=%d' % (self.url, path, per_page, page + 1)
+        return 200, data, next_url
+
+    def handle(self, handler):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+            self.connections.add(handler.client_address)
+            fail = self.failures > 0
+            if fail:
+                self.failures -= 1
+
+        url = urlparse(handler.path)
+        if fail:
+            status, data, next_url = 502, {'message': 'Server Error'}, None
+        else:
+            status, data, next_url = self._route(url.path, parse_qs(url.query))
+        body = json.dumps(data).encode('utf-8')
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+
+        headers = {
+            'Content-Type': 'application/json; charset=utf-8',
+            'X-RateLimit-Limit': str(self.RATE_LIMIT),
+            'X-RateLimit-Remaining': str(max(self.RATE_LIMIT - self.requests, 0)),
+            'X-RateLimit-Reset': str(int(time.time()) + 3600),
+        }
+        if status == 200:
+            headers['ETag'] = etag
+            if next_url:
+                headers['Link'] = '<%s>; rel="next"' % next_url
+            if handler.headers.get('If-None-Match') == etag:
+                with self._lock:
+                    self.not_modified += 1
+                status, body = 304, b''
+        if body and 'gzip' in handler.headers.get('Accept-Encoding', ''):
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                f.write(body)
+            body = buf.getvalue()
+            headers['Content-Encoding'] = 'gzip'
+
+        handler.send_response(status)
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
@@ -1,109 +1,326 @@
+import hashlib
 import logging
+import os
 import requests
 import signal
 import sys
+import threading
 import time
+from collections import Counter
 
 from django.conf import settings
-from django.core.cache import cache
+from django.core.cache import cache, caches
+from django.db import DatabaseError
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from .telemetry import stage
 
 
 log = logging.getLogger(__name__)
 
+response_cache = caches[settings.GITHUB_RESPONSE_CACHE]
+
+# The fields of a profile that the models read. The response cache keeps only these, and only the
+# id and login of each user on a followers or following page, which is all a 304 replays.
+CACHED_PROFILE_FIELDS = ('id', 'login', 'followers', 'followers_url', 'following',
+                         'following_url', 'location', 'company')
+
+
+class RateGovernor(object):
+    """
+    Spread requests over the rate limit window of a pool of access tokens.
+
+    Each token's budget (limit, remaining and reset time, as reported by the
+    ``X-RateLimit-*`` headers) is kept in the Django cache, so every client
+    sharing the cache draws on the same numbers. A token may make up to
+    ``burst`` requests back to back; after that its requests are spaced evenly
+    over what is left of the window, so the budget runs out at the reset rather
+    than long before it. Requests go to whichever token is free soonest.
+
+    Governors that don't share a cache, such as those of separate processes
+    with a local memory cache, can split a token between them by each taking a
+    ``share`` of its budget.
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, tokens=None, burst=None, share=1):
+        if tokens is None:
+            tokens = settings.GITHUB_ACCESS_TOKENS or [settings.GITHUB_ACCESS_TOKEN]
+        self.tokens = list(tokens)
+        self.burst = settings.GITHUB_RATE_BURST if burst is None else burst
+        self.share = share
+
+    @staticmethod
+    def _cache_key(token):
+        # Keep the tokens themselves out of the cache.
+        if token is None:
+            return 'github_rate-anonymous'
+        return 'github_rate-%s' % hashlib.sha1(token.encode('utf-8')).hexdigest()
+
+    def budget(self, token):
+        """
+        Return the cached budget of ``token``, or None if nothing is known about it.
+        """
+        return cache.get(self._cache_key(token))
+
+    def _save(self, token, budget):
+        # Once the window resets the budget is stale, so let it expire.
+        timeout = max(budget['reset'] - time.time(), 0) + 60
+        cache.set(self._cache_key(token), budget, int(timeout))
+
+    def _plan(self, token, now):
+        """
+        Work out when ``token`` can next be used.
+
+        Return ``(wait, budget)``, where ``budget`` is what to store if the
+        request is made. ``budget`` is None if nothing needs to be stored, and
+        False if the token has run out until its reset.
+        """
+        budget = self.budget(token)
+        if budget is None or budget['reset'] <= now:
+            # A new window. The response headers will tell us where we stand.
+            return 0, None
+        if budget['remaining'] <= 0:
+            return budget['reset'] - now, False
+
+        interval = (budget['reset'] - now) / (budget['remaining'] * float(self.share))
+        slot = max(budget['next_slot'], now - self.burst * interval)
+        budget = dict(budget, remaining=budget['remaining'] - 1, next_slot=slot + interval)
+        return max(slot - now, 0), budget
+
+    def acquire(self):
+        """
+        Wait for a free request and return the token to make it with.
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                plans = [self._plan(token, now) + (token,) for token in self.tokens]
+                wait, budget, token = min(plans, key=lambda plan: plan[0])
+                if budget:
+                    self._save(token, budget)
+
+            if budget is False:
+                self._wait_for_reset(wait)
+                continue
+            if wait > 0:
+                time.sleep(wait)
+            return token
+
+    def update(self, token, limit, remaining, reset, charged=True):
+        """
+        Record the budget reported by GitHub in response to a request made with ``token``.
+
+        A request that wasn't ``charged`` for, such as a 304, or one after which
+        the remaining count didn't drop, gives its slot in the schedule back.
+        """
+        with self._lock:
+            budget = self.budget(token)
+            next_slot = 0
+            if budget and budget['reset'] == reset:
+                # Keep our place in the pacing schedule while the window lasts.
+                next_slot = budget['next_slot']
+                if not charged or remaining >= budget['reported']:
+                    interval = (reset - time.time()) / (max(remaining, 1) * float(self.share))
+                    next_slot = max(next_slot - interval, 0)
+            # What GitHub reported, as opposed to what is left after our reservations.
+            self._save(token, {'limit': limit, 'remaining': remaining, 'reset': reset,
+                               'next_slot': next_slot, 'reported': remaining})
+
+    @staticmethod
+    def _wait_for_reset(sec_to_reset):
+        """
+        Block until the rate limit resets.
+        """
+        msg = "Rate limit exceeded. Waiting %d seconds for reset.\n" % sec_to_reset
+        log.warning(msg)
+        sys.stdout.writelines([msg, "Use <Ctrl> C to cancel.\n"], )
+        sys.stdout.flush()
+
+        # Signal handlers can only be swapped from the main thread.
+        in_main_thread = isinstance(threading.current_thread(), threading._MainThread)
+        if in_main_thread:
+            prev_handler = signal.signal(signal.SIGINT, signal.SIG_DFL)
+        time.sleep(sec_to_reset + 1)
+        if in_main_thread:
+            signal.signal(signal.SIGINT, prev_handler)
+
 
 class GitHubUserApi(object):
     """
     Provide a simple way to query the GitHub user endpoint and get
     follower and following information.
     """
-    HOST = 'https://api.github.com'
-    RATE_LIMIT = '/rate_limit'
+    RETRY_STATUSES = (500, 502, 503, 504)
+
+    _session = None
+    _session_pid = None
+    _session_lock = threading.Lock()
+
+    def __init__(self, governor=None, host=None):
+        # Instances share rate limit budgets through the cache, whether or not
+        # they share a governor.
+        self.governor = governor if governor is not None else RateGovernor()
+        self.host = host if host is not None else settings.GITHUB_API_URL
+        # How many responses of each status this instance got, None for failed requests.
+        self.responses = Counter()
+        self._responses_lock = threading.Lock()
+        # A CrawlTelemetry to report requests and their timings to.
+        self.telemetry = None
 
-    def __init__(self):
-        self.token = settings.GITHUB_ACCESS_TOKEN
+    @classmethod
+    def session(cls):
+        """
+        Return the HTTP session shared by every instance in this process.
 
-        self.rate_limit = cache.get('github_rate_limit')
-        self.rate_remaining = cache.get('github_rate_remaining')
-        self.rate_reset = cache.get('github_rate_reset')
+        Reusing one session keeps connections to GitHub alive between requests
+        rather than paying for a new TCP and TLS handshake each time. Server
+        errors and connection errors are retried with exponential backoff.
+        """
+        with cls._session_lock:
+            # Connections can't be shared with a forked parent.
+            if cls._session is None or cls._session_pid != os.getpid():
+                retry = Retry(total=settings.GITHUB_API_MAX_RETRIES,
+                              backoff_factor=settings.GITHUB_API_BACKOFF_FACTOR,
+                              status_forcelist=cls.RETRY_STATUSES)
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=settings.GITHUB_API_POOL_SIZE,
+                                      max_retries=retry)
+                session = requests.Session()
+                session.headers.update({'Accept-Encoding': 'gzip, deflate',
+                                        'Connection': 'keep-alive'})
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                cls._session = session
+                cls._session_pid = os.getpid()
+            return cls._session
 
-        if self.rate_limit is None:
-            headers = self._populate_headers(self.RATE_LIMIT)
-            response = self._get(self.RATE_LIMIT, headers)
-            rate_data = self._repackage_response(response)['json']['resources']['core']
+    @staticmethod
+    def _response_cache_key(url):
+        return 'github_response-%s' % hashlib.md5(url.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _cached_json(json_data):
+        """
+        Return the parts of a response body that are worth caching, see
+        ``CACHED_PROFILE_FIELDS``.
+        """
+        if isinstance(json_data, list):
+            return [{'id': user['id'], 'login': user['login']} for user in json_data]
+        return dict((field, json_data[field]) for field in CACHED_PROFILE_FIELDS
+                    if field in json_data)
 
-            self.rate_limit = rate_data['limit']
-            self.rate_remaining = rate_data['remaining']
-            self.rate_reset = rate_data['reset']
+    @classmethod
+    def _cache_response(cls, url, value):
+        """
+        Cache ``value`` as the last 200 response from ``url``. A cache that
+        can't be written to is skipped, like one that can't be read.
+        """
+        try:
+            response_cache.set(cls._response_cache_key(url), value)
+        except DatabaseError as e:
+            log.warning("Couldn't cache the response from '%s': %s" % (url, e))
 
-    def _populate_headers(self, endpoint, etag=None):
+    @classmethod
+    def cached_response(cls, url):
+        """
+        Return the last 200 response from ``url`` as a dict of its ``etag``, parsed
+        ``json`` body and ``next`` page link, or None.
+
+        A cache that can't be read is treated as empty, as Django already does
+        for writes, so that the request is made unconditionally.
+        """
+        try:
+            return response_cache.get(cls._response_cache_key(url))
+        except DatabaseError as e:
+            log.warning("Couldn't read the cached response from '%s': %s" % (url, e))
+            return None
+
+    @classmethod
+    def _populate_headers(cls, url, etag=None):
         """
         Create and return a headers dict.
 
-        Populate it with and auth token if we found one in the
-        settings.
-        Populate headers with the etag if it is available.
+        Populate headers with the etag if it is available. The auth token
+        is added per request, by ``_get()``.
         """
         headers = {}
-        if self.token is not None:
-            headers['Authorization'] = 'token %s' % self.token
-
         if etag is None:
-            etag = cache.get('e_tag-%s' % endpoint)
+            cached = cls.cached_response(url)
+            etag = cached['etag'] if cached is not None else None
         if etag is not None and etag is not False:
             headers['If-None-Match'] = '%s' % etag
 
         return headers
 
-    @staticmethod
-    def _cache_etag(response, endpoint):
-        """
-        Cache the etag for a given endpoint for use in future queries.
-        """
-        header_key = 'etag'
-        if response is not None and header_key in response.headers:
-            cache_key = 'e_tag-%s' % endpoint
-            cache.set(cache_key,
-                      response.headers[header_key].lstrip('W/'))
-
     def _get(self, endpoint, headers, absolute_url=False):
         log.debug("== Get '%s'" % endpoint)
-        if self.rate_limit is not None and self.rate_remaining == 0:
-            sec_to_reset = self.rate_reset - int(time.time())
-            msg = "Rate limit exceeded. Waiting %d seconds for reset.\n" % sec_to_reset
-            log.warning(msg)
-            sys.stdout.writelines([msg, "Use <Ctrl> C to cancel.\n"], )
-            sys.stdout.flush()
-
-            prev_handler = signal.signal(signal.SIGINT, signal.SIG_DFL)
-            time.sleep(sec_to_reset + 1)
-            signal.signal(signal.SIGINT, prev_handler)
+        with stage(self.telemetry, 'rate_limit'):
+            token = self.governor.acquire()
+        if token is not None:
+            headers = dict(headers, Authorization='token %s' % token)
 
         if absolute_url:
             url = endpoint
         else:
-            url = ''.join([self.HOST, endpoint])
+            url = ''.join([self.host, endpoint])
 
         try:
-            response = requests.get(url, headers=headers, timeout=19)
+            with stage(self.telemetry, 'network'):
+                response = self.session().get(url, headers=headers,
+                                              timeout=settings.GITHUB_API_TIMEOUT)
         except requests.exceptions.RequestException as e:
             log.exception("Exception while getting '%s': %s" % (endpoint, e))
+            self._count_response(None)
         else:
-            self.rate_limit = int(response.headers['X-RateLimit-Limit'])
-            self.rate_remaining = int(response.headers['X-RateLimit-Remaining'])
-            self.rate_reset = int(response.headers['X-RateLimit-Reset'])
-            cache.set('github_rate_limit', self.rate_limit)
-            cache.set('github_rate_remaining', self.rate_remaining)
-            cache.set('github_rate_reset', self.rate_reset)
-            log.debug("---- Remaining: %d" % self.rate_remaining)
-
+            self._record_response(token, response.status_code, response.headers,
+                                  len(response.content))
             return response
 
-    @staticmethod
-    def _repackage_response(response):
+    def _record_response(self, token, status, headers, size=0):
+        """
+        Count a response and pass its rate limit headers on to the governor.
+
+        ``size`` is the size of the decoded body, used when the headers don't
+        say how many bytes came over the wire.
+        """
+        self._count_response(status)
+        if self.telemetry is not None:
+            self.telemetry.record_response(status, int(headers.get('Content-Length', size)))
+        if 'X-RateLimit-Remaining' in headers:
+            remaining = int(headers['X-RateLimit-Remaining'])
+            self.governor.update(token,
+                                 int(headers['X-RateLimit-Limit']),
+                                 remaining,
+                                 int(headers['X-RateLimit-Reset']),
+                                 charged=status != requests.codes.not_modified)
+            log.debug("---- Remaining: %d" % remaining)
+
+    def _count_response(self, status):
+        with self._responses_lock:
+            self.responses[status] += 1
+        if status is None and self.telemetry is not None:
+            self.telemetry.record_response(None)
+
+    def quota_used(self):
+        """
+        Return how many of this instance's requests counted against the rate limit.
+        """
+        return sum(count for status, count in self.responses.items()
+                   if status not in (None, requests.codes.not_modified))
+
+    @classmethod
+    def _repackage_response(cls, response, url=None, sent_etag=None):
         """
         Repackage the response into a dictionary, so that clients
         don't need to worry about error handling and interacting with
         headers.
+
+        Successful responses from ``url`` are cached along with their ETag. A
+        304 for the ETag that was cached is filled in with what was cached of
+        the body and the ``next`` link, so clients can replay it, and keep
+        paginating, without spending any of the rate limit.
         """
         if response is not None:
             try:
@@ -118,36 +335,41 @@ class GitHubUserApi(object):
             }
             if 'next' in response.links:
                 resp_dict['next'] = response.links['next']['url']
+
+            if url is not None and response.status_code == requests.codes.ok \
+                    and resp_dict['etag']:
+                cls._cache_response(url, {
+                    'etag': resp_dict['etag'],
+                    'json': cls._cached_json(json_data),
+                    'next': resp_dict.get('next'),
+                })
+            elif url is not None and response.status_code == requests.codes.not_modified:
+                cached = cls.cached_response(url)
+                if cached is not None and cached['etag'] == sent_etag:
+                    resp_dict.update(etag=cached['etag'], json=cached['json'])
+                    if cached['next']:
+                        resp_dict['next'] = cached['next']
         else:
             resp_dict = {'status': None, 'etag': None, 'json': []}
 
         return resp_dict
 
-    def get_user(self, username, etag=None):
-        user_endpoint = '/users/%s' % username
-        headers = self._populate_headers(user_endpoint, etag)
-        response = self._get(user_endpoint, headers)
+    def _fetch(self, endpoint, etag=None, absolute_url=False):
+        url = endpoint if absolute_url else ''.join([self.host, endpoint])
+        headers = self._populate_headers(url, etag)
+        response = self._get(endpoint, headers, absolute_url)
+        with stage(self.telemetry, 'parse'):
+            return self._repackage_response(response, url, headers.get('If-None-Match'))
 
-        self._cache_etag(response, user_endpoint)
-        return self._repackage_response(response)
+    def get_user(self, username, etag=None):
+        return self._fetch('/users/%s' % username, etag)
 
     def get_user_followers(self, username, follower_etag=None, follower_url=None):
-        absolute_url = True
         if follower_url is None:
-            follower_url = '/users/%s/followers?per_page=100' % username
-            absolute_url = False
-        headers = self._populate_headers(follower_url, follower_etag)
-        response = self._get(follower_url, headers, absolute_url)
-        self._cache_etag(response, follower_url)
-        return self._repackage_response(response)
+            return self._fetch('/users/%s/followers?per_page=100' % username, follower_etag)
+        return self._fetch(follower_url, follower_etag, absolute_url=True)
 
     def get_user_following(self, username, following_etag=None, following_url=None):
-        absolute_url = True
         if following_url is None:
-            following_url = '/users/%s/following?per_page=100' % username
-            absolute_url = False
-
-        headers = self._populate_headers(following_url, following_etag)
-        response = self._get(following_url, headers, absolute_url)
-        self._cache_etag(response, following_url)
-        return self._repackage_response(response)
+            return self._fetch('/users/%s/following?per_page=100' % username, following_etag)
+        return self._fetch(following_url, following_etag, absolute_url=True)
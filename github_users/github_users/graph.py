@@ -0,0 +1,433 @@
+"""
+An in-memory copy of the follow graph for fast traversals.
+
+Walking the graph with nested ``followers__in`` sub-queries makes the database
+rebuild every lower level for each new level. Loading the edge table once into
+compact integer arrays lets us run a plain breadth-first search instead.
+
+The same arrays can be written to a snapshot file, along with each user's
+GitHub id and login, and memory mapped back by any process without going
+through the ORM. A snapshot is laid out as::
+
+    header                 magic, format version, byte order, nodes, edges, login bytes
+    pks                    int32 * nodes, ascending
+    github_ids             int32 * nodes
+    follower_offsets       int32 * (nodes + 1)
+    followers              int32 * edges
+    following_offsets      int32 * (nodes + 1)
+    following              int32 * edges
+    login_offsets          int32 * (nodes + 1)
+    logins                 utf-8, concatenated
+
+The arrays are in the byte order of the machine that wrote them.
+"""
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from collections import deque
+
+from django.db import connection
+from django.db.models import IntegerField
+from django.db.models.expressions import RawSQL
+
+SNAPSHOT_MAGIC = b'GHFG'
+SNAPSHOT_VERSION = 1
+_HEADER = struct.Struct('=4sHBxIII')
+_INT32 = struct.Struct('=i')
+
+
+def _csr(num_nodes, sources, targets):
+    """
+    Build CSR (compressed sparse row) arrays from parallel arrays of dense
+    node indexes.
+
+    Return ``(offsets, neighbors)`` where the neighbors of node ``i`` are
+    ``neighbors[offsets[i]:offsets[i + 1]]``, sorted ascending.
+    """
+    offsets = array('i', [0]) * (num_nodes + 1)
+    for source in sources:
+        offsets[source + 1] += 1
+    for i in range(num_nodes):
+        offsets[i + 1] += offsets[i]
+
+    position = array('i', offsets[:-1])
+    neighbors = array('i', [0]) * len(sources)
+    for source, target in zip(sources, targets):
+        neighbors[position[source]] = target
+        position[source] += 1
+
+    for i in range(num_nodes):
+        start, end = offsets[i], offsets[i + 1]
+        if end - start > 1:
+            neighbors[start:end] = array('i', sorted(neighbors[start:end]))
+
+    return offsets, neighbors
+
+
+class _Int32View(object):
+    """
+    Read only int32 sequence over a buffer, for Pythons without ``memoryview.cast``.
+    """
+
+    def __init__(self, buf, offset, length):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.length:
+            raise IndexError(i)
+        return _INT32.unpack_from(self.buf, self.offset + i * 4)[0]
+
+    def __iter__(self):
+        for i in range(self.length):
+            yield self[i]
+
+
+def _int32s(buf, offset, length):
+    """
+    Return ``length`` int32s starting at ``offset`` in ``buf``, without copying.
+    """
+    if hasattr(memoryview, 'cast'):
+        return memoryview(buf)[offset:offset + length * 4].cast('i')
+    return _Int32View(buf, offset, length)
+
+
+class FollowGraph(object):
+    """
+    Hold the follow edges of ``GitHubUser`` in CSR arrays.
+
+    Nodes are addressed internally by a dense index into ``pks``, which is
+    sorted. Every public method takes and returns ``GitHubUser`` primary keys.
+
+    Graphs opened from a snapshot also know each user's GitHub id and login.
+    """
+
+    def __init__(self, pks, follower_offsets, followers, following_offsets, following,
+                 github_ids=None, login_offsets=None, logins=None):
+        self.pks = pks
+        self.follower_offsets = follower_offsets
+        self.followers = followers
+        self.following_offsets = following_offsets
+        self.following = following
+        self.github_ids = github_ids
+        self.login_offsets = login_offsets
+        self.logins = logins
+
+    def __len__(self):
+        return len(self.pks)
+
+    def _index(self, pk):
+        """
+        Return the dense index of ``pk``, or ``None`` if it isn't in the graph.
+        """
+        i = bisect_left(self.pks, pk)
+        if i < len(self.pks) and self.pks[i] == pk:
+            return i
+        return None
+
+    @classmethod
+    def from_edges(cls, edges, pks=()):
+        """
+        Build a graph from an iterable of ``(user_pk, follower_pk)`` pairs.
+
+        Users in ``pks`` are included even if they have no edges.
+        """
+        users = array('i')
+        followers = array('i')
+        for user_pk, follower_pk in edges:
+            users.append(user_pk)
+            followers.append(follower_pk)
+
+        pks = array('i', sorted(set(users) | set(followers) | set(pks)))
+        index = dict((pk, i) for i, pk in enumerate(pks))
+        users = array('i', (index[pk] for pk in users))
+        followers = array('i', (index[pk] for pk in followers))
+
+        follower_offsets, follower_targets = _csr(len(pks), users, followers)
+        following_offsets, following_targets = _csr(len(pks), followers, users)
+        return cls(pks, follower_offsets, follower_targets, following_offsets,
+                   following_targets)
+
+    @classmethod
+    def load(cls, all_users=False):
+        """
+        Read the whole follower edge table from the database.
+
+        With ``all_users`` the graph also includes users without any edges.
+        """
+        from .models import GitHubUser
+
+        edges = GitHubUser.followers.through.objects.values_list('from_githubuser_id',
+                                                                 'to_githubuser_id')
+        pks = GitHubUser.objects.values_list('pk', flat=True).iterator() if all_users else ()
+        return cls.from_edges(edges.iterator(), pks)
+
+    @classmethod
+    def open(cls, path):
+        """
+        Memory map a snapshot written by ``write_snapshot()``.
+
+        Nothing is copied: lookups read straight from the mapped file, which
+        the operating system shares between every process that opens it.
+        """
+        with open(path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, little_endian, nodes, edges, login_bytes = _HEADER.unpack_from(buf)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError("%s is not a version %d graph snapshot." % (path, SNAPSHOT_VERSION))
+        if bool(little_endian) != (sys.byteorder == 'little'):
+            raise ValueError("%s was written on a machine with a different byte order." % path)
+
+        offset = _HEADER.size
+        arrays = []
+        for length in (nodes, nodes, nodes + 1, edges, nodes + 1, edges, nodes + 1):
+            arrays.append(_int32s(buf, offset, length))
+            offset += length * 4
+        pks, github_ids, follower_offsets, followers, following_offsets, following, \
+            login_offsets = arrays
+        if hasattr(memoryview, 'cast'):
+            logins = memoryview(buf)[offset:offset + login_bytes]
+        else:  # Python 2
+            logins = buffer(buf, offset, login_bytes)
+        return cls(pks, follower_offsets, followers, following_offsets, following,
+                   github_ids=github_ids, login_offsets=login_offsets, logins=logins)
+
+    def write_snapshot(self, path, users):
+        """
+        Write the graph to ``path`` along with ``users``, an iterable of
+        ``(pk, github_id, login)`` for every node, in any order.
+
+        The file is written next to ``path`` and then renamed into place, so
+        readers never see a partial snapshot.
+        """
+        github_ids = array('i', [0]) * len(self)
+        login_list = [b''] * len(self)
+        for pk, github_id, login in users:
+            i = self._index(pk)
+            if i is not None:
+                github_ids[i] = github_id
+                login_list[i] = login.encode('utf-8')
+
+        login_offsets = array('i', [0])
+        for login in login_list:
+            login_offsets.append(login_offsets[-1] + len(login))
+        logins = b''.join(login_list)
+
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, sys.byteorder == 'little',
+                                 len(self), len(self.followers), len(logins)))
+            for values in (self.pks, github_ids, self.follower_offsets, self.followers,
+                           self.following_offsets, self.following, login_offsets):
+                array('i', values).tofile(f)
+            f.write(logins)
+        os.rename(tmp_path, path)
+
+    def login(self, pk):
+        """
+        Return the login of ``pk``, from a snapshot.
+        """
+        i = self._index(pk)
+        if i is None or self.logins is None:
+            return None
+        return bytes(self.logins[self.login_offsets[i]:self.login_offsets[i + 1]]).decode('utf-8')
+
+    def github_id(self, pk):
+        """
+        Return the GitHub id of ``pk``, from a snapshot.
+        """
+        i = self._index(pk)
+        if i is None or self.github_ids is None:
+            return None
+        return self.github_ids[i]
+
+    def degree(self, pk):
+        """
+        Return ``(followers, following)``, the number of each for ``pk``.
+        """
+        i = self._index(pk)
+        if i is None:
+            return 0, 0
+        return (self.follower_offsets[i + 1] - self.follower_offsets[i],
+                self.following_offsets[i + 1] - self.following_offsets[i])
+
+    def _neighbors(self, i):
+        for j in range(self.follower_offsets[i], self.follower_offsets[i + 1]):
+            yield self.followers[j]
+        for j in range(self.following_offsets[i], self.following_offsets[i + 1]):
+            yield self.following[j]
+
+    def neighbors(self, pk):
+        """
+        Return the set of pks that follow, or are followed by, the given user.
+        """
+        i = self._index(pk)
+        if i is None:
+            return set()
+        return set(self.pks[j] for j in self._neighbors(i))
+
+    def layers(self, root_pk, max_distance):
+        """
+        Breadth-first search out from ``root_pk`` along follower and following edges.
+
+        Return a list of lists of pks, where ``layers[d - 1]`` holds the users whose
+        shortest distance from the root is ``d``. Each user is visited once, so cycles
+        are cut, and the root itself is never part of the result.
+        """
+        root = self._index(root_pk)
+        if root is None or max_distance <= 0:
+            return []
+
+        visited = set([root])
+        layers = []
+        frontier = deque([root])
+        for _ in range(max_distance):
+            next_frontier = deque()
+            for i in frontier:
+                for j in self._neighbors(i):
+                    if j not in visited:
+                        visited.add(j)
+                        next_frontier.append(j)
+            if not next_frontier:
+                break
+            layers.append([self.pks[i] for i in next_frontier])
+            frontier = next_frontier
+        return layers
+
+    def within(self, root_pk, max_distance):
+        """
+        Return the set of pks within ``max_distance`` of ``root_pk``, not including
+        the root.
+        """
+        return set(pk for layer in self.layers(root_pk, max_distance) for pk in layer)
+
+    def shortest_path(self, source_pk, target_pk, max_distance=None):
+        """
+        Return one shortest path from ``source_pk`` to ``target_pk`` along follower
+        and following edges, as a list of pks that starts with the source and ends
+        with the target. Return ``None`` when there is no path of at most
+        ``max_distance`` edges.
+
+        The search runs breadth first from both ends at once. Each step expands
+        a whole level of whichever side has the smaller frontier, so between two
+        well connected users it visits a small fraction of what a one sided search
+        would.
+        """
+        source = self._index(source_pk)
+        target = self._index(target_pk)
+        if source is None or target is None:
+            return None
+        if source == target:
+            return [source_pk]
+
+        # Map each visited node to the node it was reached from, for both sides.
+        parents = ({source: None}, {target: None})
+        frontiers = ([source], [target])
+        distance = 0
+        while frontiers[0] and frontiers[1]:
+            if max_distance is not None and distance >= max_distance:
+                return None
+            distance += 1
+            side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+            visited, other_visited = parents[side], parents[1 - side]
+
+            next_frontier = []
+            for i in frontiers[side]:
+                for j in self._neighbors(i):
+                    if j in visited:
+                        continue
+                    visited[j] = i
+                    if j in other_visited:
+                        return self._join_path(parents, j)
+                    next_frontier.append(j)
+            frontiers[side][:] = next_frontier
+        return None
+
+    def _join_path(self, parents, meeting):
+        path = []
+        node = meeting
+        while node is not None:
+            path.append(node)
+            node = parents[0][node]
+        path.reverse()
+        node = parents[1][meeting]
+        while node is not None:
+            path.append(node)
+            node = parents[1][node]
+        return [self.pks[i] for i in path]
+
+    def reachable_by_walk(self, root_pk, length):
+        """
+        Return the set of pks at the end of some walk of exactly ``length`` edges
+        from ``root_pk``.
+
+        Unlike ``layers()`` a walk may double back, so the root and users closer
+        than ``length`` can be part of the result. Each level is a set, so every
+        user is expanded at most once per level.
+        """
+        root = self._index(root_pk)
+        if root is None or length <= 0:
+            return set()
+
+        frontier = set([root])
+        for _ in range(length):
+            next_frontier = set()
+            for i in frontier:
+                next_frontier.update(self._neighbors(i))
+            frontier = next_frontier
+        return set(self.pks[i] for i in frontier)
+
+
+def filter_pks(queryset, pks, field='pk'):
+    """
+    Restrict ``queryset`` to rows whose ``field`` is one of the given primary keys.
+
+    Large pk lists are inlined as integer literals rather than bound as
+    parameters, which would run into the backend's parameter limit (999 on
+    older SQLite builds) well before the size of a depth 3 neighborhood.
+    """
+    pks = [int(pk) for pk in pks]
+    if not pks:
+        return queryset.none()
+
+    qn = connection.ops.quote_name
+    opts = queryset.model._meta
+    field = opts.pk if field == 'pk' else opts.get_field(field)
+    column = '%s.%s' % (qn(opts.db_table), qn(field.column))
+    return queryset.extra(where=['%s IN (%s)' % (column, ','.join(str(pk) for pk in pks))])
+
+
+class _LiteralSQL(RawSQL):
+    """
+    ``RawSQL`` without parameters. Django 1.8 hands out ``RawSQL``'s own params
+    list, which lookups on the expression then extend in place.
+    """
+
+    def __init__(self, sql, output_field):
+        super(_LiteralSQL, self).__init__(sql, [], output_field=output_field)
+
+    def as_sql(self, compiler, connection):
+        return '(%s)' % self.sql, []
+
+
+def layer_case(model, layers):
+    """
+    Return an expression for ``annotate()`` that gives the key of ``layers``, a
+    dict of lists of primary keys, that each row's primary key is in.
+
+    As in ``filter_pks()`` the primary keys are inlined as integer literals.
+    """
+    qn = connection.ops.quote_name
+    opts = model._meta
+    column = '%s.%s' % (qn(opts.db_table), qn(opts.pk.column))
+    whens = ['WHEN %s IN (%s) THEN %d' % (column, ','.join(str(int(pk)) for pk in pks), key)
+             for key, pks in sorted(layers.items()) if pks]
+    return _LiteralSQL('CASE %s END' % ' '.join(whens), output_field=IntegerField())
@@ -0,0 +1,125 @@
+"""
+A process wide copy of the follow graph.
+
+Loading the edge table through the ORM takes seconds on a large graph, which is
+too slow to repeat for every distance query. ``follow_graph()`` keeps one
+``FollowGraph`` per process and checks it against the ``GraphVersion`` stamp,
+at the cost of one small query. Adding or removing edges, whether by the
+crawler or through ``followers.add()`` and friends, changes the stamp, and the
+graph is loaded again.
+
+A crawl changes the stamp with every page it stores. Callers that can live with
+an answer that lags the edges, such as the API's distance queries, pass
+``stale_ok`` to be served the graph as it is for ``GRAPH_RELOAD_INTERVAL``
+seconds after the stamp was last checked, rather than reloading it for every
+page. The graph's ``stamp`` says which version of the edges it holds.
+
+When ``GRAPH_SNAPSHOT_DIR`` is set, the first process to load a version of the
+graph writes it there as a snapshot named after the stamp. Every process then
+memory maps that file, so several API workers share a single copy of the graph
+in memory instead of holding one each.
+"""
+import errno
+import glob
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from .graph import FollowGraph
+
+SNAPSHOT_NAME = 'follow-graph-%s.snapshot'
+
+# Snapshots are kept for at least this many seconds after they are replaced, for the
+# processes that are about to open them.
+SNAPSHOT_GRACE_SECONDS = 60
+
+
+class _GraphCache(object):
+    def __init__(self):
+        self.graph = None
+        self.stamp = None
+        self.checked = None
+        self.lock = threading.Lock()
+
+    def get(self, stale_ok=False):
+        from .models import GraphVersion
+
+        with self.lock:
+            if (stale_ok and self.graph is not None and
+                    time.time() - self.checked < settings.GRAPH_RELOAD_INTERVAL):
+                return self.graph
+            stamp = GraphVersion.objects.current()
+            if self.graph is None or self.stamp != stamp:
+                self.graph = self.load(stamp)
+                self.graph.stamp = self.stamp = stamp
+            self.checked = time.time()
+            return self.graph
+
+    def clear(self):
+        with self.lock:
+            self.graph = self.stamp = self.checked = None
+
+    @staticmethod
+    def load(stamp):
+        directory = settings.GRAPH_SNAPSHOT_DIR
+        if not directory:
+            return FollowGraph.load()
+
+        path = os.path.join(directory, SNAPSHOT_NAME % stamp)
+        # Open rather than check that it exists first, since it could be deleted in between.
+        try:
+            return FollowGraph.open(path)
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        from .models import GitHubUser
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        graph = FollowGraph.load(all_users=True)
+        graph.write_snapshot(path, GitHubUser.objects.values_list(
+            'pk', 'github_id', 'login').iterator())
+        _remove_older_snapshots(directory, path)
+        return FollowGraph.open(path)
+
+
+def _remove_older_snapshots(directory, path):
+    """
+    Delete the snapshots in ``directory`` written before ``path``, once they
+    are ``SNAPSHOT_GRACE_SECONDS`` old.
+
+    Processes that have one of them mapped keep reading it until they reload.
+    """
+    written = os.path.getmtime(path)
+    expired = time.time() - SNAPSHOT_GRACE_SECONDS
+    for old_path in glob.glob(os.path.join(directory, SNAPSHOT_NAME % '*')):
+        try:
+            modified = os.path.getmtime(old_path)
+            if old_path != path and modified < written and modified < expired:
+                os.remove(old_path)
+        except OSError:
+            pass
+
+
+_cache = _GraphCache()
+
+
+def follow_graph(stale_ok=False):
+    """
+    Return this process's copy of the follow graph, loading it first if the edges
+    changed since it was last loaded.
+
+    :param stale_ok: only check for changes once every ``GRAPH_RELOAD_INTERVAL``
+                     seconds
+    """
+    return _cache.get(stale_ok)
+
+
+def clear_follow_graph():
+    """
+    Drop this process's copy of the follow graph.
+    """
+    _cache.clear()
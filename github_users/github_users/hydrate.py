@@ -0,0 +1,185 @@
+"""
+Fill in the profiles of users that were only ever seen in someone's list.
+
+The crawlers store the users on a followers or following page with just their
+id and login. With ``POPULATE_ALL`` set they then fetch the profile of every
+user at the edge of the graph too, one request and one save at a time, which
+is most of the time a deep crawl takes. Leaving ``POPULATE_ALL`` off and
+running the ``Hydrator`` afterwards gets the same profiles in bulk: several
+requests are kept in flight by a pool of threads, while the main thread writes
+the profiles back a batch at a time, one transaction per batch.
+
+A user needs hydrating when they have no follower count, or when they have
+neither a location nor a company and have never been fetched (plenty of
+profiles have neither). Users whose profile came back 404, because the
+account was deleted or renamed, are marked ``missing`` and left alone.
+"""
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+import requests
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
+
+from .github_user_api import GitHubUserApi
+from .models import PROFILE_FIELDS, GitHubUser, GraphVersion
+from .telemetry import stage
+
+
+log = logging.getLogger(__name__)
+
+
+def pending_users(users=None):
+    """
+    Return a queryset of the users, of all of them or of those in ``users``,
+    whose profiles haven't been filled in.
+    """
+    users = users if users is not None else GitHubUser.objects.all()
+    return users.filter(
+        Q(num_followers__isnull=True) |
+        Q(location__isnull=True, company__isnull=True, e_tag__isnull=True)).exclude(missing=True)
+
+
+class Hydrator(object):
+    """
+    Fetch the profiles of the pending users, ``concurrency`` at a time, and
+    store them ``batch_size`` to a transaction.
+
+    :param limit: stop after this many users
+    :param users: only hydrate the pending users in this queryset
+    """
+
+    def __init__(self, batch_size=100, concurrency=8, limit=None, users=None, api=None,
+                 telemetry=None):
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.limit = limit
+        self.users = users
+        self.api = api if api is not None else GitHubUserApi()
+        self.telemetry = telemetry
+        if telemetry is not None:
+            self.api.telemetry = telemetry
+        self.stats = {'hydrated': 0, 'not_modified': 0, 'missing': 0, 'failed': 0, 'batches': 0}
+
+        self._requests = queue.Queue()
+        self._responses = queue.Queue()
+
+    def run(self):
+        """
+        Hydrate until no pending users are left, or ``limit`` is reached. Return
+        the stats.
+        """
+        threads = [threading.Thread(target=self._fetch, name='hydrator-%d' % i)
+                   for i in range(self.concurrency)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            in_flight = 0
+            batch = []
+            for user in self._users():
+                self._requests.put(user)
+                in_flight += 1
+                # Keep every thread busy without reading too far ahead.
+                while in_flight >= 2 * self.concurrency:
+                    batch.append(self._responses.get())
+                    in_flight -= 1
+                    if len(batch) >= self.batch_size:
+                        self.write(batch)
+                        batch = []
+            for _ in range(in_flight):
+                batch.append(self._responses.get())
+                if len(batch) >= self.batch_size:
+                    self.write(batch)
+                    batch = []
+            if batch:
+                self.write(batch)
+        finally:
+            for _ in threads:
+                self._requests.put(None)
+            for thread in threads:
+                thread.join()
+        return self.stats
+
+    def _users(self):
+        """
+        Yield the pending users in order of pk, reading a batch at a time.
+        """
+        last_pk = 0
+        remaining = self.limit
+        while remaining is None or remaining > 0:
+            size = self.batch_size if remaining is None else min(self.batch_size, remaining)
+            users = list(pending_users(self.users).filter(pk__gt=last_pk).order_by('pk')[:size])
+            if not users:
+                return
+            for user in users:
+                yield user
+            last_pk = users[-1].pk
+            if remaining is not None:
+                remaining -= len(users)
+
+    def _fetch(self):
+        try:
+            while True:
+                user = self._requests.get()
+                if user is None:
+                    break
+                try:
+                    api_resp = self.api.get_user(user.login, user.e_tag)
+                except Exception:
+                    log.exception("Failed to fetch user %s" % user.login)
+                    api_resp = None
+                self._responses.put((user, api_resp))
+        finally:
+            # Each thread gets its own database connection, for the response cache.
+            connection.close()
+
+    def write(self, batch):
+        """
+        Store a batch of ``(user, api_resp)`` pairs in one transaction.
+
+        Each user is saved in a savepoint of their own, so that one who can't
+        be, such as a renamed user whose new login is still taken by a stale
+        row, is counted as failed without rolling back the rest of the batch.
+        """
+        hydrated = False
+        with stage(self.telemetry, 'database'), transaction.atomic():
+            for user, api_resp in batch:
+                if api_resp is None:
+                    self.stats['failed'] += 1
+                    continue
+                try:
+                    with transaction.atomic():
+                        outcome = self._store(user, api_resp)
+                except IntegrityError:
+                    log.exception("Failed to store user %s" % user.login)
+                    outcome = 'failed'
+                self.stats[outcome] += 1
+                hydrated = hydrated or outcome == 'hydrated'
+            if hydrated:
+                GraphVersion.objects.bump_users()
+        self.stats['batches'] += 1
+
+    @staticmethod
+    def _store(user, api_resp):
+        """
+        Save what ``api_resp`` says about ``user``, and return which stat it counts towards.
+        """
+        user._store_profile(api_resp, save=False)
+        if api_resp['status'] == requests.codes.ok:
+            user.save(update_fields=PROFILE_FIELDS)
+            return 'hydrated'
+        elif api_resp['status'] == requests.codes.not_modified:
+            user.save(update_fields=['last_checked'])
+            return 'not_modified'
+        elif api_resp['status'] == requests.codes.not_found:
+            user.missing = True
+            user.save(update_fields=['missing'])
+            return 'missing'
+        return 'failed'
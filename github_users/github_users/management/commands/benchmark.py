@@ -0,0 +1,76 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.runner import DiscoverRunner
+from ...benchmarks import SUITES
+
+
+class Command(BaseCommand):
+    help = "Run performance benchmarks and write the results as JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument('suites', nargs='*', default=sorted(SUITES), metavar='suite',
+                            help="Which suites to run: %s. Default: all of them." %
+                                 ', '.join(sorted(SUITES)))
+        parser.add_argument('--output', type=str,
+                            help="Write the results to this file instead of stdout.")
+        parser.add_argument('--requests', default=200, type=int,
+                            help="How many HTTP requests to time.")
+        parser.add_argument('--latency', default=0.0, type=float,
+                            help="Seconds the fake GitHub server waits before each response.")
+        parser.add_argument('--users', default=10000, type=int,
+                            help="How many users to generate for the graph and api suites.")
+        parser.add_argument('--follows', default=5, type=int,
+                            help="How many users each generated user follows.")
+        parser.add_argument('--seed', default=0, type=int,
+                            help="Seed for the generated graph.")
+        parser.add_argument('--distance', default=3, type=int,
+                            help="The largest distance to query.")
+        parser.add_argument('--followers', default=1000, type=int,
+                            help="How many followers to ingest in the ingest suite, and profiles "
+                                 "to fetch in the hydrate suite.")
+        parser.add_argument('--repeat', default=3, type=int,
+                            help="Run each query this many times and report the best.")
+        parser.add_argument('--on-disk', action='store_true', default=False,
+                            help="Run against a throwaway SQLite file rather than in memory, "
+                                 "so that commits cost what they do on disk.")
+
+    def handle(self, *args, **options):
+        unknown = set(options['suites']) - set(SUITES)
+        if unknown:
+            raise CommandError("Unknown suite(s): %s" % ', '.join(sorted(unknown)))
+
+        # Per request debug logging would dominate the timings.
+        logging.getLogger('github_users').setLevel(logging.WARNING)
+
+        # Run against a throwaway database rather than the crawled data, and
+        # with DEBUG off so that queries aren't logged.
+        directory = None
+        if options['on_disk']:
+            if connection.vendor != 'sqlite':
+                raise CommandError("--on-disk is only for SQLite.")
+            directory = tempfile.mkdtemp()
+            connection.settings_dict['TEST']['NAME'] = os.path.join(directory, 'benchmark.db')
+
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        runner.setup_test_environment()
+        old_config = runner.setup_databases()
+        try:
+            results = dict((name, SUITES[name](options)) for name in options['suites'])
+        finally:
+            runner.teardown_databases(old_config)
+            runner.teardown_test_environment()
+            if directory is not None:
+                shutil.rmtree(directory)
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
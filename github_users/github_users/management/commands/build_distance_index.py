@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from ...models import DistanceIndex, GitHubUser
+
+
+class Command(BaseCommand):
+    help = ("Precompute the distance from a user to everybody within a given distance, "
+            "to speed up 'within' queries on that user.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('login', type=str)
+        parser.add_argument('max_distance', nargs='?', default=3, type=int)
+        parser.add_argument('--drop', action='store_true', default=False,
+                            help="Remove the user's index instead of building it.")
+
+    def handle(self, *args, **options):
+        try:
+            root = GitHubUser.objects.get(login=options['login'])
+        except GitHubUser.DoesNotExist:
+            raise CommandError("There is no user '%s'." % options['login'])
+
+        if options['drop']:
+            DistanceIndex.objects.filter(root=root).delete()
+            return
+
+        if options['max_distance'] < 1:
+            raise CommandError("max_distance must be at least 1.")
+
+        index, created = DistanceIndex.objects.update_or_create(
+            root=root, defaults={'max_distance': options['max_distance']})
+        index.rebuild()
+        self.stdout.write("Indexed %d users within %d of %s." % (
+            index.entries.count(), index.max_distance, root))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from ...graph import FollowGraph
+from ...models import GitHubUser
+
+
+class Command(BaseCommand):
+    help = "Export the follow graph to a snapshot file that FollowGraph.open() can memory map."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', type=str)
+
+    def handle(self, *args, **options):
+        graph = FollowGraph.load(all_users=True)
+        users = GitHubUser.objects.values_list('pk', 'github_id', 'login')
+        graph.write_snapshot(options['path'], users.iterator())
+        self.stdout.write("Wrote %d users and %d follow edges to %s." % (
+            len(graph), len(graph.followers), options['path']))
@@ -1,19 +1,102 @@
+import sys
+
 from django.core.management.base import BaseCommand, CommandError
-from ...models import GitHubUser
+from ...crawler import CrawlScheduler
+from ...models import CrawlRun, GitHubUser
+from ...sharded_crawler import ShardedCrawl
+from ...telemetry import CrawlTelemetry, ProgressReporter
 
 
 class Command(BaseCommand):
     help = "Import a user and their followers to a given depth from GitHub."
 
     def add_arguments(self, parser):
-        parser.add_argument('login', type=str)
+        parser.add_argument('login', nargs='?', type=str)
         parser.add_argument('depth', nargs='?', default=3, type=int)
+        parser.add_argument('--workers', default=1, type=int,
+                            help="Crawl breadth first with this many concurrent workers.")
+        parser.add_argument('--resume', action='store_true', default=False,
+                            help="Continue the last unfinished crawl (of 'login', if given).")
+        parser.add_argument('--async', action='store_true', default=False, dest='use_async',
+                            help="Crawl on an asyncio event loop, with --workers users in "
+                                 "flight at a time. Needs Python 3.5 or later.")
+        parser.add_argument('--shards', type=int,
+                            help="Crawl with this many worker processes, each with an access "
+                                 "token of its own where there are enough to go round.")
+        parser.add_argument('--batch-size', type=int,
+                            help="Commit the writes of this many users at a time. Needs "
+                                 "--async, or a single worker.")
+        parser.add_argument('--progress', action='store_true', default=False,
+                            help="Show a live progress line on stderr.")
+        parser.add_argument('--metrics', metavar='PATH',
+                            help="Write the crawl's metrics to this file when it ends.")
+        parser.add_argument('--metrics-format', choices=['json', 'prometheus'], default='json',
+                            help="Write --metrics as JSON, the default, or in the Prometheus "
+                                 "text format.")
 
     def handle(self, *args, **options):
-        users = GitHubUser.objects.filter(login=options['login'])
-        if users.exists():
-            user = users.get()
+        if options['workers'] < 1:
+            raise CommandError("--workers must be at least 1.")
+        if options['shards'] is not None:
+            if options['shards'] < 1:
+                raise CommandError("--shards must be at least 1.")
+            if options['use_async'] or options['workers'] > 1:
+                raise CommandError("--shards can't be combined with --async or --workers.")
+            if options['batch_size'] is not None:
+                raise CommandError("--batch-size isn't available with --shards.")
+            crawler_class = ShardedCrawl
+            crawler_kwargs = {'shards': options['shards']}
+        elif options['use_async']:
+            if sys.version_info < (3, 5):
+                raise CommandError("--async needs Python 3.5 or later.")
+            # The async crawler is Python 3 only syntax, so it's only imported here.
+            from ...async_crawler import AsyncCrawler
+            crawler_class = AsyncCrawler
+            crawler_kwargs = {'concurrency': options['workers']}
         else:
-            user = GitHubUser(login=options['login']).populate_from_github()
+            if options['batch_size'] is not None and options['workers'] > 1:
+                raise CommandError("--batch-size needs --async, or a single worker.")
+            crawler_class = CrawlScheduler
+            crawler_kwargs = {'workers': options['workers']}
+        if options['batch_size'] is not None:
+            if options['batch_size'] < 1:
+                raise CommandError("--batch-size must be at least 1.")
+            crawler_kwargs['batch_size'] = options['batch_size']
+
+        telemetry = None
+        if options['progress'] or options['metrics']:
+            if options['shards'] is not None:
+                raise CommandError("--progress and --metrics aren't available with --shards.")
+            telemetry = crawler_kwargs['telemetry'] = CrawlTelemetry()
+
+        if options['resume']:
+            runs = CrawlRun.objects.filter(finished__isnull=True)
+            if options['login']:
+                runs = runs.filter(root__login=options['login'])
+            crawl_run = runs.order_by('-started').first()
+            if crawl_run is None:
+                raise CommandError("There is no unfinished crawl to resume.")
+            self.stdout.write("Resuming the crawl of %s started %s." % (crawl_run.root,
+                                                                        crawl_run.started))
+            scheduler = crawler_class.resume(crawl_run, **crawler_kwargs)
+        else:
+            if not options['login']:
+                raise CommandError("A login is required unless --resume is given.")
+
+            users = GitHubUser.objects.filter(login=options['login'])
+            if users.exists():
+                user = users.get()
+            else:
+                user = GitHubUser(login=options['login']).populate_from_github()
+            scheduler = crawler_class(user, depth=options['depth'], **crawler_kwargs)
 
-        user.fill_follow_graph(depth=options['depth'])
+        reporter = ProgressReporter(telemetry).start() if options['progress'] else None
+        try:
+            expanded = scheduler.run()
+        finally:
+            if reporter is not None:
+                reporter.stop()
+            if options['metrics']:
+                telemetry.write(options['metrics'], options['metrics_format'])
+        self.stdout.write("Expanded %d users, and skipped %d repeat visits to users already "
+                          "reached." % (expanded, scheduler.duplicates))
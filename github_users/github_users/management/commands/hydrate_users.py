@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from ...hydrate import Hydrator, pending_users
+from ...telemetry import CrawlTelemetry, ProgressReporter
+
+
+class Command(BaseCommand):
+    help = "Fetch the profiles of stored users that were never filled in, in bulk."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', default=100, type=int,
+                            help="Store this many profiles to a transaction.")
+        parser.add_argument('--concurrency', default=8, type=int,
+                            help="Keep this many requests to GitHub in flight.")
+        parser.add_argument('--limit', default=None, type=int,
+                            help="Stop after this many users.")
+        parser.add_argument('--progress', action='store_true', default=False,
+                            help="Show a live progress line on stderr.")
+
+    def handle(self, *args, **options):
+        for option in ('batch_size', 'concurrency'):
+            if options[option] < 1:
+                raise CommandError("--%s must be at least 1." % option.replace('_', '-'))
+
+        telemetry = CrawlTelemetry() if options['progress'] else None
+        hydrator = Hydrator(batch_size=options['batch_size'],
+                            concurrency=options['concurrency'], limit=options['limit'],
+                            telemetry=telemetry)
+        if telemetry is not None:
+            with ProgressReporter(telemetry):
+                stats = hydrator.run()
+        else:
+            stats = hydrator.run()
+
+        stats['remaining'] = pending_users().count()
+        self.stdout.write("Hydrated %(hydrated)d users in %(batches)d batches, %(not_modified)d "
+                          "were unchanged, %(missing)d are gone from GitHub and %(failed)d "
+                          "failed. %(remaining)d left to hydrate." % stats)
@@ -0,0 +1,28 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from ...refresh import RefreshScheduler
+
+
+class Command(BaseCommand):
+    help = "Refresh stored users from GitHub, the most out of date first."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age-hours', default=24, type=float,
+                            help="Only refresh users last checked at least this long ago.")
+        parser.add_argument('--budget', default=None, type=int,
+                            help="Stop after this many requests count against the rate limit.")
+        parser.add_argument('--limit', default=None, type=int,
+                            help="Only consider this many of the least recently checked users.")
+
+    def handle(self, *args, **options):
+        if options['budget'] is not None and options['budget'] < 1:
+            raise CommandError("--budget must be at least 1.")
+
+        scheduler = RefreshScheduler(min_age=datetime.timedelta(hours=options['min_age_hours']),
+                                     budget=options['budget'], limit=options['limit'])
+        stats = scheduler.run()
+        self.stdout.write("Refreshed %(profiles)d profiles, %(followers)d follower lists and "
+                          "%(following)d following lists with %(requests)d requests, "
+                          "%(quota_used)d of them counted against the rate limit. "
+                          "%(missing)d users are gone from GitHub. %(remaining)d left to refresh." % stats)
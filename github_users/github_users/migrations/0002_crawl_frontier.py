@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('github_users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CrawlNode',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('depth', models.IntegerField()),
+                ('done', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CrawlRun',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('depth', models.IntegerField()),
+                ('force', models.BooleanField(default=False)),
+                ('started', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('root', models.ForeignKey(related_name='crawl_runs', to='github_users.GitHubUser')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='crawlnode',
+            name='run',
+            field=models.ForeignKey(related_name='nodes', to='github_users.CrawlRun'),
+        ),
+        migrations.AddField(
+            model_name='crawlnode',
+            name='user',
+            field=models.ForeignKey(related_name='+', to='github_users.GitHubUser'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='crawlnode',
+            unique_together=set([('run', 'user')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='crawlnode',
+            index_together=set([('run', 'done', 'depth')]),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('github_users', '0002_crawl_frontier'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DistanceIndex',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('max_distance', models.PositiveSmallIntegerField()),
+                ('built', models.DateTimeField(blank=True, null=True)),
+                ('root', models.OneToOneField(related_name='distance_index', to='github_users.GitHubUser')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DistanceIndexEntry',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('distance', models.PositiveSmallIntegerField()),
+                ('index', models.ForeignKey(related_name='entries', to='github_users.DistanceIndex')),
+                ('user', models.ForeignKey(related_name='root_distances', to='github_users.GitHubUser')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='distanceindexentry',
+            unique_together=set([('index', 'user')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='distanceindexentry',
+            index_together=set([('index', 'distance')]),
+        ),
+    ]
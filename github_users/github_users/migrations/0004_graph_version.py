@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('github_users', '0003_distance_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GraphVersion',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('stamp', models.CharField(max_length=32)),
+            ],
+        ),
+    ]
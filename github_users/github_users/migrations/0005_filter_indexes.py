@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+USER_TABLE = 'github_users_githubuser'
+FOLLOWERS_TABLE = 'github_users_githubuser_followers'
+REVERSE_INDEX = 'github_users_githubuser_followers_to_from'
+
+
+def case_insensitive_indexes(vendor, has_trigrams=False):
+    """
+    Return ``(name, create sql)`` for the indexes that serve case insensitive
+    lookups on ``vendor``.
+    """
+    if vendor == 'postgresql':
+        # iexact and icontains compare UPPER() of the column.
+        indexes = [('%s_%s_upper' % (USER_TABLE, column),
+                    'CREATE INDEX %s_%s_upper ON %s (UPPER(%s))' % (
+                        USER_TABLE, column, USER_TABLE, column))
+                   for column in ('location', 'company')]
+        if has_trigrams:
+            indexes += [('%s_%s_upper_trgm' % (USER_TABLE, column),
+                         'CREATE INDEX %s_%s_upper_trgm ON %s '
+                         'USING gin (UPPER(%s) gin_trgm_ops)' % (
+                             USER_TABLE, column, USER_TABLE, column))
+                        for column in ('location', 'company')]
+        return indexes
+    # MySQL's default collations already compare case insensitively. On SQLite the lookups
+    # compile to LIKE with the pattern as a parameter, which no index can serve.
+    return []
+
+
+def has_trigrams(connection):
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        return cursor.fetchone() is not None
+
+
+def create_indexes(apps, schema_editor):
+    # The unique index on (from, to) covers looking up a user's followers. This
+    # one covers looking up who a user follows without reading the table.
+    schema_editor.execute('CREATE INDEX %s ON %s (to_githubuser_id, from_githubuser_id)' % (
+        REVERSE_INDEX, FOLLOWERS_TABLE))
+    vendor = schema_editor.connection.vendor
+    for name, sql in case_insensitive_indexes(vendor, has_trigrams(schema_editor.connection)):
+        schema_editor.execute(sql)
+
+
+def drop_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    names = [REVERSE_INDEX] + [name for name, sql in case_insensitive_indexes(
+        vendor, has_trigrams(schema_editor.connection))]
+    for name in names:
+        if vendor == 'mysql':
+            table = FOLLOWERS_TABLE if name == REVERSE_INDEX else USER_TABLE
+            schema_editor.execute('DROP INDEX %s ON %s' % (name, table))
+        else:
+            schema_editor.execute('DROP INDEX IF EXISTS %s' % name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('github_users', '0004_graph_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='githubuser',
+            name='company',
+            field=models.CharField(max_length=200, blank=True, null=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='githubuser',
+            name='location',
+            field=models.CharField(max_length=200, blank=True, null=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='githubuser',
+            name='num_followers',
+            field=models.IntegerField(blank=True, null=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='githubuser',
+            name='num_following',
+            field=models.IntegerField(blank=True, null=True, db_index=True),
+        ),
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
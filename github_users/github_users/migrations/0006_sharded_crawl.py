@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('github_users', '0005_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='crawlnode',
+            name='claimed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='crawlnode',
+            name='failed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='crawlnode',
+            name='shard',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='crawlrun',
+            name='shards',
+            field=models.IntegerField(default=1),
+        ),
+        migrations.AlterIndexTogether(
+            name='crawlnode',
+            index_together=set([('run', 'shard', 'depth'), ('run', 'done', 'depth')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('github_users', '0006_sharded_crawl'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='graphversion',
+            name='users_stamp',
+            field=models.CharField(max_length=32, default=''),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('github_users', '0007_graph_version_users'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='githubuser',
+            name='missing',
+            field=models.BooleanField(default=False),
+        ),
+    ]
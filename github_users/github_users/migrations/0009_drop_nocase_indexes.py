@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+USER_TABLE = 'github_users_githubuser'
+
+
+def drop_nocase_indexes(apps, schema_editor):
+    # 0005_filter_indexes used to add these on SQLite, but SQLite can't use them for the
+    # parameterised LIKE that iexact and friends compile to.
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for column in ('location', 'company'):
+        schema_editor.execute('DROP INDEX IF EXISTS %s_%s_nocase' % (USER_TABLE, column))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('github_users', '0008_user_missing'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_nocase_indexes, migrations.RunPython.noop),
+    ]
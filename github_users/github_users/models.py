@@ -1,12 +1,19 @@
 import datetime
-import copy
+import logging
 import pytz
 import requests
+import uuid
+from collections import OrderedDict, deque
 
 from django.conf import settings
-from django.db import models
+from django.db import IntegrityError, connection, models, transaction
 
 from .github_user_api import GitHubUserApi
+from .graph import filter_pks, layer_case
+from .graph_cache import follow_graph
+
+
+log = logging.getLogger(__name__)
 
 
 class GitHubObject(models.Model):
@@ -19,46 +26,49 @@ class GitHubObject(models.Model):
 
 
 class FollowManager(models.Manager):
-    def distance(self, root_user, distance=1, follow_qs=None, depth=1, *args, **kwargs):
+    def distance(self, root_user, distance=1, *args, **kwargs):
         """
         Return a queryset of GitHubUsers who are a given distance from the root_user along
         the followers edges.
 
-        We are accomplishing this by recursively building up sub-queries.
-
-        Note that this method will follow cycles in the graph.
+        A user is included when some walk of exactly ``distance`` edges leads from the
+        root_user to them. Note that this means cycles in the graph are followed, so
+        the root_user and closer users can show up again at larger distances.
 
         :param distance: The distance between users on the graph
-        :param follow_qs: The queryset to modify. Should only be passed by a recursive call.
-        :param depth: Used internally to track depth of recursion.
-                      Should only be passed by a recursive call.
         :return: a queryset
         """
-        if depth < 1:
-            raise ValueError("The depth parameter should start at 1 and only go up."
-                             "It should only be passed in by recursive calls.")
-        if depth > 1 and follow_qs is None:
-            raise ValueError("The 'follow_qs' parameter is required when 'depth' > 1.")
-
         if distance <= 0:
             return self.get_queryset().none()
 
-        if depth > distance:
-            # end recursion
-            return follow_qs.filter(*args, **kwargs)
+        pks = follow_graph().reachable_by_walk(root_user.pk, distance)
+        return filter_pks(self.get_queryset(), pks).filter(*args, **kwargs)
 
-        # Build the root query or sub-queries based on the root queryset.
-        if depth == 1:
-            follower_or_following = (models.Q(following=root_user) |
-                                     models.Q(followers=root_user))
-        else:
-            follower_or_following = (models.Q(followers__in=follow_qs) |
-                                     models.Q(following__in=follow_qs))
 
-        # Apply the filter to a new queryset and call this method again, one level deeper.
-        qs = self.get_queryset().filter(follower_or_following).distinct()
-        return self.distance(follow_qs=qs, depth=depth + 1, distance=distance,
-                             root_user=root_user).distinct()
+class GitHubUserQuerySet(models.QuerySet):
+    def with_edge_counts(self):
+        """
+        Annotate each user with ``followers_stored`` and ``following_stored``, the
+        number of follower and following edges we have for them.
+
+        Counting in correlated sub-queries avoids joining the through table twice,
+        which would multiply the two counts together.
+        """
+        qn = connection.ops.quote_name
+        through = qn(GitHubUser.followers.through._meta.db_table)
+        table = qn(GitHubUser._meta.db_table)
+        count_sql = 'SELECT COUNT(*) FROM %s WHERE %s.%%s = %s.%s' % (through, through, table,
+                                                                   qn('id'))
+        return self.extra(select=OrderedDict([
+            ('followers_stored', count_sql % qn('from_githubuser_id')),
+            ('following_stored', count_sql % qn('to_githubuser_id')),
+        ]))
+
+
+# The fields that ``_store_profile()`` fills in from a profile.
+PROFILE_FIELDS = ['github_id', 'login', 'e_tag', 'num_followers', 'followers_url',
+                  'num_following', 'location', 'company', 'missing', 'last_retrieved',
+                  'last_checked']
 
 
 class GitHubUser(GitHubObject):
@@ -68,16 +78,18 @@ class GitHubUser(GitHubObject):
     github_id = models.IntegerField(unique=True)
     login = models.CharField(max_length=39, unique=True)
     followers = models.ManyToManyField('self', related_name='following', symmetrical=False)
-    num_followers = models.IntegerField(null=True, blank=True)
+    num_followers = models.IntegerField(null=True, blank=True, db_index=True)
     followers_etag = models.CharField(max_length=32, blank=True, null=True)
     followers_url = models.URLField(blank=True, null=True)
-    num_following = models.IntegerField(null=True, blank=True)
+    num_following = models.IntegerField(null=True, blank=True, db_index=True)
     following_etag = models.CharField(max_length=32, blank=True, null=True)
     following_url = models.URLField(blank=True, null=True)
-    company = models.CharField(max_length=200, blank=True, null=True)
-    location = models.CharField(max_length=200, blank=True, null=True)
+    company = models.CharField(max_length=200, blank=True, null=True, db_index=True)
+    location = models.CharField(max_length=200, blank=True, null=True, db_index=True)
+    # GitHub has no profile for the login any more, see hydrate.py.
+    missing = models.BooleanField(default=False)
 
-    objects = models.Manager()
+    objects = GitHubUserQuerySet.as_manager()
     follow_relations = FollowManager()
 
     def __unicode__(self):
@@ -91,6 +103,12 @@ class GitHubUser(GitHubObject):
         etag = False if force else self.e_tag
         self._init_gh_api()
         api_resp = self.api.get_user(self.login, etag)
+        return self._store_profile(api_resp, save)
+
+    def _store_profile(self, api_resp, save=True):
+        """
+        Update self from a response of the ``/users/<login>`` endpoint.
+        """
         now = datetime.datetime.now(tz=pytz.UTC)
         if api_resp['status'] == requests.codes.ok:
             self.github_id = api_resp['json']['id']
@@ -103,6 +121,7 @@ class GitHubUser(GitHubObject):
                                                       '').rstrip('{/other_user}')
             self.location = api_resp['json'].get('location')
             self.company = api_resp['json'].get('company')
+            self.missing = False
             self.last_retrieved = self.last_checked = now
         elif api_resp['status'] == requests.codes.not_modified:
             self.last_checked = now
@@ -111,106 +130,216 @@ class GitHubUser(GitHubObject):
 
         if save:
             self.save()
+            if api_resp['status'] == requests.codes.ok:
+                GraphVersion.objects.bump_users()
         return self
 
-    def _add_followers(self, data):
-        followers = list(self.followers.all())
-        to_add = []
-        for user in data:
+    @staticmethod
+    def _edge_fields(relation):
+        """
+        Return the through table fields that point at self and at the other user
+        for the 'followers' or 'following' relation.
+        """
+        # For followers self is the 'from' side of the edge, for following the 'to' side.
+        if relation == 'followers':
+            return 'from_githubuser_id', 'to_githubuser_id'
+        return 'to_githubuser_id', 'from_githubuser_id'
+
+    def _edges(self, relation, pks):
+        """
+        Return ``(user_pk, follower_pk)`` pairs between self and ``pks``.
+        """
+        if relation == 'followers':
+            return [(self.pk, pk) for pk in pks]
+        return [(pk, self.pk) for pk in pks]
+
+    def _ingest_page(self, data, relation):
+        """
+        Store one page of users from the followers or following endpoint and link
+        them to self.
+
+        Rather than a ``get_or_create`` per user this looks up the users on the page
+        in one query, bulk inserts the missing ones and bulk inserts only the edges
+        that don't exist yet, so a page costs a handful of queries.
+
+        :param data: a list of user dicts, as returned by the GitHub API
+        :param relation: either 'followers' or 'following'
+        :return: the set of pks of the users on the page
+        """
+        users = OrderedDict((user['id'], user['login']) for user in data)
+        if not users:
+            return set()
+
+        pks = dict(GitHubUser.objects.filter(github_id__in=list(users))
+                   .values_list('github_id', 'pk'))
+        missing = [github_id for github_id in users if github_id not in pks]
+        if missing:
             now = datetime.datetime.now(tz=pytz.UTC)
-            follower, created = GitHubUser.objects.get_or_create(
-                github_id=user['id'],
-                defaults={'login': user['login'], 'last_retrieved': now, 'last_checked': now}
-            )
-            if follower not in followers:
-                to_add.append(follower)
-        self.followers.add(*to_add)
+            try:
+                with transaction.atomic():
+                    GitHubUser.objects.bulk_create([
+                        GitHubUser(github_id=github_id, login=users[github_id],
+                                   last_retrieved=now, last_checked=now)
+                        for github_id in missing
+                    ])
+            except IntegrityError:
+                # Somebody else inserted some of these users in the meantime.
+                for github_id in missing:
+                    GitHubUser.objects.get_or_create(
+                        github_id=github_id,
+                        defaults={'login': users[github_id], 'last_retrieved': now,
+                                  'last_checked': now}
+                    )
+            pks.update(GitHubUser.objects.filter(github_id__in=missing)
+                       .values_list('github_id', 'pk'))
+            GraphVersion.objects.bump_users()
+
+        through = GitHubUser.followers.through
+        self_field, other_field = self._edge_fields(relation)
+        page_pks = set(pks.values())
+        linked = set(through.objects.filter(**{self_field: self.pk,
+                                               other_field + '__in': list(page_pks)})
+                     .values_list(other_field, flat=True))
+        to_add = page_pks - linked
+        if not to_add:
+            return page_pks
+        try:
+            with transaction.atomic():
+                through.objects.bulk_create([
+                    through(**{self_field: self.pk, other_field: pk}) for pk in sorted(to_add)
+                ])
+        except IntegrityError:
+            getattr(self, relation).add(*to_add)
+
+        GraphVersion.objects.bump()
+        DistanceIndex.objects.edges_added(self._edges(relation, to_add))
+        return page_pks
+
+    def _remove_stale(self, relation, current_pks):
+        """
+        Remove the edges of ``relation`` to users that are not in ``current_pks``.
+        """
+        through = GitHubUser.followers.through
+        self_field, other_field = self._edge_fields(relation)
+        edges = through.objects.filter(**{self_field: self.pk})
+        stale = set(edges.values_list(other_field, flat=True)) - current_pks
+        if not stale:
+            return
+        filter_pks(edges, stale, field=other_field).delete()
+        GraphVersion.objects.bump()
+        DistanceIndex.objects.edges_removed(self._edges(relation, stale))
 
-    def populate_followers(self, force=False):
+    def _add_followers(self, data):
+        return self._ingest_page(data, 'followers')
+
+    def _populate_relation(self, relation, force=False):
+        """
+        Fetch the follower or following pages for this user and store them.
+
+        Every page is requested conditionally, with the ETag it had last time. A
+        304 comes back with the body we stored for that page, so an unchanged
+        list is replayed page by page without spending any of the rate limit and
+        without writing any edges. Only pages that did change are fetched in full.
+
+        With ``force`` the first page is fetched regardless of its ETag, and
+        users who are no longer on the list are removed once every page is in.
+        """
+        if relation == 'followers':
+            fetch, etag_field = self.api.get_user_followers, 'followers_etag'
+            add = self._add_followers
+        else:
+            fetch, etag_field = self.api.get_user_following, 'following_etag'
+            add = self._add_following
+
+        api_resp = fetch(self.login, False if force else getattr(self, etag_field))
+        if api_resp['status'] == requests.codes.ok:
+            setattr(self, etag_field, api_resp['etag'])
+            self.save()
+        elif api_resp['status'] != requests.codes.not_modified:
+            return
+
+        seen = add(api_resp['json'])
+        while 'next' in api_resp:
+            api_resp = fetch(self.login, None, api_resp['next'])
+            if api_resp['status'] not in (requests.codes.ok, requests.codes.not_modified):
+                return
+            seen |= add(api_resp['json'])
         if force:
-            self.following.clear()
+            self._remove_stale(relation, seen)
+
+    def populate_followers(self, force=False):
+        """
+        Fetch this user's followers from GitHub. See ``_populate_relation()``.
+        """
         if self.num_followers == 0 and not force:
             return
 
-        etag = False if force else self.followers_etag
         self._init_gh_api()
-        api_resp = self.api.get_user_followers(self.login, etag)
-        if api_resp['status'] == requests.codes.ok:
-            follower_data = api_resp['json']
-            self.followers_etag = api_resp['etag']
-            self.save()
-            self._add_followers(follower_data)
-            while 'next' in api_resp:
-                api_resp = self.api.get_user_followers(self.login, follower_url=api_resp['next'])
-                self._add_followers(api_resp['json'])
+        self._populate_relation('followers', force=force)
 
     def _add_following(self, data):
-        following = list(self.following.all())
-        to_add = []
-        for user in data:
-            now = datetime.datetime.now(tz=pytz.UTC)
-            gh_user, created = GitHubUser.objects.get_or_create(
-                github_id=user['id'],
-                defaults={'login': user['login'], 'last_retrieved': now, 'last_checked': now}
-            )
-            if gh_user not in following:
-                to_add.append(gh_user)
-        self.following.add(*to_add)
+        return self._ingest_page(data, 'following')
 
     def populate_following(self, force=False):
-        if force:
-            self.following.clear()
+        """
+        Fetch the users this user is following from GitHub. See ``_populate_relation()``.
+        """
         if self.num_following == 0 and not force:
             return
 
-        etag = False if force else self.following_etag
         self._init_gh_api()
-        api_resp = self.api.get_user_following(self.login, etag)
-        if api_resp['status'] == requests.codes.ok:
-            following_data = api_resp['json']
-            self.following_etag = api_resp['etag']
-            self.save()
-            self._add_following(following_data)
-            while 'next' in api_resp:
-                api_resp = self.api.get_user_following(self.login, following_url=api_resp['next'])
-                self._add_following(api_resp['json'])
+        self._populate_relation('following', force=force)
 
-    def fill_follow_graph(self, depth=3, parents=None, force=False):
+    def fill_follow_graph(self, depth=3, force=False):
         """
-        Get followers and followees recursively to the given depth.
+        Get followers and followees breadth first to the given depth.
 
-        ``parents`` is used by the recursive calls to avoid following
-        graph cycles.
-        """
-        if parents is None:
-            parents = []
-
-        parents.append(self)
+        Each user is fetched and expanded at most once, however many paths lead
+        to them. Users at the last level are only populated when ``POPULATE_ALL``
+        is set. The queue, and the depth of each user reached, only hold primary
+        keys.
 
-        self.populate_followers(force=force)
-        self.populate_following(force=force)
+        Return the number of users ``expanded`` and ``populated``, and the
+        ``duplicates``: how many times a user was reached again after they were
+        queued, counted as ``CrawlScheduler`` counts them.
 
-        if depth > 1 or settings.POPULATE_ALL:
-            for follower in self.followers.all():
-                # start with the original list of parents each time.
-                calling_parents = copy.copy(parents)
-                if follower in calling_parents:
-                    continue
-                # Only fully populate the follower if there will be multiple levels
-                follower = follower.populate_from_github(force=force)
-                if depth > 1:
-                    follower.fill_follow_graph(depth=depth - 1, parents=calling_parents,
-                                               force=force)
-
-            for followee in self.following.all():
-                # start with the original list of parents each time.
-                calling_parents = copy.copy(parents)
-                if followee in calling_parents:
+        ``fill_user_graph`` crawls with ``CrawlScheduler`` rather than this
+        method, which is kept for use as a library.
+        """
+        self._init_gh_api()
+        depths = {self.pk: 0}
+        queue = deque([self.pk])
+        stats = {'expanded': 0, 'populated': 0, 'duplicates': 0}
+
+        while queue:
+            pk = queue.popleft()
+            level = depths[pk]
+            user = self if pk == self.pk else GitHubUser.objects.get(pk=pk)
+            user.api = self.api
+
+            # Only fully populate the user if there will be multiple levels.
+            if level > 0 and (level < depth or settings.POPULATE_ALL):
+                user.populate_from_github(force=force)
+                stats['populated'] += 1
+            if level >= depth:
+                continue
+
+            user.populate_followers(force=force)
+            user.populate_following(force=force)
+            stats['expanded'] += 1
+
+            neighbors = list(user.followers.values_list('pk', flat=True))
+            neighbors.extend(user.following.values_list('pk', flat=True))
+            for neighbor in OrderedDict.fromkeys(neighbors):
+                if neighbor in depths:
+                    stats['duplicates'] += 1
                     continue
-                followee = followee.populate_from_github(force=force)
-                if depth > 1:
-                    followee.fill_follow_graph(depth=depth - 1, parents=calling_parents,
-                                               force=force)
+                depths[neighbor] = level + 1
+                queue.append(neighbor)
+        log.info("Filled the follow graph of %s to depth %d: expanded %d users, populated %d "
+                 "and skipped %d repeat visits." % (self.login, depth, stats['expanded'],
+                                                    stats['populated'], stats['duplicates']))
+        return stats
 
     def users_at_distance(self, distance):
         """
@@ -219,16 +348,318 @@ class GitHubUser(GitHubObject):
         """
         return GitHubUser.follow_relations.distance(root_user=self, distance=distance)
 
-    def users_within_distance(self, distance):
+    def distance_counts(self, distance, stale_ok=False):
+        """
+        Return a list of how many users are at each distance from self, from 1
+        up to ``distance``.
+
+        :param stale_ok: see ``follow_graph()``
+        """
+        if distance <= 0:
+            return []
+
+        index = self._distance_index(distance)
+        if index is not None:
+            counts = dict(index.entries.filter(distance__lte=distance).values('distance')
+                          .annotate(users=models.Count('id')).values_list('distance', 'users'))
+            return [counts.get(d, 0) for d in range(1, distance + 1)]
+
+        layers = follow_graph(stale_ok).layers(self.pk, distance)
+        return [len(layer) for layer in layers] + [0] * (distance - len(layers))
+
+    def users_within_distance(self, distance, with_distance=False, distances=None,
+                              stale_ok=False):
         """
         Return a queryset of all the users within the given distance to self.
+
+        :param with_distance: annotate each user with ``distance``, their shortest
+                              distance from self
+        :param distances: only include the users at these distances
+        :param stale_ok: see ``follow_graph()``
         """
         if distance <= 0:
             return GitHubUser.objects.none()
+        wanted = set(range(1, distance + 1))
+        if distances is not None:
+            wanted &= set(distances)
+
+        index = self._distance_index(distance)
+        if index is not None:
+            users = GitHubUser.objects.filter(root_distances__index=index,
+                                              root_distances__distance__in=sorted(wanted))
+            if with_distance:
+                users = users.annotate(distance=models.Min('root_distances__distance'))
+            return users
+
+        layers = dict((d, layer) for d, layer in
+                      enumerate(follow_graph(stale_ok).layers(self.pk, distance), 1)
+                      if d in wanted)
+        users = filter_pks(GitHubUser.objects.all(),
+                           [pk for layer in layers.values() for pk in layer])
+        if with_distance and layers:
+            users = users.annotate(distance=layer_case(GitHubUser, layers))
+        return users
+
+    def _distance_index(self, distance):
+        """
+        Return a built ``DistanceIndex`` rooted at self that covers ``distance``, if any.
+        """
+        return DistanceIndex.objects.filter(root=self, max_distance__gte=distance,
+                                            built__isnull=False).first()
+
+
+class GraphVersionManager(models.Manager):
+    def current(self):
+        """
+        Return the stamp of the edge table as it is now.
+        """
+        version, _ = self.get_or_create(pk=1, defaults={'stamp': uuid.uuid4().hex})
+        return version.stamp
+
+    def bump(self):
+        """
+        Record that the edge table changed.
+        """
+        self._bump('stamp')
+
+    def current_with_users(self, stamp=None):
+        """
+        Return a stamp of both the edges and the users as they are now.
+
+        :param stamp: the edges stamp to use instead of the current one, that of
+                      the follow graph a result was read from
+        """
+        version, _ = self.get_or_create(pk=1, defaults={'stamp': uuid.uuid4().hex})
+        return '%s-%s' % (stamp or version.stamp, version.users_stamp)
+
+    def bump_users(self):
+        """
+        Record that users were added, or that their profiles changed. Edits
+        made outside of the crawlers don't bump it.
+        """
+        self._bump('users_stamp')
+
+    def _bump(self, field):
+        stamp = uuid.uuid4().hex
+        if not self.filter(pk=1).update(**{field: stamp}):
+            self.get_or_create(pk=1, defaults={'stamp': stamp, 'users_stamp': stamp})
+
+
+class GraphVersion(models.Model):
+    """
+    A single row whose stamp changes whenever follow edges are added or removed,
+    so that every process can tell whether its copy of the graph is current.
+    ``users_stamp`` does the same for the users themselves.
+
+    The stamps are random rather than counters so that they never repeat, even
+    when the tables are emptied.
+    """
+    stamp = models.CharField(max_length=32)
+    users_stamp = models.CharField(max_length=32, default='')
 
-        # Build up a queryset that includes all of the related  users within a given distance
-        qs = self.users_at_distance(1)
-        for i in range(2, distance + 1):
-            qs = qs | self.users_at_distance(i)
+    objects = GraphVersionManager()
 
-        return qs.exclude(pk=self.pk)
+    def __unicode__(self):
+        return self.stamp
+
+
+class CrawlRun(models.Model):
+    """
+    A single run of ``fill_user_graph``, so that an interrupted crawl can be resumed.
+    """
+    root = models.ForeignKey(GitHubUser, related_name='crawl_runs')
+    depth = models.IntegerField()
+    force = models.BooleanField(default=False)
+    # The number of worker processes the frontier is partitioned between.
+    shards = models.IntegerField(default=1)
+    started = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return '%s (depth %d)' % (self.root, self.depth)
+
+
+class CrawlNode(models.Model):
+    """
+    A user that a crawl run has reached, along with the level at which it was
+    reached. Nodes that are not ``done`` make up the frontier.
+
+    In a sharded crawl each node belongs to the ``shard`` of its user, and a
+    worker ``claimed`` it while crawling it. Nodes that ``failed`` are left for
+    the next resume.
+    """
+    run = models.ForeignKey(CrawlRun, related_name='nodes')
+    user = models.ForeignKey(GitHubUser, related_name='+')
+    depth = models.IntegerField()
+    done = models.BooleanField(default=False)
+    shard = models.IntegerField(default=0)
+    claimed = models.BooleanField(default=False)
+    failed = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ('run', 'user')
+        index_together = (('run', 'done', 'depth'), ('run', 'shard', 'depth'))
+
+
+class DistanceIndexManager(models.Manager):
+    def edges_added(self, edges):
+        """
+        Bring every index up to date with new ``(user_pk, follower_pk)`` edges.
+        """
+        if edges:
+            for index in self.get_queryset():
+                index.add_edges(edges)
+
+    def edges_removed(self, edges):
+        """
+        Bring every index up to date after ``(user_pk, follower_pk)`` edges were removed.
+        """
+        if edges:
+            for index in self.get_queryset():
+                index.remove_edges(edges)
+
+
+class DistanceIndex(models.Model):
+    """
+    Materialized minimum distances from a root user to everybody within
+    ``max_distance`` of them.
+
+    The index is filled by a breadth first search and then kept up to date as
+    the crawler adds and removes edges, so ``users_within_distance()`` on the
+    root becomes a single indexed filter.
+    """
+    root = models.OneToOneField(GitHubUser, related_name='distance_index')
+    max_distance = models.PositiveSmallIntegerField()
+    built = models.DateTimeField(null=True, blank=True)
+
+    objects = DistanceIndexManager()
+
+    def __unicode__(self):
+        return '%s (max distance %d)' % (self.root, self.max_distance)
+
+    def rebuild(self):
+        """
+        Recompute the whole index from scratch.
+        """
+        layers = follow_graph().layers(self.root_id, self.max_distance)
+        with transaction.atomic():
+            self.entries.all().delete()
+            DistanceIndexEntry.objects.bulk_create([
+                DistanceIndexEntry(index=self, user_id=pk, distance=distance)
+                for distance, layer in enumerate(layers, 1) for pk in layer
+            ])
+            self.built = datetime.datetime.now(tz=pytz.UTC)
+            self.save(update_fields=['built'])
+
+    def _distances(self, pks):
+        """
+        Return a dict of the indexed distance for those of ``pks`` that are in the index.
+        """
+        distances = dict(filter_pks(self.entries.all(), pks, field='user')
+                         .values_list('user_id', 'distance'))
+        if self.root_id in pks:
+            distances[self.root_id] = 0
+        return distances
+
+    @staticmethod
+    def _neighbor_pairs(pks):
+        """
+        Yield ``(pk, neighbor_pk)`` for every edge touching one of ``pks``.
+        """
+        through = GitHubUser.followers.through.objects.all()
+        for field, other_field in (('from_githubuser', 'to_githubuser_id'),
+                                   ('to_githubuser', 'from_githubuser_id')):
+            pairs = filter_pks(through, pks, field=field).values_list(field + '_id', other_field)
+            for pair in pairs.iterator():
+                yield pair
+
+    def add_edges(self, edges):
+        """
+        Lower the distances that the new edges shorten and carry the change outwards.
+        """
+        distances = self._distances(set(pk for edge in edges for pk in edge))
+        candidates = {}
+        for a, b in edges:
+            for near, far in ((a, b), (b, a)):
+                if near in distances and distances[near] < self.max_distance:
+                    distance = distances[near] + 1
+                    if distance < min(distances.get(far, distance + 1),
+                                      candidates.get(far, distance + 1)):
+                        candidates[far] = distance
+        if candidates:
+            self._relax(candidates)
+
+    def _relax(self, candidates):
+        """
+        Apply ``candidates``, a dict of pk to a possibly shorter distance, then
+        breadth first propagate any improvement to the neighbors.
+        """
+        improved = {}
+        while candidates:
+            current = self._distances(candidates)
+            level = dict((pk, distance) for pk, distance in candidates.items()
+                         if distance < current.get(pk, self.max_distance + 1))
+            improved.update(level)
+
+            candidates = {}
+            frontier = [pk for pk, distance in level.items() if distance < self.max_distance]
+            for pk, neighbor in self._neighbor_pairs(frontier):
+                distance = level[pk] + 1
+                if distance < min(improved.get(neighbor, distance + 1),
+                                  candidates.get(neighbor, distance + 1)):
+                    candidates[neighbor] = distance
+
+        improved.pop(self.root_id, None)
+        existing = self._distances(improved)
+        with transaction.atomic():
+            by_distance = {}
+            for pk in existing:
+                by_distance.setdefault(improved[pk], []).append(pk)
+            for distance, pks in by_distance.items():
+                filter_pks(self.entries.all(), pks, field='user').update(distance=distance)
+            DistanceIndexEntry.objects.bulk_create([
+                DistanceIndexEntry(index=self, user_id=pk, distance=distance)
+                for pk, distance in improved.items() if pk not in existing
+            ])
+
+    def remove_edges(self, edges):
+        """
+        Check whether removed edges lengthen any distance.
+
+        An edge only matters if it joined users at successive distances, and
+        even then only if the farther user has no other neighbor one step
+        closer to the root. When that happens the distances past that user
+        can grow in ways that are hard to follow locally, so the index is
+        rebuilt.
+        """
+        distances = self._distances(set(pk for edge in edges for pk in edge))
+        for a, b in edges:
+            if a not in distances or b not in distances or distances[a] == distances[b]:
+                continue
+            near, far = (a, b) if distances[a] < distances[b] else (b, a)
+            parents = self._distances(set(neighbor for _, neighbor in self._neighbor_pairs([far])))
+            if distances[near] not in parents.values():
+                self.rebuild()
+                return
+
+
+class DistanceIndexEntry(models.Model):
+    """
+    The minimum distance between a ``DistanceIndex`` root and one other user.
+    """
+    index = models.ForeignKey(DistanceIndex, related_name='entries')
+    user = models.ForeignKey(GitHubUser, related_name='root_distances')
+    distance = models.PositiveSmallIntegerField()
+
+    class Meta:
+        unique_together = ('index', 'user')
+        index_together = ('index', 'distance')
+
+
+def follow_edges_changed(sender, action, **kwargs):
+    """
+    Bump the graph version when edges change through the related managers,
+    e.g. ``user.followers.add()``.
+    """
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        GraphVersion.objects.bump()
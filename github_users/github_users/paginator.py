@@ -0,0 +1,198 @@
+"""
+Keyset pagination for the user resource.
+
+Tastypie's ``Paginator`` counts the whole result set and then slices it with
+``OFFSET``, so every page costs a count, and deep pages cost more than shallow
+ones because the database steps over all of the rows before them.
+
+Passing ``cursor`` switches to keyset pagination instead: each page picks up
+after the last row of the page before it, by comparing the ordering fields
+(with ``id`` added to break ties), so every page costs the same. The ``next``
+link carries the cursor for the following page. The total count is only
+computed when asked for with ``total_count=1``.
+"""
+import base64
+import json
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connection
+from django.db.models import Q
+from django.db.models.query import QuerySet
+from tastypie.exceptions import BadRequest
+from tastypie.paginator import Paginator
+
+try:
+    from urllib.parse import urlencode
+except ImportError:  # Python 2
+    from urllib import urlencode
+
+
+def encode_cursor(ordering, values):
+    data = json.dumps({'order': ordering, 'after': values}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Return the ``(ordering, values)`` of a cursor, or ``None`` for an empty one.
+    """
+    if not cursor:
+        return None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        return data['order'], data['after']
+    except (TypeError, ValueError, KeyError, UnicodeError):
+        raise BadRequest("Invalid cursor '%s' provided." % cursor)
+
+
+def keyset_filter(ordering, values, nulls_largest=None):
+    """
+    Return a ``Q`` that matches the rows after ``values`` in ``ordering``, a list
+    of field names as passed to ``order_by()`` whose last field is unique.
+
+    ``nulls_largest`` says whether the database sorts NULLs after every value,
+    as PostgreSQL does, or before them, as SQLite and MySQL do.
+    """
+    if nulls_largest is None:
+        nulls_largest = connection.features.nulls_order_largest
+
+    tied = Q()
+    terms = []
+    for order, value in zip(ordering, values):
+        descending = order.startswith('-')
+        field = order.lstrip('-')
+        nulls_last = nulls_largest != descending
+
+        if value is None:
+            after = Q(**{'%s__isnull' % field: False}) if not nulls_last else None
+            tie = Q(**{'%s__isnull' % field: True})
+        else:
+            after = Q(**{'%s__%s' % (field, 'lt' if descending else 'gt'): value})
+            if nulls_last:
+                after |= Q(**{'%s__isnull' % field: True})
+            tie = Q(**{field: value})
+
+        if after is not None:
+            terms.append(tied & after)
+        tied &= tie
+
+    if not terms:
+        return None
+    q = terms[0]
+    for term in terms[1:]:
+        q |= term
+    return q
+
+
+def ordering_with_pk(queryset):
+    """
+    Return the ordering of ``queryset``, ending with the primary key.
+    """
+    ordering = []
+    pk_order = 'id'
+    for order in queryset.query.order_by:
+        if order.lstrip('-') in ('pk', 'id'):
+            pk_order = order.replace('pk', 'id')
+            break
+        ordering.append(order)
+    return ordering + [pk_order]
+
+
+def iterate_keyset(queryset, fields, chunk_size=2000):
+    """
+    Yield the rows of ``queryset`` as dicts of ``fields``, in order, reading
+    ``chunk_size`` rows at a time.
+
+    Each chunk is its own keyset query, so neither the database nor this
+    process holds more than a chunk at once, however large the result.
+    """
+    ordering = ordering_with_pk(queryset)
+    keys = [order.lstrip('-') for order in ordering]
+    queryset = queryset.order_by(*ordering).values(*set(fields) | set(keys))
+    objects = queryset
+    while True:
+        count = 0
+        row = None
+        for row in objects[:chunk_size].iterator():
+            count += 1
+            yield dict((field, row[field]) for field in fields)
+        if count < chunk_size:
+            return
+        q = keyset_filter(ordering, [row[key] for key in keys])
+        if q is None:
+            return
+        objects = queryset.filter(q)
+
+
+class KeysetPaginator(Paginator):
+    """
+    Paginate with a cursor when the request has one, and by offset otherwise.
+    """
+
+    def page(self):
+        if 'cursor' not in self.request_data or not isinstance(self.objects, QuerySet):
+            return super(KeysetPaginator, self).page()
+
+        limit = self.get_limit()
+        ordering = self.get_ordering()
+        objects = self.objects.order_by(*ordering)
+        cursor = decode_cursor(self.request_data['cursor'])
+        if cursor is not None:
+            cursor_ordering, values = cursor
+            if cursor_ordering != ordering or len(values) != len(ordering):
+                raise BadRequest("The cursor doesn't match the requested ordering.")
+            q = keyset_filter(ordering, values)
+            objects = objects.filter(q) if q is not None else objects.none()
+
+        meta = {'limit': limit, 'previous': None, 'next': None}
+        if self.request_data.get('total_count') in ('1', 'true'):
+            meta['total_count'] = self.get_count()
+
+        if limit:
+            page = list(objects[:limit + 1])
+            if len(page) > limit:
+                page = page[:limit]
+                meta['next'] = self._generate_cursor_uri(
+                    limit, encode_cursor(ordering, self.get_values(page[-1], ordering)))
+        else:
+            page = list(objects)
+
+        return {
+            self.collection_name: page,
+            'meta': meta,
+        }
+
+    def get_ordering(self):
+        return ordering_with_pk(self.objects)
+
+    @staticmethod
+    def get_values(obj, ordering):
+        opts = obj._meta
+        values = []
+        for order in ordering:
+            name = order.lstrip('-')
+            try:
+                name = opts.get_field(name).attname
+            except FieldDoesNotExist:
+                pass
+            values.append(getattr(obj, name))
+        return values
+
+    def _generate_cursor_uri(self, limit, cursor):
+        if self.resource_uri is None:
+            return None
+
+        try:
+            request_params = self.request_data.copy()
+            for key in ('limit', 'offset', 'cursor'):
+                if key in request_params:
+                    del request_params[key]
+            request_params.update({'limit': limit, 'cursor': cursor})
+            encoded_params = request_params.urlencode()
+        except AttributeError:
+            request_params = dict((k, v) for k, v in self.request_data.items()
+                                  if k not in ('limit', 'offset', 'cursor'))
+            request_params.update({'limit': limit, 'cursor': cursor})
+            encoded_params = urlencode(request_params)
+
+        return '%s?%s' % (self.resource_uri, encoded_params)
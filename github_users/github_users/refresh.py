@@ -0,0 +1,147 @@
+"""
+Refresh an existing graph, most out of date users first.
+
+``fill_follow_graph(force=True)`` throws away every relation and fetches it all
+again. Most of a large graph doesn't change from one day to the next, so the
+refresh here ranks users by how long ago they were checked and by how far their
+follower and following counts are from the edges we have stored, and then only
+fetches what is needed, within a budget of requests:
+
+1. Each user's profile is revalidated with a conditional request. That is free
+   when nothing changed.
+2. When the counts in the profile don't match the stored edges, the user goes
+   back on the queue, ranked by the size of the mismatch, to have their
+   follower or following pages revalidated. Only lists that were fetched
+   before are compared, so the users at the edge of the graph aren't expanded.
+
+Users that are gone from GitHub are marked ``missing`` and not refreshed again.
+"""
+import datetime
+import heapq
+import itertools
+import logging
+
+import pytz
+import requests
+
+from .github_user_api import GitHubUserApi
+from .models import GitHubUser
+
+
+log = logging.getLogger(__name__)
+
+PROFILE, RELATIONS = 'profile', 'relations'
+
+
+def _drift(count, stored, etag):
+    """
+    How far a count from GitHub is from the number of edges we have.
+
+    Only relations that have been fetched, and so have an ETag, can drift. The
+    users at the edge of a crawl only have the edges to the users around them.
+    """
+    if count is None or etag is None:
+        return 0
+    return abs(count - stored)
+
+
+def _followers_drift(user):
+    return _drift(user.num_followers, user.followers_stored, user.followers_etag)
+
+
+def _following_drift(user):
+    return _drift(user.num_following, user.following_stored, user.following_etag)
+
+
+class RefreshScheduler(object):
+    """
+    Refresh users that were last checked at least ``min_age`` ago.
+
+    :param budget: stop after this many requests have counted against the
+                   rate limit. 304 responses are free.
+    :param limit: only consider this many of the least recently checked users
+    """
+
+    def __init__(self, min_age=datetime.timedelta(days=1), budget=None, limit=None, api=None):
+        self.min_age = min_age
+        self.budget = budget
+        self.limit = limit
+        self.api = api if api is not None else GitHubUserApi()
+
+        self.queue = []
+        self._order = itertools.count()
+        self.stats = {'profiles': 0, 'missing': 0, 'followers': 0, 'following': 0}
+
+    def push(self, priority, pk, stage):
+        # The counter keeps equal priorities in insertion order.
+        heapq.heappush(self.queue, (-priority, next(self._order), pk, stage))
+
+    def load(self):
+        """
+        Queue every stale user, ranked by age and by how far their counts drift
+        from the stored edges.
+        """
+        now = datetime.datetime.now(tz=pytz.UTC)
+        users = (GitHubUser.objects.with_edge_counts()
+                 .filter(last_checked__lte=now - self.min_age, missing=False)
+                 .order_by('last_checked'))
+        if self.limit is not None:
+            users = users[:self.limit]
+
+        for user in users.iterator():
+            age = (now - user.last_checked).total_seconds() / self.min_age.total_seconds()
+            drift = _followers_drift(user) + _following_drift(user)
+            self.push(age * (1 + drift), user.pk, PROFILE)
+
+    def out_of_budget(self):
+        return self.budget is not None and self.api.quota_used() >= self.budget
+
+    def run(self):
+        """
+        Work through the queue until it is empty or the budget is spent.
+        Return the stats.
+        """
+        self.load()
+        while self.queue and not self.out_of_budget():
+            priority, _, pk, stage = heapq.heappop(self.queue)
+            user = GitHubUser.objects.with_edge_counts().get(pk=pk)
+            user.api = self.api
+            if stage == PROFILE:
+                self.refresh_profile(user, -priority)
+            else:
+                self.refresh_relations(user)
+
+        self.stats['requests'] = sum(self.api.responses.values())
+        self.stats['quota_used'] = self.api.quota_used()
+        self.stats['remaining'] = len(self.queue)
+        return self.stats
+
+    def refresh_profile(self, user, priority):
+        """
+        Revalidate the profile and queue the user's relations if their counts changed.
+        """
+        api_resp = self.api.get_user(user.login, user.e_tag)
+        self.stats['profiles'] += 1
+        if api_resp['status'] == requests.codes.not_found:
+            user.missing = True
+            user.last_checked = datetime.datetime.now(tz=pytz.UTC)
+            user.save(update_fields=['missing', 'last_checked'])
+            self.stats['missing'] += 1
+            return
+        user._store_profile(api_resp)
+        drift = _followers_drift(user) + _following_drift(user)
+        if drift:
+            self.push(priority * (1 + drift), user.pk, RELATIONS)
+
+    def refresh_relations(self, user):
+        """
+        Fetch whichever of the user's relations no longer match their counts.
+
+        The relations are forced so that edges which went away are removed.
+        """
+        if _followers_drift(user):
+            user.populate_followers(force=True)
+            self.stats['followers'] += 1
+        if _following_drift(user):
+            user.populate_following(force=True)
+            self.stats['following'] += 1
@@ -0,0 +1,109 @@
+"""
+A cache of API list results.
+
+The same filtered lists and ``within/<distance>/`` queries are requested over
+and over, one page at a time, and each page runs the whole query again to
+count and slice it. ``cached_results()`` keeps the ordered ids of a result in
+the ``API_RESULT_CACHE`` cache instead, so that a later request for any page of
+it only loads the users on that page.
+
+Results are keyed by the path and the query parameters, other than those that
+pick the page, along with the ``GraphVersion`` stamps of the edges and the
+users. The crawlers change those stamps whenever they write, so a result is
+never served once the data behind it has changed. Results read from a follow
+graph that may be behind the database are keyed by that graph's own stamp
+instead, so a stale graph's result is never cached as the current one. Stale entries aren't deleted,
+they expire or are evicted by the cache like any other.
+
+Only offset pagination is served from the cache: cursors and NDJSON already
+read a result a chunk at a time.
+"""
+import hashlib
+from array import array
+
+from django.conf import settings
+from django.core.cache import caches
+
+# Parameters that pick the page or the format rather than the result.
+PAGE_PARAMETERS = ('limit', 'offset', 'cursor', 'total_count', 'format', 'callback')
+
+
+def cache_key(request, stamp):
+    params = sorted((name, request.GET.getlist(name)) for name in request.GET
+                    if name not in PAGE_PARAMETERS)
+    text = '%s?%r' % (request.path, params)
+    return 'api-results:%s:%s' % (stamp, hashlib.md5(text.encode('utf-8')).hexdigest())
+
+
+def cacheable(request):
+    return (bool(settings.API_RESULT_CACHE) and 'cursor' not in request.GET and
+            request.GET.get('format') != 'ndjson')
+
+
+class CachedResults(object):
+    """
+    A result as an array of pks, and their distances if it has them, that
+    loads the users of a slice when it is taken. Just enough of a queryset for
+    the paginator.
+    """
+
+    def __init__(self, pks, distances, model):
+        self.pks = pks
+        self.distances = distances
+        self.model = model
+
+    def count(self):
+        return len(self.pks)
+
+    def __len__(self):
+        return len(self.pks)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        pks = self.pks[index]
+        objects = self.model.objects.in_bulk(list(pks))
+        distances = self.distances[index] if self.distances is not None else None
+        page = []
+        for i, pk in enumerate(pks):
+            # Users deleted since the result was cached are left out.
+            if pk in objects:
+                if distances is not None:
+                    objects[pk].distance = distances[i]
+                page.append(objects[pk])
+        return page
+
+
+def cached_results(request, build, model, graph=None):
+    """
+    Return the result for ``request`` from the cache, or else call ``build``
+    for the sorted queryset, and cache its ids if there aren't too many.
+
+    :param graph: the follow graph ``build`` reads from, if it does
+    """
+    if not cacheable(request):
+        return build()
+
+    from .models import GraphVersion
+
+    cache = caches[settings.API_RESULT_CACHE]
+    stamp = getattr(graph, 'stamp', None)
+    key = cache_key(request, GraphVersion.objects.current_with_users(stamp))
+    cached = cache.get(key)
+    if cached is not None:
+        return CachedResults(cached[0], cached[1], model)
+
+    objects = build()
+    limit = settings.API_RESULT_CACHE_MAX_IDS
+    if 'distance' in objects.query.annotations:
+        rows = list(objects.values_list('pk', 'distance')[:limit + 1])
+        pks = array('l', (pk for pk, _ in rows))
+        distances = array('l', (distance for _, distance in rows))
+    else:
+        pks = array('l', objects.values_list('pk', flat=True)[:limit + 1])
+        distances = None
+    if len(pks) > limit:
+        return objects
+    # Arrays pickle far smaller and faster than lists of ints.
+    cache.set(key, (pks, distances))
+    return CachedResults(pks, distances, model)
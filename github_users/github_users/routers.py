@@ -0,0 +1,25 @@
+from django.conf import settings
+
+# The app label of the models Django's database caches use.
+CACHE_APP_LABEL = 'django_cache'
+
+
+class CacheRouter(object):
+    """
+    Keep the tables of database caches in ``GITHUB_RESPONSE_CACHE_DATABASE``,
+    and everything else out of it.
+    """
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == CACHE_APP_LABEL:
+            return settings.GITHUB_RESPONSE_CACHE_DATABASE
+        return None
+
+    db_for_write = db_for_read
+
+    def allow_migrate(self, db, app_label, model=None, **hints):
+        if app_label == CACHE_APP_LABEL:
+            return db == settings.GITHUB_RESPONSE_CACHE_DATABASE
+        if db == settings.GITHUB_RESPONSE_CACHE_DATABASE:
+            return False
+        return None
@@ -79,7 +79,65 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-    }
+        'OPTIONS': {
+            # Seconds a writer waits for another to commit before giving up.
+            'timeout': 20,
+        },
+    },
+    # GitHub's responses, see CACHES['github']. A database of their own keeps the cache's writes
+    # from contending with a crawl's for the crawl database's write lock.
+    'github_cache': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'github_cache.sqlite3'),
+        'OPTIONS': {
+            'timeout': 20,
+        },
+    },
+}
+
+# Database caches keep their tables in GITHUB_RESPONSE_CACHE_DATABASE, see routers.py.
+DATABASE_ROUTERS = ['github_users.routers.CacheRouter']
+
+# Applied to every new SQLite connection, see apps.py. In WAL mode readers, such as the API, carry
+# on while a crawl writes, and synchronous=NORMAL only syncs at checkpoints rather than at every
+# commit. A negative cache_size is in KiB.
+SQLITE_PRAGMAS = [
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -65536),
+]
+
+
+# Caches
+# https://docs.djangoproject.com/en/1.8/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Responses from GitHub, kept between runs so that unchanged pages can be revalidated and
+    # replayed. The table is in the github_cache database, and is created by
+    # `manage.py migrate --database github_cache`. Only what a replay needs is kept, about 4 KB for
+    # a page of 100 followers and a few hundred bytes for a profile. Every write counts the entries to check MAX_ENTRIES, so
+    # keep it in proportion.
+    'github': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'github_response_cache',
+        'TIMEOUT': 60 * 60 * 24 * 30,
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000000,
+        },
+    },
+    # The ordered ids of API list results, see result_cache.py. Use memcached or Redis to share
+    # them between API workers, with an LRU of their own.
+    'results': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'api-results',
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+        },
+    },
 }
 
 
@@ -102,8 +160,32 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+GITHUB_API_URL = 'https://api.github.com'
+
+# The cache that GitHub responses and their ETags are kept in.
+GITHUB_RESPONSE_CACHE = 'github'
+# The database that database caches, such as GITHUB_RESPONSE_CACHE, keep their tables in.
+GITHUB_RESPONSE_CACHE_DATABASE = 'github_cache'
+
+# HTTP client settings for the GitHub API. Connections are pooled and kept alive; server and
+# connection errors are retried with an exponential backoff of BACKOFF_FACTOR * 2 ** (retry - 1)
+# seconds.
+GITHUB_API_POOL_SIZE = 10
+GITHUB_API_TIMEOUT = 19
+GITHUB_API_MAX_RETRIES = 3
+GITHUB_API_BACKOFF_FACTOR = 0.5
+
 GITHUB_ACCESS_TOKEN = os.environ.get('GITHUB_ACCESS_TOKEN')
 
+# A comma separated pool of access tokens to spread requests over. Takes precedence over
+# GITHUB_ACCESS_TOKEN.
+GITHUB_ACCESS_TOKENS = [token for token in os.environ.get('GITHUB_ACCESS_TOKENS', '').split(',')
+                        if token]
+
+# How many requests a token may make back to back before requests are spaced out evenly over
+# the rest of the rate limit window.
+GITHUB_RATE_BURST = 10
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -137,5 +219,20 @@ LOGGING = {
 
 TASTYPIE_DEFAULT_FORMATS = ['json']
 
-# Controls if we fully populate users at the edge of a related user graph.
+# Controls if we fully populate users at the edge of a related user graph. Without it, fill in
+# their profiles in bulk afterwards with `python manage.py hydrate_users`.
 POPULATE_ALL = True
+
+# Where API workers write and share memory mapped snapshots of the follow graph. If unset, each
+# process loads its own copy from the database.
+GRAPH_SNAPSHOT_DIR = os.getenv('GRAPH_SNAPSHOT_DIR')
+
+# Seconds that each process serves its copy of the follow graph to the API's distance queries for,
+# before it checks whether the edges changed. A crawl changes them with every page, and the graph
+# is too big to reload as often. Other callers always check.
+GRAPH_RELOAD_INTERVAL = 30
+
+# The cache that API list results are kept in, or None not to keep them, and the most ids a
+# result may have to be kept.
+API_RESULT_CACHE = 'results'
+API_RESULT_CACHE_MAX_IDS = 50000
@@ -0,0 +1,306 @@
+"""
+Crawl the follow graph with several worker processes.
+
+Threads only get so far: parsing JSON and running the ORM hold the GIL, so a
+threaded crawl keeps at most about one core busy. ``ShardedCrawl`` starts a
+process per shard instead. Users are partitioned between the shards by a hash
+of their ``github_id``, and each shard worker has its own ``GitHubUserApi``,
+with an access token of its own where there are enough to go round, and its
+own database connection.
+
+The workers coordinate through the run's ``CrawlNode`` rows. A worker only
+crawls nodes of its own shard, and claims each one with a conditional update
+first, so no user is fetched twice even if a shard's worker is started twice.
+To keep the crawl breadth first, a worker doesn't start on a level until every
+shard is done with the levels before it: otherwise a slow shard could reach a
+user at depth 2 after a fast one had already reached them at depth 3.
+
+The worker processes are forked, so that they start with Django already set
+up, which rules out platforms without ``fork()``, such as Windows.
+"""
+import datetime
+import logging
+import multiprocessing
+import time
+from collections import defaultdict
+from functools import partial
+
+import pytz
+from django.conf import settings
+from django.db import IntegrityError, OperationalError, connection, connections, transaction
+from django.db.models import Min
+
+from .github_user_api import GitHubUserApi, RateGovernor
+from .graph import filter_pks
+from .models import CrawlNode, CrawlRun, GitHubUser
+
+
+log = logging.getLogger(__name__)
+
+
+def shard_for(github_id, shards):
+    """
+    Return the shard of the user with ``github_id``.
+
+    GitHub ids are handed out in sequence, so they are scrambled with a
+    multiplicative hash rather than taken modulo ``shards`` as they are.
+    """
+    return (github_id or 0) * 2654435761 % 2 ** 32 % shards
+
+
+def shard_api(shard, shards=1):
+    """
+    Return a ``GitHubUserApi`` for ``shard`` of ``shards``, with one access token
+    of its own.
+
+    When there are more shards than tokens, the shards that share a token each
+    take an even share of its budget, since their processes can't see each
+    other's requests.
+    """
+    tokens = settings.GITHUB_ACCESS_TOKENS or [settings.GITHUB_ACCESS_TOKEN]
+    sharing = len(range(shard % len(tokens), max(shards, shard + 1), len(tokens)))
+    return GitHubUserApi(governor=RateGovernor(tokens=[tokens[shard % len(tokens)]],
+                                               share=1.0 / sharing))
+
+
+def _multiprocessing():
+    """
+    Return the multiprocessing context that forks its processes, or the module
+    itself on Python 2, which always forks.
+    """
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing
+
+
+def _run_shard(crawl_run_pk, shard, make_api, poll_interval, expanded, duplicates):
+    """
+    The body of a worker process. Adds the number of users it expanded, and of
+    users it reached again, to ``expanded`` and ``duplicates``, shared
+    ``multiprocessing.Value`` objects.
+    """
+    try:
+        crawl_run = CrawlRun.objects.get(pk=crawl_run_pk)
+        worker = ShardWorker(crawl_run, shard, api=make_api(shard), poll_interval=poll_interval)
+        count = worker.run()
+        with expanded.get_lock():
+            expanded.value += count
+        with duplicates.get_lock():
+            duplicates.value += worker.duplicates
+    finally:
+        connection.close()
+
+
+class ShardWorker(object):
+    """
+    Crawl the nodes of one shard of ``crawl_run``, until the frontier is empty.
+    """
+
+    # How many times to retry a user while the database is busy with another shard's
+    # writes. SQLite gives up on lock upgrades straight away rather than waiting.
+    BUSY_RETRIES = 3
+
+    def __init__(self, crawl_run, shard, api=None, poll_interval=0.5):
+        self.crawl_run = crawl_run
+        self.shard = shard
+        self.api = api if api is not None else shard_api(shard)
+        self.poll_interval = poll_interval
+        self.expanded = 0
+        # How many times a user was reached again after some shard scheduled them.
+        self.duplicates = 0
+
+    def run(self):
+        """
+        Return the number of users this worker expanded.
+        """
+        nodes = self.crawl_run.nodes
+        while True:
+            try:
+                level = nodes.filter(done=False, failed=False).aggregate(
+                    level=Min('depth'))['level']
+                node = self.claim(level) if level is not None else None
+            except OperationalError:
+                log.warning("Database busy, waiting.")
+                time.sleep(self.poll_interval)
+                continue
+            if level is None:
+                return self.expanded
+            if node is None:
+                # The other shards are still busy with this level.
+                time.sleep(self.poll_interval)
+                continue
+
+            try:
+                expanded = self._retry_busy(self.crawl, node.user_id, node.depth)
+            except Exception:
+                log.exception("Failed to crawl user %d" % node.user_id)
+                # The other shards wait on this node, so keep at it until it's released.
+                self._retry_busy(nodes.filter(pk=node.pk).update, claimed=False, failed=True,
+                                 retries=None)
+            else:
+                self._retry_busy(nodes.filter(pk=node.pk).update, done=True, retries=None)
+                self.expanded += expanded
+
+    def _retry_busy(self, func, *args, **kwargs):
+        """
+        Call ``func``, retrying up to ``retries`` times, or for as long as it
+        takes if that is None, while the database is busy.
+        """
+        retries = kwargs.pop('retries', self.BUSY_RETRIES)
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except OperationalError:
+                if attempt == retries:
+                    raise
+                log.warning("Database busy, retrying.")
+                time.sleep(self.poll_interval * 2 ** min(attempt, 6))
+                attempt += 1
+
+    def claim(self, level):
+        """
+        Claim a node of this shard at ``level``, or return None if there is none left.
+        """
+        candidates = self.crawl_run.nodes.filter(shard=self.shard, depth=level, done=False,
+                                                 claimed=False, failed=False)
+        for node in candidates.order_by('pk')[:10]:
+            if self.crawl_run.nodes.filter(pk=node.pk, claimed=False).update(claimed=True):
+                return node
+        return None
+
+    def crawl(self, pk, level):
+        """
+        Fetch a single user and add their neighbors to the next level. Return
+        whether the user was expanded.
+
+        This mirrors ``CrawlScheduler.crawl()``.
+        """
+        depth = self.crawl_run.depth
+        force = self.crawl_run.force
+        user = GitHubUser.objects.get(pk=pk)
+        user.api = self.api
+
+        if level > 0 and (level < depth or settings.POPULATE_ALL):
+            user.populate_from_github(force=force)
+
+        if level < depth:
+            user.populate_followers(force=force)
+            user.populate_following(force=force)
+
+            neighbors = dict(user.followers.values_list('pk', 'github_id'))
+            neighbors.update(user.following.values_list('pk', 'github_id'))
+            self.schedule(neighbors, level + 1)
+            return True
+        return False
+
+    def schedule(self, neighbors, level):
+        """
+        Add nodes at ``level`` for those of ``neighbors``, a dict of pk to
+        github_id, that no shard has reached yet.
+        """
+        reached = set(filter_pks(self.crawl_run.nodes.all(), neighbors, field='user')
+                      .values_list('user_id', flat=True))
+        shards = self.crawl_run.shards
+        new_nodes = [CrawlNode(run=self.crawl_run, user_id=pk, depth=level,
+                               shard=shard_for(github_id, shards))
+                     for pk, github_id in sorted(neighbors.items()) if pk not in reached]
+        self.duplicates += len(neighbors) - len(new_nodes)
+        if not new_nodes:
+            return
+        try:
+            with transaction.atomic():
+                CrawlNode.objects.bulk_create(new_nodes)
+        except IntegrityError:
+            # Another shard reached some of these users in the meantime.
+            for node in new_nodes:
+                _, created = CrawlNode.objects.get_or_create(
+                    run=self.crawl_run, user_id=node.user_id,
+                    defaults={'depth': level, 'shard': node.shard})
+                self.duplicates += not created
+
+
+class ShardedCrawl(object):
+    """
+    Fill the follow graph around ``root`` to the given depth with ``shards``
+    worker processes.
+
+    ``make_api`` builds the ``GitHubUserApi`` of a shard, by default with a
+    token of its own, see ``shard_api()``. ``process_class`` is what the
+    workers are started with, forked processes by default.
+    """
+
+    def __init__(self, root, depth=3, shards=None, force=False, crawl_run=None,
+                 make_api=None, process_class=None, poll_interval=0.5):
+        if shards is None:
+            shards = crawl_run.shards if crawl_run is not None else \
+                max(len(settings.GITHUB_ACCESS_TOKENS), 1)
+        self.root = root
+        self.depth = depth
+        self.shards = shards
+        self.force = force
+        self.crawl_run = crawl_run
+        self.make_api = make_api if make_api is not None else partial(shard_api, shards=shards)
+        self.process_class = process_class if process_class is not None else \
+            _multiprocessing().Process
+        self.poll_interval = poll_interval
+        self.duplicates = 0
+
+    @classmethod
+    def resume(cls, crawl_run, shards=None, **kwargs):
+        """
+        Build a crawl that continues the given ``CrawlRun``, whichever way it was
+        started.
+        """
+        return cls(crawl_run.root, depth=crawl_run.depth, shards=shards,
+                   force=crawl_run.force, crawl_run=crawl_run, **kwargs)
+
+    def run(self):
+        """
+        Crawl until the frontier is exhausted. Return the number of users expanded.
+        """
+        if self.crawl_run is None:
+            self.crawl_run = CrawlRun.objects.create(root=self.root, depth=self.depth,
+                                                     force=self.force, shards=self.shards)
+            self.crawl_run.nodes.create(user=self.root, depth=0,
+                                        shard=shard_for(self.root.github_id, self.shards))
+        else:
+            self._prepare_resume()
+
+        # Forked workers mustn't share the parent's database connections.
+        connections.close_all()
+        expanded = _multiprocessing().Value('i', 0)
+        duplicates = _multiprocessing().Value('i', 0)
+        workers = [self.process_class(target=_run_shard, name='crawler-shard-%d' % shard,
+                                      args=(self.crawl_run.pk, shard, self.make_api,
+                                            self.poll_interval, expanded, duplicates))
+                   for shard in range(self.shards)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        # Users that failed are left on the frontier for the next --resume.
+        if not self.crawl_run.nodes.filter(done=False).exists():
+            self.crawl_run.finished = datetime.datetime.now(tz=pytz.UTC)
+            self.crawl_run.save(update_fields=['finished'])
+        self.duplicates = duplicates.value
+        return expanded.value
+
+    def _prepare_resume(self):
+        """
+        Release the claims of workers that were interrupted, give failed nodes
+        another try and, if the number of shards changed, repartition the frontier.
+        """
+        frontier = self.crawl_run.nodes.filter(done=False)
+        frontier.update(claimed=False, failed=False)
+        if self.crawl_run.shards == self.shards:
+            return
+
+        by_shard = defaultdict(list)
+        for pk, github_id in frontier.values_list('pk', 'user__github_id'):
+            by_shard[shard_for(github_id, self.shards)].append(pk)
+        for shard, pks in by_shard.items():
+            filter_pks(CrawlNode.objects.all(), pks).update(shard=shard)
+        self.crawl_run.shards = self.shards
+        self.crawl_run.save(update_fields=['shards'])
@@ -0,0 +1,234 @@
+"""
+Instrumentation for long running crawls.
+
+A ``CrawlTelemetry`` is handed to a crawler, which passes it on to its
+``GitHubUserApi``. Between them they count responses by status and the bytes
+they carried, keep track of the frontier at each depth, and split the time of
+every thread between the stages of the crawl:
+
+``rate_limit``
+    waiting on the ``RateGovernor`` for a request to be allowed
+``network``
+    waiting on GitHub
+``parse``
+    decoding responses
+``database``
+    everything else a crawler does for a user, which is mostly the ORM
+``lock_wait``
+    threaded crawls only, waiting for another worker to be done with the database
+
+Stages nest: time spent in an inner stage isn't counted towards the stage
+around it. With several threads the stages add up to more than the elapsed
+time, since they're counted per thread.
+
+``ProgressReporter`` prints a progress line while the crawl runs, and the
+totals can be exported as JSON or in the Prometheus text format afterwards.
+"""
+import datetime
+import json
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+@contextmanager
+def _null_stage():
+    yield
+
+
+def stage(telemetry, name):
+    """
+    Return ``telemetry.stage(name)``, or a context that does nothing when
+    ``telemetry`` is None.
+    """
+    if telemetry is None:
+        return _null_stage()
+    return telemetry.stage(name)
+
+
+class CrawlTelemetry(object):
+    STAGES = ('rate_limit', 'network', 'parse', 'database', 'lock_wait')
+
+    def __init__(self):
+        self.started = time.time()
+        self.responses = Counter()
+        self.bytes = 0
+        self.seconds = dict((stage, 0.0) for stage in self.STAGES)
+        # Users queued and done at each depth.
+        self.queued = Counter()
+        self.done = Counter()
+        # Users done by this run, rather than restored from a checkpoint.
+        self.completed = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Count the time spent in the block towards the stage ``name``.
+        """
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        now = time.time()
+        if stack:
+            self.add_time(stack[-1][0], now - stack[-1][1])
+        stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.time()
+            name, since = stack.pop()
+            self.add_time(name, now - since)
+            if stack:
+                stack[-1][1] = now
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self.seconds[stage] += seconds
+
+    def record_response(self, status, size=0):
+        """
+        Count a response, None for a request that failed.
+        """
+        with self._lock:
+            self.responses[status] += 1
+            self.bytes += size
+
+    def scheduled(self, depth, count=1):
+        with self._lock:
+            self.queued[depth] += count
+
+    def finished(self, depth, count=1, restored=False):
+        with self._lock:
+            self.done[depth] += count
+            if not restored:
+                self.completed += count
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def eta(self):
+        """
+        Return the seconds left until the frontier that is known so far is
+        done, at the rate of this run so far, or None before anything is done.
+        """
+        return self.as_dict()['eta_seconds']
+
+    def as_dict(self):
+        elapsed = self.elapsed()
+        with self._lock:
+            requests = sum(self.responses.values())
+            remaining = sum(self.queued.values()) - sum(self.done.values())
+            return {
+                'elapsed_seconds': elapsed,
+                'requests': requests,
+                'requests_per_second': requests / elapsed if elapsed else 0.0,
+                'responses': dict((str(status), count)
+                                  for status, count in self.responses.items()),
+                'bytes': self.bytes,
+                'seconds': dict(self.seconds),
+                'frontier': dict((str(depth), {'queued': self.queued[depth],
+                                               'done': self.done[depth]})
+                                 for depth in sorted(self.queued)),
+                'eta_seconds': remaining * elapsed / self.completed if self.completed else None,
+            }
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        """
+        Return the totals in the Prometheus text exposition format.
+        """
+        data = self.as_dict()
+        lines = []
+
+        def metric(name, kind, description, samples):
+            name = 'github_users_crawl_' + name
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                label_text = ','.join('%s="%s"' % label for label in labels)
+                lines.append('%s%s %s' % (name, '{%s}' % label_text if label_text else '',
+                                          repr(float(value)) if isinstance(value, float)
+                                          else value))
+
+        metric('elapsed_seconds', 'gauge', "Seconds since the crawl started.",
+               [((), data['elapsed_seconds'])])
+        metric('responses_total', 'counter', "Responses from GitHub by status.",
+               [((('status', status),), count)
+                for status, count in sorted(data['responses'].items())])
+        metric('response_bytes_total', 'counter', "Bytes of responses from GitHub.",
+               [((), data['bytes'])])
+        metric('stage_seconds_total', 'counter',
+               "Seconds spent in each stage, summed over threads.",
+               [((('stage', stage),), data['seconds'][stage]) for stage in self.STAGES])
+        metric('users', 'gauge', "Users queued and done at each depth.",
+               [((('depth', depth), ('state', state)), counts[state])
+                for depth, counts in sorted(data['frontier'].items())
+                for state in ('queued', 'done')])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, format='json'):
+        with open(path, 'w') as f:
+            f.write(self.to_prometheus() if format == 'prometheus' else self.to_json())
+
+    def progress_line(self):
+        data = self.as_dict()
+        eta = data['eta_seconds']
+        frontier = ' '.join('%s:%d/%d' % (depth, counts['done'], counts['queued'])
+                            for depth, counts in sorted(data['frontier'].items(),
+                                                        key=lambda item: int(item[0])))
+        responses = ' '.join('%s:%d' % (status, count)
+                             for status, count in sorted(data['responses'].items()))
+        stages = ' '.join('%s %.0fs' % (stage, data['seconds'][stage]) for stage in self.STAGES
+                          if data['seconds'][stage])
+        return 'depth %s | %.1f req/s [%s] %.1f MB | %s | ETA %s' % (
+            frontier or '-', data['requests_per_second'], responses,
+            data['bytes'] / 1e6, stages or '-',
+            datetime.timedelta(seconds=int(eta)) if eta is not None else '?')
+
+
+class ProgressReporter(object):
+    """
+    Rewrite a progress line on ``stream`` every ``interval`` seconds, from a
+    thread of its own, until stopped.
+    """
+
+    def __init__(self, telemetry, stream=None, interval=1.0):
+        self.telemetry = telemetry
+        self.stream = stream if stream is not None else sys.stderr
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._report, name='crawl-progress')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._write()
+        self.stream.write('\n')
+        self.stream.flush()
+
+    def _write(self):
+        # Clear what is left of a longer line before it.
+        self.stream.write('\r%s\x1b[K' % self.telemetry.progress_line())
+        self.stream.flush()
+
+    def _report(self):
+        while not self._stop.wait(self.interval):
+            self._write()
@@ -1,9 +1,89 @@
+import datetime
 import json
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from contextlib import contextmanager
 
-from django.core.urlresolvers import reverse
-from django.test import TestCase
+import pytz
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.core.urlresolvers import resolve, reverse
+from django.db import DatabaseError, connection, connections
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.utils import six
 
-from .models import GitHubUser
+from . import transactions
+from .benchmarks import _tuned_indexes, case_insensitive_index_names, power_law_edges
+from .crawler import CrawlScheduler
+from .fake_github import FakeGitHub, UnlimitedGovernor
+from .github_user_api import GitHubUserApi, RateGovernor
+from .graph import FollowGraph
+from .graph_cache import clear_follow_graph, follow_graph
+from .hydrate import Hydrator, pending_users
+from .models import CrawlRun, DistanceIndex, GitHubUser, GraphVersion
+from .paginator import iterate_keyset
+from .refresh import RefreshScheduler
+from .sharded_crawler import ShardedCrawl, ShardWorker, shard_api, shard_for
+from .telemetry import CrawlTelemetry
+from .transactions import immediate_atomic
+
+
+def quiet_logging(test):
+    """
+    Keep the app's debug lines and expected warnings out of the test output for
+    the rest of ``test``.
+    """
+    log = logging.getLogger('github_users')
+    test.addCleanup(log.setLevel, log.level)
+    log.setLevel(logging.CRITICAL)
+
+
+class FakeGitHubUserApi(object):
+    """
+    Stand in for ``GitHubUserApi``, serving a small graph from memory.
+
+    ``followers`` maps each login to the logins of their followers.
+    """
+
+    def __init__(self, followers):
+        self.followers = followers
+        self.logins = sorted(set(followers) | set(
+            login for follower_list in followers.values() for login in follower_list))
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def _user_json(self, login):
+        return {'id': self.logins.index(login) + 1000, 'login': login}
+
+    def _response(self, call, data):
+        with self._lock:
+            self.calls.append(call)
+        return {'status': 200, 'etag': 'etag-%s-%s' % call, 'json': data}
+
+    def get_user(self, username, etag=None):
+        data = self._user_json(username)
+        data.update({
+            'followers': len(self.followers.get(username, [])),
+            'following': len([l for l in self.logins if username in self.followers.get(l, [])]),
+        })
+        return self._response(('user', username), data)
+
+    def get_user_followers(self, username, follower_etag=None, follower_url=None):
+        return self._response(('followers', username), [
+            self._user_json(login) for login in self.followers.get(username, [])])
+
+    def get_user_following(self, username, following_etag=None, following_url=None):
+        return self._response(('following', username), [
+            self._user_json(login) for login in self.logins
+            if username in self.followers.get(login, [])])
 
 
 class UserRelationsTestCase(TestCase):
@@ -27,6 +107,172 @@ class UserRelationsTestCase(TestCase):
         within_3 = self.root_user.users_within_distance(3)
         self.assertEqual(within_3.count(), 63)
 
+    def test_distance_follows_walks(self):
+        # Walking to a follower and back again leads to the root user.
+        at_2 = GitHubUser.follow_relations.distance(root_user=self.root_user, distance=2)
+        self.assertTrue(at_2.filter(pk=self.root_user.pk).exists())
+        self.assertFalse(self.root_user.users_within_distance(2)
+                         .filter(pk=self.root_user.pk).exists())
+
+
+class FollowGraphTestCase(TestCase):
+    """
+    Traversals over a small hand built graph.
+    """
+
+    def setUp(self):
+        # 1 <- 2 <- 3 <- 1 is a cycle, 4 follows 3 and 5 is followed by 4.
+        self.graph = FollowGraph.from_edges([(1, 2), (2, 3), (3, 1), (3, 4), (5, 4)])
+
+    def test_layers(self):
+        self.assertEqual(self.graph.layers(1, 5), [[2, 3], [4], [5]])
+        self.assertEqual(self.graph.layers(1, 1), [[2, 3]])
+
+    def test_within(self):
+        self.assertEqual(self.graph.within(4, 1), set([3, 5]))
+        self.assertEqual(self.graph.within(4, 2), set([1, 2, 3, 5]))
+        self.assertEqual(self.graph.within(99, 2), set())
+
+    def test_reachable_by_walk(self):
+        self.assertEqual(self.graph.reachable_by_walk(5, 2), set([3, 5]))
+
+    def test_shortest_path(self):
+        self.assertEqual(self.graph.shortest_path(1, 5), [1, 3, 4, 5])
+        self.assertEqual(self.graph.shortest_path(5, 2), [5, 4, 3, 2])
+        self.assertEqual(self.graph.shortest_path(2, 2), [2])
+        self.assertEqual(self.graph.shortest_path(1, 5, max_distance=2), None)
+        self.assertEqual(self.graph.shortest_path(1, 99), None)
+
+        graph = FollowGraph.from_edges(power_law_edges(2000, follows=2, seed=3))
+        for target in (7, 500, 1999):
+            path = graph.shortest_path(0, target)
+            layers = graph.layers(0, 10)
+            distance = [d for d, layer in enumerate(layers, 1) if target in layer][0]
+            self.assertEqual(len(path) - 1, distance)
+            for a, b in zip(path, path[1:]):
+                self.assertIn(b, graph.neighbors(a))
+
+    def test_snapshot(self):
+        graph = FollowGraph.from_edges([(1, 2), (2, 3), (3, 1), (3, 4), (5, 4)], pks=[7])
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'graph.snapshot')
+        graph.write_snapshot(path, [(pk, pk + 100, u'user\xe9%d' % pk) for pk in graph.pks])
+
+        snapshot = FollowGraph.open(path)
+        self.assertEqual(len(snapshot), 6)
+        self.assertEqual(snapshot.layers(1, 5), [[2, 3], [4], [5]])
+        self.assertEqual(snapshot.neighbors(7), set())
+        self.assertEqual(snapshot.degree(3), (2, 1))
+        self.assertEqual(snapshot.login(4), u'user\xe94')
+        self.assertEqual(snapshot.github_id(5), 105)
+        self.assertEqual(snapshot.login(99), None)
+
+
+class GraphCacheTestCase(TestCase):
+    fixtures = ['test_data.json']
+
+    def setUp(self):
+        clear_follow_graph()
+        self.addCleanup(clear_follow_graph)
+        self.user = GitHubUser.objects.get(login='matthewcburke')
+        self.stranger = GitHubUser.objects.exclude(
+            pk__in=self.user.users_within_distance(1)).exclude(pk=self.user.pk)[0]
+
+    def test_reload_on_change(self):
+        graph = follow_graph()
+        self.assertIs(follow_graph(), graph)
+        self.assertNotIn(self.stranger.pk, graph.neighbors(self.user.pk))
+
+        self.user.followers.add(self.stranger)
+        self.assertIsNot(follow_graph(), graph)
+        self.assertIn(self.stranger.pk, follow_graph().neighbors(self.user.pk))
+
+        self.user._remove_stale('followers', set())
+        self.assertEqual(follow_graph().neighbors(self.user.pk),
+                         set(self.user.following.values_list('pk', flat=True)))
+
+    def test_shared_snapshot(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        with self.settings(GRAPH_SNAPSHOT_DIR=tmp):
+            clear_follow_graph()
+            graph = follow_graph()
+            self.assertEqual(graph.login(self.user.pk), 'matthewcburke')
+            self.assertEqual(len(os.listdir(tmp)), 1)
+
+            # Another process finds the snapshot rather than loading the graph itself.
+            clear_follow_graph()
+            with self.assertNumQueries(1):
+                self.assertEqual(follow_graph().within(self.user.pk, 3),
+                                 graph.within(self.user.pk, 3))
+
+            self.user.followers.add(self.stranger)
+            self.assertIn(self.stranger.pk, follow_graph().neighbors(self.user.pk))
+
+    @override_settings(GRAPH_RELOAD_INTERVAL=60)
+    def test_reload_interval(self):
+        graph = follow_graph()
+        self.user.followers.add(self.stranger)
+        # The stamp was only just checked, so callers that don't mind are served the
+        # graph as it is, without a query.
+        with self.assertNumQueries(0):
+            self.assertIs(follow_graph(stale_ok=True), graph)
+        # Everybody else sees the change at once.
+        self.assertIn(self.stranger.pk, follow_graph().neighbors(self.user.pk))
+        self.assertIsNot(follow_graph(), graph)
+
+    def test_snapshot_replaced(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        with self.settings(GRAPH_SNAPSHOT_DIR=tmp):
+            clear_follow_graph()
+            follow_graph()
+            old_path = os.path.join(tmp, os.listdir(tmp)[0])
+            self.user.followers.add(self.stranger)
+            follow_graph()
+            # A replaced snapshot is kept a while for the processes about to open it...
+            self.assertTrue(os.path.exists(old_path))
+
+            os.utime(old_path, (0, 0))
+            self.user.followers.remove(self.stranger)
+            follow_graph()
+            # ...and deleted once it's old.
+            self.assertFalse(os.path.exists(old_path))
+            self.assertEqual(len(os.listdir(tmp)), 2)
+
+            # A snapshot that another process deleted is written again.
+            for name in os.listdir(tmp):
+                os.remove(os.path.join(tmp, name))
+            clear_follow_graph()
+            self.assertNotIn(self.stranger.pk, follow_graph().neighbors(self.user.pk))
+
+
+class IndexesTestCase(TestCase):
+    def test_tuned_indexes(self):
+        names = [name for table, name in _tuned_indexes()]
+        self.assertIn('github_users_githubuser_followers_to_from', names)
+        # The case insensitive indexes, where the backend has any, are dropped and timed too.
+        case_insensitive = case_insensitive_index_names()
+        for name in case_insensitive:
+            self.assertIn(name, names)
+        # One per filter field, and the reverse follower index.
+        self.assertEqual(len(names), 5 + len(case_insensitive))
+
+
+class PowerLawEdgesTestCase(TestCase):
+    def test_power_law_edges(self):
+        edges = list(power_law_edges(1000, follows=3, seed=1))
+        self.assertEqual(edges, list(power_law_edges(1000, follows=3, seed=1)))
+        # Nobody follows themselves, or anyone twice.
+        self.assertEqual(len(set(edges)), len(edges))
+        self.assertFalse([edge for edge in edges if edge[0] == edge[1]])
+
+        # A few early users collect most of the followers.
+        graph = FollowGraph.from_edges(edges)
+        counts = sorted((len(graph.neighbors(pk)) for pk in graph.pks), reverse=True)
+        self.assertGreater(counts[0], 10 * counts[len(counts) // 2])
+
 
 class UserApiTestCase(TestCase):
     """
@@ -37,6 +283,10 @@ class UserApiTestCase(TestCase):
     def setUp(self):
         self.root_user = GitHubUser.objects.get(login='breadjc')
         self.user_list = reverse('api_dispatch_list', kwargs={'resource_name': 'user'})
+        caches['results'].clear()
+        # The API serves a graph for a while without checking it, so don't share one.
+        clear_follow_graph()
+        self.addCleanup(clear_follow_graph)
 
     def test_user_list(self):
         resp = self.client.get("%s?order_by=num_following" % self.user_list)
@@ -59,3 +309,1057 @@ class UserApiTestCase(TestCase):
         resp = self.client.get(uri)
         data = json.loads(resp.content)
         self.assertEqual(data['meta']['total_count'], 7)
+
+    def test_detail(self):
+        uri = reverse('api_dispatch_detail', kwargs={'resource_name': 'user',
+                                                     'pk': self.root_user.pk})
+        # The user and the counts, without a query per follower.
+        with self.assertNumQueries(1):
+            data = json.loads(self.client.get(uri).content)
+        self.assertNotIn('followers', data)
+        self.assertNotIn('following', data)
+        self.assertEqual(data['followers_count'], self.root_user.followers.count())
+        self.assertEqual(data['following_count'], self.root_user.following.count())
+        self.assertEqual(data['followers_uri'], uri + 'followers/')
+        self.assertEqual(data['following_uri'], uri + 'following/')
+
+        data = json.loads(self.client.get(self.user_list).content)
+        self.assertNotIn('followers_count', data['objects'][0])
+
+    def test_relations(self):
+        for relation in ('followers', 'following'):
+            uri = reverse('api_user_%s' % relation, kwargs={'resource_name': 'user',
+                                                            'pk': self.root_user.pk})
+            expected = sorted(getattr(self.root_user, relation).values_list('login', flat=True))
+            data = json.loads(self.client.get(uri + '?order_by=login').content)
+            self.assertEqual(data['meta']['total_count'], len(expected))
+            self.assertEqual([o['login'] for o in data['objects']], expected)
+            self.assertEqual(self._pages(uri + '?order_by=login&limit=1&cursor='), expected)
+
+        # tastypie answers a missing user with a 404, but re-raises for the test server and
+        # the test client, so call the view as any other server would.
+        uri = reverse('api_user_followers', kwargs={'resource_name': 'user', 'pk': 0})
+        match = resolve(uri)
+        response = match.func(RequestFactory().get(uri, SERVER_NAME='localhost'),
+                              *match.args, **match.kwargs)
+        self.assertEqual(response.status_code, 404)
+
+    def test_result_cache(self):
+        mb = GitHubUser.objects.get(login='matthewcburke')
+        uri = reverse('api_user_within', kwargs={'resource_name': 'user', 'pk': mb.pk,
+                                                 'distance': 3})
+        uri += '?order_by=-distance&order_by=login&limit=3'
+        first = json.loads(self.client.get(uri).content)
+        # The user, the stamps and the users on the page, without running the query again.
+        with self.assertNumQueries(3):
+            second = json.loads(self.client.get(uri + '&offset=3').content)
+        self.assertEqual(second['meta']['total_count'], 7)
+        expected = json.loads(self.client.get(uri + '&limit=0&cursor=').content)['objects']
+        self.assertEqual(first['objects'] + second['objects'], expected[:6])
+        self.assertEqual(expected[0]['distance'], 3)
+
+        # Writing edges changes the stamp, so the next request misses.
+        mb.following.add(self.root_user)
+        self.assertEqual(json.loads(self.client.get(uri).content)['meta']['total_count'],
+                         len(list(mb.users_within_distance(3))))
+
+        # So do the crawler's changes to users.
+        filtered = '%s?location=Nowhere' % self.user_list
+        self.assertEqual(json.loads(self.client.get(filtered).content)['objects'], [])
+        GitHubUser.objects.filter(pk=mb.pk).update(location='Nowhere')
+        self.assertEqual(json.loads(self.client.get(filtered).content)['objects'], [])
+        GraphVersion.objects.bump_users()
+        logins = [o['login'] for o in json.loads(self.client.get(filtered).content)['objects']]
+        self.assertEqual(logins, ['matthewcburke'])
+
+    @override_settings(GRAPH_RELOAD_INTERVAL=60)
+    def test_result_cache_stale_graph(self):
+        mb = GitHubUser.objects.get(login='matthewcburke')
+        uri = reverse('api_user_within', kwargs={'resource_name': 'user', 'pk': mb.pk,
+                                                 'distance': 1})
+        before = json.loads(self.client.get(uri).content)['meta']['total_count']
+
+        # The graph isn't reloaded yet, and neither is its result cached as the new edges'.
+        mb.following.add(GitHubUser.objects.exclude(
+            pk__in=mb.users_within_distance(1)).exclude(pk=mb.pk)[0])
+        self.assertEqual(json.loads(self.client.get(uri).content)['meta']['total_count'],
+                         before)
+        follow_graph()
+        self.assertEqual(json.loads(self.client.get(uri).content)['meta']['total_count'],
+                         before + 1)
+
+    def _pages(self, uri):
+        logins = []
+        while uri:
+            data = json.loads(self.client.get(uri).content)
+            logins.extend(o['login'] for o in data['objects'])
+            uri = data['meta']['next']
+        return logins
+
+    def test_cursor(self):
+        for order in ('-num_followers', 'location', '-company', 'id'):
+            expected = [o['login'] for o in json.loads(self.client.get(
+                "%s?order_by=%s&order_by=id&limit=0" % (self.user_list, order)).content)['objects']]
+            self.assertEqual(len(expected), 64)
+            logins = self._pages("%s?order_by=%s&limit=7&cursor=" % (self.user_list, order))
+            self.assertEqual(logins, expected)
+
+        resp = self.client.get("%s?cursor=&total_count=1" % self.user_list)
+        data = json.loads(resp.content)
+        self.assertEqual(data['meta']['total_count'], 64)
+        self.assertNotIn('total_count', json.loads(
+            self.client.get("%s?cursor=" % self.user_list).content)['meta'])
+
+    def test_cursor_within(self):
+        mb = GitHubUser.objects.get(login='matthewcburke')
+        uri = reverse('api_user_within', kwargs={'resource_name': 'user', 'pk': mb.pk,
+                                                 'distance': 3})
+        logins = self._pages("%s?order_by=-num_following&limit=2&cursor=" % uri)
+        self.assertEqual(len(logins), 7)
+        self.assertEqual(set(logins),
+                         set(mb.users_within_distance(3).values_list('login', flat=True)))
+
+    def _ndjson(self, uri):
+        resp = self.client.get(uri)
+        self.assertEqual(resp['Content-Type'], 'application/x-ndjson')
+        content = b''.join(resp.streaming_content).decode('utf-8')
+        return [json.loads(line) for line in content.splitlines()]
+
+    def test_ndjson(self):
+        expected = json.loads(self.client.get(
+            "%s?location__isnull=false&order_by=-num_followers&order_by=id&limit=0" %
+            self.user_list).content)['objects']
+        rows = self._ndjson("%s?location__isnull=false&order_by=-num_followers&format=ndjson" %
+                            self.user_list)
+        self.assertEqual([(row['login'], row['resource_uri']) for row in rows],
+                         [(o['login'], o['resource_uri']) for o in expected])
+
+        mb = GitHubUser.objects.get(login='matthewcburke')
+        uri = reverse('api_user_within', kwargs={'resource_name': 'user', 'pk': mb.pk,
+                                                 'distance': 3})
+        rows = self._ndjson("%s?format=ndjson" % uri)
+        self.assertEqual(set(row['login'] for row in rows),
+                         set(mb.users_within_distance(3).values_list('login', flat=True)))
+
+    def test_iterate_keyset(self):
+        users = GitHubUser.objects.order_by('location')
+        rows = list(iterate_keyset(users, ['login'], chunk_size=5))
+        self.assertEqual([row['login'] for row in rows],
+                         list(users.order_by('location', 'id').values_list('login', flat=True)))
+
+    def test_within_distance(self):
+        mb = GitHubUser.objects.get(login='matthewcburke')
+        uri = reverse('api_user_within', kwargs={'resource_name': 'user', 'pk': mb.pk,
+                                                 'distance': 3})
+        expected = {}
+        for distance in (1, 2, 3):
+            for login in mb.users_within_distance(distance).exclude(
+                    pk__in=mb.users_within_distance(distance - 1)).values_list('login', flat=True):
+                expected[login] = distance
+
+        data = json.loads(self.client.get(uri + '?order_by=-distance').content)
+        found = [(o['login'], o['distance']) for o in data['objects']]
+        self.assertEqual(dict(found), expected)
+        self.assertEqual([d for _, d in found], sorted(expected.values(), reverse=True))
+
+        data = json.loads(self.client.get(uri + '?distance__gte=2&distance__lt=3').content)
+        self.assertEqual(set(o['login'] for o in data['objects']),
+                         set(login for login, d in expected.items() if d == 2))
+
+        data = json.loads(self.client.get(uri + '?counts_only=1').content)
+        self.assertEqual(data['total_count'], 7)
+        self.assertEqual(data['counts'], dict(
+            (str(d), list(expected.values()).count(d)) for d in (1, 2, 3)))
+
+        logins = self._pages(uri + '?order_by=distance&limit=2&cursor=')
+        self.assertEqual([expected[login] for login in logins], sorted(expected.values()))
+
+        # The same from a distance index.
+        DistanceIndex.objects.create(root=mb, max_distance=3).rebuild()
+        logins = self._pages(uri + '?order_by=-distance&limit=2&cursor=')
+        self.assertEqual([expected[login] for login in logins],
+                         sorted(expected.values(), reverse=True))
+        data = json.loads(self.client.get(uri + '?counts_only=1&distance__in=1,3').content)
+        self.assertEqual(sorted(data['counts']), ['1', '3'])
+
+        # Distance only means something on within/<distance>/.
+        resp = self.client.get("%s?order_by=distance" % self.user_list)
+        self.assertEqual(resp.status_code, 400)
+        data = json.loads(self.client.get(self.user_list).content)
+        self.assertNotIn('distance', data['objects'][0])
+
+    def test_path(self):
+        mb = GitHubUser.objects.get(login='matthewcburke')
+        far = mb.users_within_distance(3).exclude(pk__in=mb.users_within_distance(2))[0]
+        uri = reverse('api_user_path', kwargs={'resource_name': 'user', 'pk': mb.pk,
+                                               'other_pk': far.pk})
+        data = json.loads(self.client.get(uri).content)
+        self.assertEqual(data['distance'], 3)
+        self.assertEqual([o['login'] for o in data['path']][::3], [mb.login, far.login])
+
+        data = json.loads(self.client.get(uri + '?max_distance=2').content)
+        self.assertEqual(data, {'distance': None, 'path': []})
+
+    def test_bad_cursor(self):
+        resp = self.client.get("%s?cursor=nonsense" % self.user_list)
+        self.assertEqual(resp.status_code, 400)
+
+
+class IngestTestCase(TestCase):
+    """
+    Storing pages of followers and following.
+    """
+    fixtures = ['test_data.json']
+
+    def setUp(self):
+        quiet_logging(self)
+        self.user = GitHubUser.objects.get(login='jacobpgallagher')
+        self.existing = self.user.followers.all()[0]
+        self.stranger = GitHubUser.objects.exclude(followers=self.user).exclude(
+            following=self.user).exclude(pk=self.user.pk)[0]
+
+    def test_add_followers(self):
+        before = self.user.followers.count()
+        page = [
+            {'id': self.existing.github_id, 'login': self.existing.login},
+            {'id': self.stranger.github_id, 'login': self.stranger.login},
+            {'id': 1, 'login': 'new-user'},
+        ]
+        # Look up users, insert the new one, look up its pk, bump the users stamp, look up
+        # and insert edges, bump the graph version, then check for distance indexes to
+        # update. Inside the test's transaction both inserts are also wrapped in a savepoint.
+        with self.assertNumQueries(8 + 2 * 2):
+            self.user._add_followers(page)
+
+        self.assertEqual(self.user.followers.count(), before + 2)
+        self.assertTrue(self.user.followers.filter(login='new-user').exists())
+        self.assertTrue(self.user.followers.filter(pk=self.stranger.pk).exists())
+
+        # Adding the same page again is a no-op.
+        with self.assertNumQueries(2):
+            self.user._add_followers(page)
+        self.assertEqual(self.user.followers.count(), before + 2)
+
+    def test_add_following(self):
+        self.user._add_following([{'id': self.stranger.github_id,
+                                   'login': self.stranger.login}])
+        self.assertTrue(self.stranger.followers.filter(pk=self.user.pk).exists())
+
+    def test_force_refresh(self):
+        api = FakeGitHubUserApi({'root': ['a', 'b']})
+        root = GitHubUser(login='root')
+        root.api = api
+        root.populate_from_github()
+        root.populate_followers()
+        self.assertEqual(root.followers.count(), 2)
+
+        api.followers['root'] = ['a']
+        root.populate_followers(force=True)
+        self.assertEqual(list(root.followers.values_list('login', flat=True)), ['a'])
+
+
+class FillFollowGraphTestCase(TestCase):
+    """
+    ``fill_follow_graph`` fetches each user once, however many paths lead to them.
+    """
+
+    def setUp(self):
+        quiet_logging(self)
+        # root <- a <- c, root <- b <- c: c is reachable along two paths.
+        self.api = FakeGitHubUserApi({'root': ['a', 'b'], 'a': ['c'], 'b': ['c'], 'c': ['d']})
+        self.root = GitHubUser(login='root')
+        self.root.api = self.api
+        self.root.populate_from_github()
+
+    @override_settings(POPULATE_ALL=True)
+    def test_fill(self):
+        stats = self.root.fill_follow_graph(depth=2)
+        # a and b each reach root again, and b reaches c after a, as CrawlScheduler counts.
+        self.assertEqual(stats, {'expanded': 3, 'populated': 3, 'duplicates': 3})
+        self.assertEqual(len(self.api.calls), len(set(self.api.calls)))
+        self.assertEqual(set(GitHubUser.objects.values_list('login', flat=True)),
+                         set(['root', 'a', 'b', 'c']))
+        self.assertEqual(GitHubUser.objects.get(login='c').e_tag, 'etag-user-c')
+
+    @override_settings(POPULATE_ALL=False)
+    def test_edge_not_populated(self):
+        stats = self.root.fill_follow_graph(depth=2)
+        self.assertEqual(stats, {'expanded': 3, 'populated': 2, 'duplicates': 3})
+        self.assertIsNone(GitHubUser.objects.get(login='c').e_tag)
+
+
+class DistanceIndexTestCase(TestCase):
+    """
+    The materialized distance index stays in step with the edges.
+    """
+    fixtures = ['test_data.json']
+
+    def setUp(self):
+        self.root_user = GitHubUser.objects.get(login='breadjc')
+        self.index = DistanceIndex.objects.create(root=self.root_user, max_distance=3)
+        self.index.rebuild()
+
+    def assertIndexIsCurrent(self):
+        layers = FollowGraph.load().layers(self.root_user.pk, self.index.max_distance)
+        expected = dict((pk, distance) for distance, layer in enumerate(layers, 1)
+                        for pk in layer)
+        self.assertEqual(dict(self.index.entries.values_list('user_id', 'distance')), expected)
+
+    def test_within(self):
+        for distance, count in ((1, 3), (2, 7), (3, 63)):
+            with self.assertNumQueries(2):
+                self.assertEqual(self.root_user.users_within_distance(distance).count(), count)
+
+    def test_add_edges(self):
+        far_user = self.index.entries.filter(distance=3)[0].user
+        new_page = [{'id': far_user.github_id, 'login': far_user.login},
+                    {'id': 1, 'login': 'new-user'}]
+        self.root_user._add_followers(new_page)
+        self.assertEqual(self.index.entries.get(user=far_user).distance, 1)
+        self.assertIndexIsCurrent()
+
+    def test_remove_edges(self):
+        user = self.index.entries.filter(distance=1)[0].user
+        user._remove_stale('followers', set())
+        user._remove_stale('following', set())
+        self.assertFalse(self.index.entries.filter(user=user).exists())
+        self.assertIndexIsCurrent()
+
+
+class RateGovernorTestCase(TestCase):
+    """
+    Pacing requests over a pool of tokens.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.governor = RateGovernor(tokens=['first', 'second'], burst=0)
+        self.reset = int(time.time()) + 100
+
+    def test_unknown_budget(self):
+        self.assertEqual(self.governor.acquire(), 'first')
+
+    def test_exhausted_token_is_skipped(self):
+        self.governor.update('first', 5000, 0, self.reset)
+        self.governor.update('second', 5000, 4000, self.reset)
+        self.assertEqual(self.governor.acquire(), 'second')
+        self.assertEqual(self.governor.budget('second')['remaining'], 3999)
+
+    def test_pacing(self):
+        self.governor.update('first', 5000, 2, self.reset)
+        now = time.time()
+        wait, budget = self.governor._plan('first', now)
+        self.assertEqual(wait, 0)
+        self.governor._save('first', budget)
+
+        # The second request waits half of what is left of the window.
+        wait, budget = self.governor._plan('first', now)
+        self.assertAlmostEqual(wait, (self.reset - now) / 2, places=3)
+        self.assertEqual(budget['remaining'], 0)
+
+    def test_refund(self):
+        governor = RateGovernor(tokens=['first'], burst=0)
+        governor.update('first', 5000, 100, self.reset)
+        governor.acquire()
+        # A 304 isn't charged for, and gives its slot back.
+        governor.update('first', 5000, 100, self.reset, charged=False)
+        self.assertEqual(governor._plan('first', time.time())[0], 0)
+        self.assertEqual(governor.budget('first')['remaining'], 100)
+        # Nor is a request after which the remaining count didn't drop.
+        governor.acquire()
+        governor.update('first', 5000, 100, self.reset)
+        self.assertEqual(governor._plan('first', time.time())[0], 0)
+        # A charged request keeps its slot, so the next one is paced.
+        governor.acquire()
+        governor.update('first', 5000, 99, self.reset)
+        self.assertGreater(governor._plan('first', time.time())[0], 0)
+
+
+@override_settings(GITHUB_API_BACKOFF_FACTOR=0)
+class GitHubUserApiTestCase(TestCase):
+    """
+    The HTTP client, against a local fake GitHub.
+    """
+
+    def setUp(self):
+        cache.clear()
+        # The response cache is in a database of its own, which tests don't roll back.
+        caches['github'].clear()
+        # Pick up the settings above.
+        GitHubUserApi._session = None
+        quiet_logging(self)
+
+    def tearDown(self):
+        GitHubUserApi._session = None
+
+    def test_keep_alive(self):
+        with FakeGitHub({'root': ['a', 'b']}) as fake:
+            api = GitHubUserApi(governor=UnlimitedGovernor(), host=fake.url)
+            for _ in range(3):
+                resp = api.get_user('root', etag=False)
+                self.assertEqual(resp['json']['followers'], 2)
+            self.assertEqual(len(fake.connections), 1)
+
+    def test_retry(self):
+        with FakeGitHub({'root': ['a']}, failures=2) as fake:
+            api = GitHubUserApi(governor=UnlimitedGovernor(), host=fake.url)
+            resp = api.get_user('root', etag=False)
+            self.assertEqual(resp['status'], 200)
+            self.assertEqual(fake.requests, 3)
+
+    def test_revalidate_pages(self):
+        followers = ['user%03d' % i for i in range(150)]
+        with FakeGitHub({'root': followers, 'other': ['late']}) as fake:
+            root = GitHubUser(login='root')
+            root.api = GitHubUserApi(governor=UnlimitedGovernor(), host=fake.url)
+            root.populate_from_github()
+            root.populate_followers()
+            self.assertEqual(root.followers.count(), 150)
+
+            # Both pages are unchanged and replayed from the cache.
+            requests_before = fake.requests
+            root.populate_followers()
+            self.assertEqual(fake.requests - requests_before, 2)
+            self.assertEqual(fake.not_modified, 2)
+
+            # Only the second page changed.
+            fake.followers['root'].append('late')
+            root.populate_followers()
+            self.assertEqual(fake.not_modified, 3)
+            self.assertEqual(root.followers.count(), 151)
+            self.assertTrue(root.followers.filter(login='late').exists())
+
+    def test_response_cache_database(self):
+        with FakeGitHub({'root': ['a']}, profiles={'root': {'bio': 'Hi', 'location': 'Here'}}) \
+                as fake:
+            api = GitHubUserApi(governor=UnlimitedGovernor(), host=fake.url)
+            api.get_user('root')
+            # Only what the models read is kept, and replayed.
+            cached = api.cached_response(fake.url + '/users/root')
+            self.assertNotIn('bio', cached['json'])
+            resp = api.get_user('root')
+            self.assertEqual((resp['status'], resp['json']['location']), (304, 'Here'))
+        self.assertEqual(GitHubUserApi._cached_json([{'id': 1, 'login': 'a', 'type': 'User'}]),
+                         [{'id': 1, 'login': 'a'}])
+        # The responses are kept out of the crawl's database.
+        self.assertNotIn('github_response_cache', connection.introspection.table_names())
+        cache_database = connections[settings.GITHUB_RESPONSE_CACHE_DATABASE]
+        self.assertIn('github_response_cache', cache_database.introspection.table_names())
+
+    def test_create_cache_table(self):
+        cache_database = connections[settings.GITHUB_RESPONSE_CACHE_DATABASE]
+        with cache_database.cursor() as cursor:
+            cursor.execute('DROP TABLE github_response_cache')
+        self.assertNotIn('github_response_cache', cache_database.introspection.table_names())
+        call_command('migrate', database=settings.GITHUB_RESPONSE_CACHE_DATABASE, verbosity=0)
+        self.assertIn('github_response_cache', cache_database.introspection.table_names())
+
+    def test_retries_exhausted(self):
+        with FakeGitHub({'root': ['a']}, failures=10) as fake:
+            api = GitHubUserApi(governor=UnlimitedGovernor(), host=fake.url)
+            self.assertEqual(api.get_user('root', etag=False)['status'], None)
+
+
+# Without a shared cache each thread would get its own, empty, in-memory database.
+threads_share_test_db = unittest.skipIf(
+    connection.vendor == 'sqlite' and not connection.features.can_share_in_memory_db,
+    "Worker threads can't share this in-memory test database.")
+
+
+@contextmanager
+def on_disk_database():
+    """
+    Point the default database at a new, migrated, SQLite file for the duration,
+    for tests of locking, which the in-memory test database doesn't do.
+    """
+    directory = tempfile.mkdtemp()
+    name = connection.settings_dict['NAME']
+    # The in-memory database only lasts while a connection to it is open.
+    in_memory = connection.connection
+    connection.connection = None
+    # Connections made by other threads share the settings.
+    connection.settings_dict['NAME'] = os.path.join(directory, 'db.sqlite3')
+    try:
+        call_command('migrate', verbosity=0)
+        yield connection.settings_dict['NAME']
+    finally:
+        connection.close()
+        connection.settings_dict['NAME'] = name
+        connection.connection = in_memory
+        shutil.rmtree(directory)
+
+
+@threads_share_test_db
+@override_settings(POPULATE_ALL=True)
+class CrawlSchedulerTestCase(TransactionTestCase):
+    """
+    Crawl a fake GitHub with several worker threads.
+    """
+
+    def setUp(self):
+        quiet_logging(self)
+        # root <- a <- c, root <- b <- c, c <- d <- e: c is reachable along two paths.
+        self.api = FakeGitHubUserApi({
+            'root': ['a', 'b'],
+            'a': ['c'],
+            'b': ['c'],
+            'c': ['d'],
+            'd': ['e'],
+        })
+        self.root = GitHubUser(login='root')
+        self.root.api = self.api
+        self.root.populate_from_github()
+
+    def test_crawl(self):
+        scheduler = CrawlScheduler(self.root, depth=2, workers=4, api=self.api)
+        self.assertEqual(scheduler.run(), 3)
+        # a and b each reach root again, and one of them reaches c after the other.
+        self.assertEqual(scheduler.duplicates, 3)
+        self.assertEqual(set(GitHubUser.objects.values_list('login', flat=True)),
+                         set(['root', 'a', 'b', 'c']))
+        self.assertEqual(set(self.root.followers.values_list('login', flat=True)),
+                         set(['a', 'b']))
+        # Every user is fetched once, even though 'c' is reachable twice.
+        self.assertEqual(len(self.api.calls), len(set(self.api.calls)))
+        self.assertEqual(self.api.calls.count(('user', 'c')), 1)
+
+        crawl_run = CrawlRun.objects.get()
+        self.assertIsNotNone(crawl_run.finished)
+        self.assertEqual(crawl_run.nodes.count(), 4)
+        self.assertFalse(crawl_run.nodes.filter(done=False).exists())
+
+    def test_resume(self):
+        # Checkpoint of a run that was interrupted after expanding the root.
+        crawl_run = CrawlRun.objects.create(root=self.root, depth=2)
+        self.root.populate_followers()
+        crawl_run.nodes.create(user=self.root, depth=0, done=True)
+        for follower in self.root.followers.all():
+            crawl_run.nodes.create(user=follower, depth=1)
+        del self.api.calls[:]
+
+        expanded = CrawlScheduler.resume(crawl_run, workers=2, api=self.api).run()
+        self.assertEqual(expanded, 2)
+        self.assertNotIn(('followers', 'root'), self.api.calls)
+        self.assertEqual(set(GitHubUser.objects.values_list('login', flat=True)),
+                         set(['root', 'a', 'b', 'c']))
+        self.assertIsNotNone(CrawlRun.objects.get().finished)
+
+    def test_batched_writes(self):
+        # With batches of two users, 'c' shares a batch with 'b'.
+        get_user = self.api.get_user
+
+        def failing_get_user(username, etag=None):
+            if username == 'c':
+                raise ValueError("GitHub is down")
+            return get_user(username, etag)
+
+        self.api.get_user = failing_get_user
+        with self.assertRaises(ValueError):
+            CrawlScheduler(self.root, workers=2, api=self.api, batch_size=2)
+
+        expanded = CrawlScheduler(self.root, depth=2, workers=1, api=self.api,
+                                  batch_size=2).run()
+        self.assertEqual(expanded, 3)
+        # Only the user that failed is rolled back, the rest of their batch is committed.
+        crawl_run = CrawlRun.objects.get()
+        self.assertEqual(list(crawl_run.nodes.filter(done=False)
+                              .values_list('user__login', flat=True)), ['c'])
+        self.assertEqual(set(self.root.followers.values_list('login', flat=True)),
+                         set(['a', 'b']))
+        self.assertEqual(GitHubUser.objects.get(login='b').e_tag, 'etag-user-b')
+        self.assertIsNone(crawl_run.finished)
+
+        # The --resume picks up 'c'.
+        self.api.get_user = get_user
+        CrawlScheduler.resume(crawl_run, workers=1, api=self.api, batch_size=2).run()
+        self.assertIsNotNone(CrawlRun.objects.get().finished)
+
+    def test_batched_writes_outside_requests(self):
+        # No transaction, and so no lock on the database, is held while waiting on GitHub.
+        in_transaction = []
+
+        def watched(fetch):
+            def call(*args, **kwargs):
+                in_transaction.append(connection.in_atomic_block)
+                return fetch(*args, **kwargs)
+            return call
+
+        for name in ('get_user', 'get_user_followers', 'get_user_following'):
+            setattr(self.api, name, watched(getattr(self.api, name)))
+        expanded = CrawlScheduler(self.root, depth=2, workers=1, api=self.api,
+                                  batch_size=2).run()
+        self.assertEqual(expanded, 3)
+        self.assertEqual(set(GitHubUser.objects.get(login='a').followers
+                             .values_list('login', flat=True)), set(['c']))
+        self.assertTrue(in_transaction)
+        self.assertFalse(any(in_transaction))
+
+
+@threads_share_test_db
+@override_settings(POPULATE_ALL=True)
+class CrawlTelemetryTestCase(TransactionTestCase):
+    """
+    Instrument crawls of a local fake GitHub.
+    """
+
+    def setUp(self):
+        quiet_logging(self)
+        cache.clear()
+        GitHubUserApi._session = None
+        self.fake = FakeGitHub({'root': ['a', 'b'], 'a': ['c'], 'b': ['c']}).start()
+        self.api = GitHubUserApi(governor=UnlimitedGovernor(), host=self.fake.url)
+        self.root = GitHubUser(login='root')
+        self.root.api = self.api
+        self.root.populate_from_github()
+
+    def tearDown(self):
+        self.fake.stop()
+        GitHubUserApi._session = None
+
+    def test_stages(self):
+        telemetry = CrawlTelemetry()
+        with telemetry.stage('database'):
+            time.sleep(0.02)
+            with telemetry.stage('network'):
+                time.sleep(0.05)
+        self.assertGreaterEqual(telemetry.seconds['network'], 0.05)
+        # The inner stage isn't counted towards the outer one.
+        self.assertGreaterEqual(telemetry.seconds['database'], 0.02)
+        self.assertLess(telemetry.seconds['database'], 0.05)
+
+    def test_crawl(self):
+        telemetry = CrawlTelemetry()
+        CrawlScheduler(self.root, depth=1, workers=2, api=self.api, telemetry=telemetry).run()
+        telemetry.scheduled(2)
+        CrawlScheduler(self.root, depth=1, workers=2, api=self.api, telemetry=telemetry).run()
+
+        data = telemetry.as_dict()
+        # root's followers and the profiles of a and b, then the same again, unchanged.
+        self.assertEqual(data['responses'], {'200': 3, '304': 3})
+        self.assertEqual(data['requests'], 6)
+        self.assertGreater(data['bytes'], 0)
+        self.assertEqual(data['frontier'], {'0': {'queued': 2, 'done': 2},
+                                            '1': {'queued': 4, 'done': 4},
+                                            '2': {'queued': 1, 'done': 0}})
+        self.assertGreater(data['seconds']['network'], 0)
+        self.assertGreater(data['seconds']['database'], 0)
+        self.assertGreater(data['eta_seconds'], 0)
+        self.assertEqual(json.loads(telemetry.to_json())['requests'], 6)
+        self.assertIn('depth 0:2/2 1:4/4 2:0/1', telemetry.progress_line())
+
+        prometheus = telemetry.to_prometheus()
+        self.assertIn('# TYPE github_users_crawl_responses_total counter\n', prometheus)
+        self.assertIn('github_users_crawl_responses_total{status="304"} 3\n', prometheus)
+        self.assertIn('github_users_crawl_users{depth="1",state="done"} 4\n', prometheus)
+
+    def test_command_metrics(self):
+        path = os.path.join(tempfile.mkdtemp(), 'metrics.prom')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        stdout = six.StringIO()
+        with override_settings(GITHUB_API_URL=self.fake.url):
+            call_command('fill_user_graph', 'root', '1', metrics=path,
+                         metrics_format='prometheus', stdout=stdout)
+        self.assertIn("Expanded 1 users, and skipped 0 repeat visits", stdout.getvalue())
+        with open(path) as f:
+            self.assertIn('github_users_crawl_responses_total{status="200"} 3\n', f.read())
+
+
+@threads_share_test_db
+@override_settings(POPULATE_ALL=True)
+class ShardedCrawlTestCase(TransactionTestCase):
+    """
+    Crawl a fake GitHub with shard workers, run on threads rather than processes.
+    """
+
+    def setUp(self):
+        quiet_logging(self)
+        self.api = FakeGitHubUserApi({
+            'root': ['a', 'b', 'c'],
+            'a': ['d', 'e'],
+            'b': ['d', 'f'],
+            'c': ['g'],
+            'g': ['h'],
+        })
+        self.root = GitHubUser(login='root')
+        self.root.api = self.api
+        self.root.populate_from_github()
+
+    def crawl(self, **kwargs):
+        kwargs.setdefault('depth', 2)
+        return ShardedCrawl(self.root, make_api=lambda shard: self.api,
+                            process_class=threading.Thread, poll_interval=0.01, **kwargs)
+
+    def test_shard_for(self):
+        shards = [shard_for(github_id, 4) for github_id in range(1000, 1400)]
+        self.assertEqual(set(shards), set(range(4)))
+        self.assertTrue(all(80 <= shards.count(shard) <= 120 for shard in range(4)))
+
+    def test_crawl(self):
+        crawl = self.crawl(shards=3)
+        self.assertEqual(crawl.run(), 4)
+        # a, b and c reach root again, and one of a and b reaches d after the other.
+        self.assertEqual(crawl.duplicates, 4)
+        self.assertEqual(set(GitHubUser.objects.values_list('login', flat=True)),
+                         set(['root', 'a', 'b', 'c', 'd', 'e', 'f', 'g']))
+        # Every user within reach is crawled. That each is crawled by a single worker
+        # is down to the claims, see test_claim.
+        self.assertEqual(set(self.api.calls), set(
+            [('user', 'root'), ('followers', 'root')] +
+            [(call, login) for login in 'abc' for call in ('user', 'followers', 'following')] +
+            [('user', login) for login in 'defg']))
+
+        crawl_run = CrawlRun.objects.get()
+        self.assertIsNotNone(crawl_run.finished)
+        self.assertEqual(crawl_run.shards, 3)
+        self.assertFalse(crawl_run.nodes.filter(done=False).exists())
+        self.assertEqual(dict(crawl_run.nodes.values_list('user__login', 'depth')), {
+            'root': 0, 'a': 1, 'b': 1, 'c': 1, 'd': 2, 'e': 2, 'f': 2, 'g': 2})
+        for node in crawl_run.nodes.select_related('user'):
+            self.assertEqual(node.shard, shard_for(node.user.github_id, 3))
+
+    @override_settings(GITHUB_ACCESS_TOKENS=['first', 'second'])
+    def test_shard_api(self):
+        # The first and third shards split the first token's budget.
+        governors = [shard_api(shard, 3).governor for shard in range(3)]
+        self.assertEqual([governor.tokens for governor in governors],
+                         [['first'], ['second'], ['first']])
+        self.assertEqual([governor.share for governor in governors], [0.5, 1, 0.5])
+
+    def test_claim(self):
+        crawl_run = CrawlRun.objects.create(root=self.root, depth=2)
+        crawl_run.nodes.create(user=self.root, depth=0)
+        first = ShardWorker(crawl_run, 0, api=self.api)
+        second = ShardWorker(crawl_run, 0, api=self.api)
+        self.assertEqual(first.claim(0).user_id, self.root.pk)
+        # Even a second worker for the same shard can't claim the user again.
+        self.assertIsNone(second.claim(0))
+
+    def test_resume(self):
+        # A threaded crawl that was interrupted after expanding the root, with one
+        # of its workers holding a claim.
+        crawl_run = CrawlRun.objects.create(root=self.root, depth=2)
+        self.root.populate_followers()
+        crawl_run.nodes.create(user=self.root, depth=0, done=True)
+        for follower in self.root.followers.all():
+            crawl_run.nodes.create(user=follower, depth=1, claimed=True)
+        del self.api.calls[:]
+
+        expanded = ShardedCrawl.resume(crawl_run, shards=2, make_api=lambda shard: self.api,
+                                       process_class=threading.Thread,
+                                       poll_interval=0.01).run()
+        self.assertEqual(expanded, 3)
+        self.assertEqual(set(self.api.calls), set(
+            [(call, login) for login in 'abc' for call in ('user', 'followers', 'following')] +
+            [('user', login) for login in 'defg']))
+        crawl_run = CrawlRun.objects.get()
+        self.assertIsNotNone(crawl_run.finished)
+        self.assertEqual(crawl_run.shards, 2)
+        self.assertEqual(crawl_run.nodes.count(), 8)
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "The async crawler needs Python 3.5 or later.")
+@threads_share_test_db
+@override_settings(POPULATE_ALL=True)
+class AsyncCrawlerTestCase(TransactionTestCase):
+    """
+    Crawl a local fake GitHub on an event loop.
+    """
+
+    def setUp(self):
+        quiet_logging(self)
+        cache.clear()
+        GitHubUserApi._session = None
+        self.fake = FakeGitHub({
+            'root': ['a', 'b'],
+            'a': ['c'],
+            'b': ['c'],
+            'c': ['d'],
+            'd': ['e'],
+            'big': ['user%03d' % i for i in range(250)],
+        }).start()
+        self.api = GitHubUserApi(governor=UnlimitedGovernor(), host=self.fake.url)
+
+    def tearDown(self):
+        self.fake.stop()
+        GitHubUserApi._session = None
+
+    def crawl(self, login, depth, **kwargs):
+        from .async_crawler import AsyncCrawler
+        root = GitHubUser.objects.filter(login=login).first() or GitHubUser(login=login)
+        root.api = self.api
+        root.populate_from_github()
+        requests_before = self.fake.requests
+        crawler = AsyncCrawler(root, depth=depth, concurrency=4, api=self.api, **kwargs)
+        crawler.run()
+        return crawler, self.fake.requests - requests_before
+
+    def test_crawl(self):
+        crawler, requests = self.crawl('root', 2)
+        self.assertEqual(crawler.expanded, 3)
+        self.assertEqual(crawler.duplicates, 3)
+        # root's followers (it follows nobody), the profile and both lists of a and b,
+        # then c's profile.
+        self.assertEqual(requests, 1 + 3 * 2 + 1)
+        self.assertEqual(set(GitHubUser.objects.values_list('login', flat=True)),
+                         set(['root', 'a', 'b', 'c']))
+        c = GitHubUser.objects.get(login='c')
+        self.assertEqual(set(c.following.values_list('login', flat=True)), set(['a', 'b']))
+        self.assertEqual((c.github_id, c.num_followers), (self.fake.ids['c'], 1))
+        a = GitHubUser.objects.get(login='a')
+        self.assertIsNotNone(a.e_tag)
+        self.assertIsNotNone(a.followers_etag)
+
+        crawl_run = CrawlRun.objects.get()
+        self.assertIsNotNone(crawl_run.finished)
+        self.assertEqual(crawl_run.nodes.count(), 4)
+        self.assertFalse(crawl_run.nodes.filter(done=False).exists())
+
+    @override_settings(POPULATE_ALL=False)
+    def test_pages(self):
+        crawler, requests = self.crawl('big', 1, batch_size=2)
+        # Three pages of followers, and big follows nobody.
+        self.assertEqual(requests, 3)
+        big = GitHubUser.objects.get(login='big')
+        self.assertEqual(big.followers.count(), 250)
+        self.assertGreater(crawler.batches, 1)
+
+    def test_recrawl(self):
+        self.crawl('root', 1)
+        not_modified = self.fake.not_modified
+        crawler, requests = self.crawl('root', 1)
+        # Nothing changed, so root's profile and followers and the profiles of a and b
+        # all came back not modified.
+        self.assertEqual(requests, 3)
+        self.assertEqual(self.fake.not_modified - not_modified, 1 + 3)
+        self.assertEqual(GitHubUser.objects.count(), 3)
+
+
+@unittest.skipIf(connection.vendor != 'sqlite', "Tests SQLite's locking.")
+@override_settings(POPULATE_ALL=True)
+class OnDiskDatabaseTestCase(TransactionTestCase):
+    """
+    Crawl into an SQLite file, where writers really do lock each other out.
+    """
+
+    def setUp(self):
+        quiet_logging(self)
+        cache.clear()
+        caches['github'].clear()
+        GitHubUserApi._session = None
+
+    def tearDown(self):
+        GitHubUserApi._session = None
+
+    def test_immediate_atomic(self):
+        with on_disk_database() as path:
+            other = sqlite3.connect(path, timeout=0)
+            try:
+                with immediate_atomic():
+                    # The write lock is taken before anything is read or written.
+                    with self.assertRaises(sqlite3.OperationalError):
+                        other.execute('BEGIN IMMEDIATE')
+                other.execute('BEGIN IMMEDIATE')
+                other.rollback()
+            finally:
+                other.close()
+
+            # Nothing is left patched, even when the transaction couldn't begin.
+            self.assertNotIn('_start_transaction_under_autocommit', connection.__dict__)
+            begin_immediate = transactions._begin_immediate
+            transactions._begin_immediate = lambda connection: connection.cursor().execute('BEGIN?')
+            try:
+                with self.assertRaises(DatabaseError):
+                    with immediate_atomic():
+                        pass
+            finally:
+                transactions._begin_immediate = begin_immediate
+            self.assertNotIn('_start_transaction_under_autocommit', connection.__dict__)
+            self.assertFalse(connection.in_atomic_block)
+            with immediate_atomic():
+                self.assertTrue(connection.in_atomic_block)
+
+    @unittest.skipIf(sys.version_info < (3, 5), "The async crawler needs Python 3.5 or later.")
+    def test_async_crawl(self):
+        from .async_crawler import AsyncCrawler
+        followers = {'user%02d' % i: ['user%02d' % ((i * 7 + j) % 40) for j in range(1, 6)]
+                     for i in range(40)}
+        with on_disk_database(), FakeGitHub(followers) as fake:
+            api = GitHubUserApi(governor=UnlimitedGovernor(), host=fake.url)
+            root = GitHubUser(login='user00')
+            root.api = api
+            root.populate_from_github()
+            crawler = AsyncCrawler(root, depth=3, concurrency=8, api=api, batch_size=5)
+            crawler.run()
+
+            # Nobody was lost to a locked database.
+            self.assertEqual(GitHubUser.objects.count(), 40)
+            self.assertFalse(GitHubUser.objects.filter(num_followers__isnull=True).exists())
+            self.assertIsNotNone(CrawlRun.objects.get().finished)
+
+    def test_sharded_processes(self):
+        followers = {'user%02d' % i: ['user%02d' % ((i * 7 + j) % 30) for j in range(1, 4)]
+                     for i in range(30)}
+        with on_disk_database(), FakeGitHub(followers) as fake:
+            root = GitHubUser(login='user00')
+            root.api = GitHubUserApi(governor=UnlimitedGovernor(), host=fake.url)
+            root.populate_from_github()
+            make_api = lambda shard: GitHubUserApi(governor=UnlimitedGovernor(), host=fake.url)
+            # Real worker processes, which only share the database file.
+            expanded = ShardedCrawl(root, depth=2, shards=2, make_api=make_api,
+                                    poll_interval=0.05).run()
+
+            crawl_run = CrawlRun.objects.get()
+            self.assertIsNotNone(crawl_run.finished)
+            self.assertEqual(expanded, crawl_run.nodes.filter(depth__lt=2).count())
+            self.assertEqual(GitHubUser.objects.count(), crawl_run.nodes.count())
+            self.assertFalse(GitHubUser.objects.filter(num_followers__isnull=True).exists())
+
+
+class RefreshSchedulerTestCase(TestCase):
+    """
+    Refresh stale users against a local fake GitHub.
+    """
+
+    def setUp(self):
+        quiet_logging(self)
+        cache.clear()
+        GitHubUserApi._session = None
+        self.fake = FakeGitHub({'root': ['a', 'b'], 'other': ['c'], 'late': []}).start()
+        self.api = GitHubUserApi(governor=UnlimitedGovernor(), host=self.fake.url)
+        for login in ('root', 'other'):
+            user = GitHubUser(login=login)
+            user.api = self.api
+            user.populate_from_github()
+            user.populate_followers()
+        for user in GitHubUser.objects.filter(e_tag__isnull=True):
+            user.api = self.api
+            user.populate_from_github()
+        two_days_ago = datetime.datetime.now(tz=pytz.UTC) - datetime.timedelta(days=2)
+        GitHubUser.objects.update(last_checked=two_days_ago)
+
+    def tearDown(self):
+        self.fake.stop()
+        GitHubUserApi._session = None
+
+    def test_edge_counts(self):
+        root = GitHubUser.objects.with_edge_counts().get(login='root')
+        self.assertEqual((root.followers_stored, root.following_stored), (2, 0))
+        a = GitHubUser.objects.with_edge_counts().get(login='a')
+        self.assertEqual((a.followers_stored, a.following_stored), (0, 1))
+
+    def test_refresh_changed(self):
+        self.fake.followers['root'].append('late')
+        api = GitHubUserApi(governor=UnlimitedGovernor(), host=self.fake.url)
+        stats = RefreshScheduler(api=api).run()
+
+        self.assertEqual(stats['followers'], 1)
+        self.assertEqual(stats['following'], 0)
+        self.assertEqual(stats['remaining'], 0)
+        root = GitHubUser.objects.get(login='root')
+        self.assertEqual(root.num_followers, 3)
+        self.assertTrue(root.followers.filter(login='late').exists())
+        # Only root's profile and its followers changed.
+        self.assertEqual(stats['quota_used'], 2)
+
+    def test_unexpanded_relations(self):
+        # a now follows late too, but a's following list was never fetched.
+        self.fake.following['a'].append('late')
+        self.fake.followers['late'].append('a')
+        api = GitHubUserApi(governor=UnlimitedGovernor(), host=self.fake.url)
+        stats = RefreshScheduler(api=api).run()
+
+        a = GitHubUser.objects.with_edge_counts().get(login='a')
+        self.assertEqual((a.num_following, a.following_stored), (2, 1))
+        self.assertEqual((stats['followers'], stats['following']), (0, 0))
+        # Only a's profile changed.
+        self.assertEqual(stats['quota_used'], 1)
+
+    def test_budget(self):
+        self.fake.followers['root'].append('late')
+        self.fake.followers['other'].append('late')
+        api = GitHubUserApi(governor=UnlimitedGovernor(), host=self.fake.url)
+        stats = RefreshScheduler(api=api, budget=1).run()
+        self.assertEqual(stats['quota_used'], 1)
+        self.assertGreater(stats['remaining'], 0)
+
+    def test_missing(self):
+        del self.fake.ids['other']
+        stats = RefreshScheduler(api=self.api).run()
+        self.assertEqual((stats['profiles'], stats['missing']), (5, 1))
+        other = GitHubUser.objects.get(login='other')
+        self.assertTrue(other.missing)
+        self.assertGreater(other.last_checked,
+                           datetime.datetime.now(tz=pytz.UTC) - datetime.timedelta(hours=1))
+
+        # Users that are gone from GitHub aren't fetched again.
+        two_days_ago = datetime.datetime.now(tz=pytz.UTC) - datetime.timedelta(days=2)
+        GitHubUser.objects.update(last_checked=two_days_ago)
+        stats = RefreshScheduler(api=self.api).run()
+        self.assertEqual((stats['profiles'], stats['missing']), (4, 0))
+
+
+class HydratorTestCase(TestCase):
+    """
+    Bulk hydration of the users that were only seen in someone's list.
+    """
+
+    def setUp(self):
+        quiet_logging(self)
+        self.api = FakeGitHubUserApi({'root': ['a', 'b', 'c', 'd', 'e'], 'a': ['root']})
+        root = GitHubUser(login='root')
+        root.api = self.api
+        root.populate_from_github()
+        root.populate_followers()
+
+    def test_hydrate(self):
+        self.assertEqual(set(pending_users().values_list('login', flat=True)),
+                         set('abcde'))
+        stamp = GraphVersion.objects.current_with_users()
+        stats = Hydrator(batch_size=2, concurrency=3, api=self.api).run()
+
+        self.assertEqual(stats['hydrated'], 5)
+        self.assertEqual(stats['batches'], 3)
+        self.assertFalse(pending_users().exists())
+        self.assertNotEqual(GraphVersion.objects.current_with_users(), stamp)
+        a = GitHubUser.objects.get(login='a')
+        self.assertEqual((a.num_followers, a.num_following), (1, 1))
+        self.assertEqual(a.e_tag, 'etag-user-a')
+        # The relations are left alone.
+        self.assertIsNone(a.followers_etag)
+
+    def test_limit(self):
+        stats = Hydrator(batch_size=2, limit=3, api=self.api).run()
+        self.assertEqual(stats['hydrated'], 3)
+        self.assertEqual(sorted(pending_users().values_list('login', flat=True)), ['d', 'e'])
+
+    def test_missing(self):
+        get_user = self.api.get_user
+        self.api.get_user = lambda login, etag=None: (
+            {'status': 404, 'etag': '', 'json': {'message': 'Not Found'}} if login == 'b'
+            else get_user(login, etag))
+        stats = Hydrator(api=self.api).run()
+        self.assertEqual((stats['hydrated'], stats['missing']), (4, 1))
+        self.assertTrue(GitHubUser.objects.get(login='b').missing)
+        # Users that are gone from GitHub aren't fetched again.
+        self.assertFalse(pending_users().exists())
+        self.assertEqual(Hydrator(api=self.api).run()['missing'], 0)
+
+    def test_login_taken(self):
+        # 'b' was renamed to 'c', whose old row is still there, so 'b' can't be saved.
+        get_user = self.api.get_user
+
+        def renamed_get_user(login, etag=None):
+            resp = get_user(login, etag)
+            if login == 'b':
+                resp['json']['login'] = 'c'
+            return resp
+
+        self.api.get_user = renamed_get_user
+        stats = Hydrator(batch_size=5, api=self.api).run()
+        self.assertEqual((stats['hydrated'], stats['failed']), (4, 1))
+        self.assertEqual(sorted(pending_users().values_list('login', flat=True)), ['b'])
+
+    def test_no_profile(self):
+        # Plenty of users have neither a location nor a company, once fetched they're done.
+        GitHubUser.objects.filter(login='a').update(num_followers=1, e_tag='etag')
+        self.assertFalse(pending_users().filter(login='a').exists())
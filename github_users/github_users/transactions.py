@@ -0,0 +1,46 @@
+"""
+Transactions that take SQLite's write lock up front.
+
+SQLite begins a transaction without any lock, and asks for the write lock at
+the first write. If another connection has written since the transaction first
+read, the request fails with "database is locked" straight away, rather than
+waiting out the busy timeout, since waiting could deadlock. A transaction that
+begins with ``BEGIN IMMEDIATE`` takes the write lock before it reads anything,
+and waits for it like any single write does.
+"""
+import sys
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+
+def _begin_immediate(connection):
+    connection.cursor().execute('BEGIN IMMEDIATE')
+
+
+@contextmanager
+def immediate_atomic(using=None):
+    """
+    An ``atomic()`` block that, when it is the outermost block on SQLite,
+    begins its transaction with ``BEGIN IMMEDIATE``.
+    """
+    connection = connections[using or DEFAULT_DB_ALIAS]
+    atomic = transaction.atomic(using=using)
+    if connection.vendor == 'sqlite' and not connection.in_atomic_block:
+        # The outermost atomic() begins SQLite transactions with this method, and
+        # has no other way to say how. Only swap it for as long as that takes.
+        connection._start_transaction_under_autocommit = lambda: _begin_immediate(connection)
+        try:
+            atomic.__enter__()
+        finally:
+            del connection._start_transaction_under_autocommit
+    else:
+        atomic.__enter__()
+
+    try:
+        yield
+    except BaseException:
+        if not atomic.__exit__(*sys.exc_info()):
+            raise
+    else:
+        atomic.__exit__(None, None, None)